@@ -1,16 +1,294 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, send_from_directory, g, Response
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from dotenv import load_dotenv
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
+import threading
+import time
+import sys
+import random
+import hmac
+import cProfile
+import gzip
+import zlib
+import re
+import struct
+import atexit
+import base64
+import csv
+import hashlib
+import io
+from bisect import bisect_left
+from collections import OrderedDict, deque
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # ---------------- LOAD ENV ----------------
 load_dotenv()
 
 app = Flask(__name__)
 
+
+# ---------------- METRICS ----------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+METRIC_HELP = {
+    "inventory_http_requests_total": ("counter", "HTTP requests by route, method and status"),
+    "inventory_http_request_errors_total": ("counter", "HTTP requests that ended with a 5xx status"),
+    "inventory_http_request_duration_seconds": ("histogram", "HTTP request latency by route"),
+    "inventory_sheets_calls_total": ("counter", "Google Sheets API calls by worksheet and method"),
+    "inventory_sheets_call_errors_total": ("counter", "Google Sheets API calls that raised an exception"),
+    "inventory_sheets_call_duration_seconds": ("histogram", "Google Sheets API call latency by worksheet and method"),
+    "inventory_cache_requests_total": ("counter", "Cache lookups by cache name and result"),
+    "inventory_cache_hit_ratio": ("gauge", "Cache hit ratio since process start"),
+    "inventory_sheet_rows": ("gauge", "Data rows (without header) seen on the last read or tail of a worksheet"),
+    "inventory_sheet_last_refresh_age_seconds": ("gauge", "Seconds since a worksheet was last read or tailed"),
+}
+
+
+class Metrics:
+    """In-process counters, gauges and histograms exported in Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # (name, labels) -> value
+        self.gauges = {}        # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self.refreshed_at = {}  # worksheet -> time.time() of last full read or incremental tail
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[len(LATENCY_BUCKETS)] += 1
+            hist[-1] += seconds
+
+    def record_cache(self, cache, hit):
+        self.inc("inventory_cache_requests_total", (("cache", cache), ("result", "hit" if hit else "miss")))
+
+    def record_sheet_read(self, worksheet, rows):
+        self.record_refresh(worksheet, max(len(rows) - 1, 0))
+
+    def record_refresh(self, worksheet, row_count):
+        """A worksheet is known to be current with row_count data rows (full read or tail)"""
+        self.set_gauge("inventory_sheet_rows", (("worksheet", worksheet),), row_count)
+        with self.lock:
+            self.refreshed_at[worksheet] = time.time()
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+            refreshed_at = dict(self.refreshed_at)
+
+        # Derived gauges: cache hit ratios and refresh ages
+        cache_totals = {}
+        for (name, labels), value in counters.items():
+            if name == "inventory_cache_requests_total":
+                label_map = dict(labels)
+                hits, total = cache_totals.get(label_map["cache"], (0, 0))
+                if label_map["result"] == "hit":
+                    hits += value
+                cache_totals[label_map["cache"]] = (hits, total + value)
+        for cache, (hits, total) in cache_totals.items():
+            gauges[("inventory_cache_hit_ratio", (("cache", cache),))] = hits / total if total else 0.0
+        now = time.time()
+        for worksheet, ts in refreshed_at.items():
+            gauges[("inventory_sheet_last_refresh_age_seconds", (("worksheet", worksheet),))] = round(now - ts, 3)
+
+        series = {}
+        for (name, labels), value in sorted(counters.items()):
+            series.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            series.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), hist in sorted(histograms.items()):
+            lines = series.setdefault(name, [])
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {hist[i]}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {hist[len(LATENCY_BUCKETS)]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {round(hist[-1], 6)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {hist[len(LATENCY_BUCKETS)]}")
+
+        output = []
+        for name in sorted(series):
+            metric_type, help_text = METRIC_HELP.get(name, ("untyped", name))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(series[name])
+        return "\n".join(output) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+metrics = Metrics()
+
+
+class InstrumentedWorksheet:
+    """Wraps a gspread Worksheet and records call counts, latencies and row counts per worksheet"""
+
+    def __init__(self, worksheet):
+        self._ws = worksheet
+        self.name = worksheet.title
+
+    def read_versioned(self):
+        """get_all_values() plus a fingerprint of the content.
+
+        The fingerprint depends on the rows only (not on this wrapper), so it stays valid as a
+        cache key when the worksheet is wrapped again after a reconnect.
+        """
+        rows = self.get_all_values()
+        return rows, hash(tuple(map(tuple, rows)))
+
+    def spreadsheet_batch_update(self, body):
+        """Spreadsheet-level batch_update (row deletes etc.), counted under this worksheet"""
+        return self._timed("spreadsheet.batch_update", self._ws.spreadsheet.batch_update)(body)
+
+    def __getattr__(self, attr):
+        value = getattr(self._ws, attr)
+        if attr.startswith("_") or not callable(value):
+            return value
+        return self._timed(attr, value)
+
+    def _timed(self, attr, value):
+        def timed_call(*args, **kwargs):
+            labels = (("worksheet", self.name), ("method", attr))
+            profile = getattr(_profile_local, "profile", None)
+            if profile is not None:
+                profile.in_io = True
+            started = time.perf_counter()
+            try:
+                result = value(*args, **kwargs)
+            except Exception:
+                metrics.inc("inventory_sheets_call_errors_total", labels)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                metrics.inc("inventory_sheets_calls_total", labels)
+                metrics.observe("inventory_sheets_call_duration_seconds", labels, elapsed)
+                if profile is not None:
+                    profile.in_io = False
+                    profile.io_seconds += elapsed
+            if attr == "get_all_values":
+                metrics.record_sheet_read(self.name, result)
+            return result
+
+        return timed_call
+
+
+# ---------------- REQUEST PROFILING ----------------
+# Opt-in only: send "X-Profile: <PROFILE_ADMIN_TOKEN>" (or ?profile=<token>), or set
+# PROFILE_SAMPLE_RATE (0.0 - 1.0) to profile a random share of requests.
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "") or PROFILE_ADMIN_TOKEN  # destructive admin endpoints (ledger archive)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0") or 0)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5") or 5) / 1000.0
+PROFILE_CPROFILE = os.getenv("PROFILE_CPROFILE", "").lower() in ("1", "true", "yes")
+PROFILING_ENABLED = bool(PROFILE_ADMIN_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+_profile_local = threading.local()
+
+
+class RequestProfile:
+    """Samples the request thread's stack and splits wall time into Sheets I/O and CPU.
+
+    Samples are written as collapsed stacks ("frame;frame;frame count"), ready for
+    flamegraph.pl or speedscope. The second frame of every stack is "io" or "cpu".
+    """
+
+    def __init__(self, label, interval):
+        self.label = label
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = {}
+        self.in_io = False
+        self.io_seconds = 0.0
+        self.cprofile = cProfile.Profile() if PROFILE_CPROFILE else None
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.cpu_started = time.thread_time()
+        self._sampler.start()
+        if self.cprofile:
+            self.cprofile.enable()
+
+    def stop(self):
+        if self.cprofile:
+            self.cprofile.disable()
+        self.wall_seconds = time.perf_counter() - self.started
+        self.cpu_seconds = time.thread_time() - self.cpu_started
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if not stack:
+                continue
+            stack.append("io" if self.in_io else "cpu")
+            stack.append(self.label)
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def write(self, directory):
+        """Write the collapsed stacks (and the cProfile dump if enabled); returns the base path"""
+        os.makedirs(directory, exist_ok=True)
+        slug = "".join(ch if ch.isalnum() else "_" for ch in self.label).strip("_")
+        base = os.path.join(directory, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{slug}")
+        with open(base + ".collapsed", "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        if self.cprofile:
+            self.cprofile.dump_stats(base + ".prof")
+        return base
+        return base
+
 # ---------------- GOOGLE SHEETS SETUP ----------------
 scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 try:
@@ -35,26 +313,1801 @@ try:
     client = gspread.authorize(creds)
     sheet = client.open_by_key(sheet_id)
 
-    products_ws = sheet.worksheet("Products")
-    stockin_ws = sheet.worksheet("Stock In")
-    stockout_ws = sheet.worksheet("Stock Out")
-    transactions_ws = sheet.worksheet("Transactions")
+    products_ws = InstrumentedWorksheet(sheet.worksheet("Products"))
+    stockin_ws = InstrumentedWorksheet(sheet.worksheet("Stock In"))
+    stockout_ws = InstrumentedWorksheet(sheet.worksheet("Stock Out"))
+    transactions_ws = InstrumentedWorksheet(sheet.worksheet("Transactions"))
     
     # ✅ REPORTS SHEET ADD KARO
     try:
-        reports_ws = sheet.worksheet("Reports")
+        reports_ws = InstrumentedWorksheet(sheet.worksheet("Reports"))
         print("✅ Reports sheet found")
     except gspread.exceptions.WorksheetNotFound:
         # Agar Reports sheet nahi hai toh banao
-        reports_ws = sheet.add_worksheet(title="Reports", rows="1000", cols="20")
+        reports_ws = InstrumentedWorksheet(sheet.add_worksheet(title="Reports", rows="1000", cols="20"))
         # Headers set karo - WITH CATEGORIES
-        reports_ws.append_row(["Report Type", "Period", "Product ID", "Main Category", "Received", "Sold", "Remaining", "Purchase Value", "Sales Value", "Generated At", "Sub Category"])
+        reports_ws.append_row(["Report Type", "Period", "Product ID", "Main Category", "Received", "Sold", "Remaining", "Purchase Value", "Sales Value", "Generated At", "Sub Category", "Report Version"])
         print("✅ Created new Reports sheet")
 
+    # ✅ REORDER POINTS SHEET (low-stock thresholds per product)
+    try:
+        reorder_ws = InstrumentedWorksheet(sheet.worksheet("Reorder Points"))
+        print("✅ Reorder Points sheet found")
+    except gspread.exceptions.WorksheetNotFound:
+        reorder_ws = InstrumentedWorksheet(sheet.add_worksheet(title="Reorder Points", rows="1000", cols="3"))
+        reorder_ws.append_row(["Product ID", "Reorder Point", "Reorder Quantity"])
+        print("✅ Created new Reorder Points sheet")
+
     print("✅ Connected to Google Sheet:", sheet.title)
 except Exception as e:
     print("❌ Error connecting to Google Sheets:", e)
-    products_ws = stockin_ws = stockout_ws = transactions_ws = reports_ws = None
+    products_ws = stockin_ws = stockout_ws = transactions_ws = reports_ws = reorder_ws = None
+
+
+# ---------------- LOCATION HEADER MIGRATION ----------------
+# Sheets created before multi-location stock have no "Location" header. Rows work without it,
+# so the header is added lazily before the first write of a stock movement, once per process,
+# and a failure is only logged.
+_location_headers_lock = threading.Lock()
+_location_headers_checked = False
+
+
+def ensure_location_headers():
+    global _location_headers_checked
+    if _location_headers_checked:
+        return
+    with _location_headers_lock:
+        if _location_headers_checked:
+            return
+        _location_headers_checked = True
+        try:
+            for location_ws, location_column in ((transactions_ws, "H"), (stockin_ws, "G"), (stockout_ws, "G")):
+                if location_ws is None:
+                    continue
+                header = location_ws.get(f"{location_column}1")
+                if not (header and header[0] and header[0][0]):
+                    location_ws.update(f"{location_column}1", [["Location"]])
+                    print(f"✅ Added Location header to {location_ws.name}")
+        except Exception as e:
+            print("⚠️ Could not add the Location headers:", e)
+
+
+# ---------------- RESPONSE LAYER ----------------
+# Fast JSON (orjson when installed), gzip/brotli above COMPRESS_MIN_BYTES, optional
+# columnar format (?format=columnar) and a cache of serialized bodies per dataset version.
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+BODY_CACHE_SIZE = int(os.getenv("BODY_CACHE_SIZE", "32"))
+BOOT_ID = f"{os.getpid():x}{int(time.time()):x}"
+
+
+def dumps_json(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def to_columnar(records):
+    """[{"a": 1, "b": 2}, ...] -> {"columns": ["a", "b"], "rows": [[1, 2], ...]}"""
+    columns = []
+    seen = set()
+    for record in records:
+        for key in record:
+            if key not in seen:
+                seen.add(key)
+                columns.append(key)
+    return {"columns": columns, "rows": [[record.get(key) for key in columns] for record in records]}
+
+
+def _accepted_encoding():
+    accepted = {}
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.lower()] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return "identity"
+
+
+def _compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=5)
+    return body
+
+
+class BodyCache:
+    """Small LRU of serialized response bodies; compressed variants are added on first use"""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+body_cache = BodyCache(BODY_CACHE_SIZE)
+
+
+def _serialize(data):
+    if request.args.get("format") == "columnar" and isinstance(data, list):
+        data = to_columnar(data)
+    body = dumps_json(data)
+    return {"identity": body, "etag": f'"{BOOT_ID}-{zlib.crc32(body):08x}-{len(body):x}"'}
+
+
+def _etag_matches(etag):
+    """True if If-None-Match lists this ETag (weak or strong) or is "*" """
+    header = request.headers.get("If-None-Match", "")
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+
+def _send_body(entry, status=200):
+    if status == 200 and _etag_matches(entry["etag"]):
+        response = Response(status=304)
+        response.headers["ETag"] = entry["etag"]
+        return response
+    encoding = "identity"
+    if len(entry["identity"]) >= COMPRESS_MIN_BYTES:
+        encoding = _accepted_encoding()
+    body = entry.get(encoding)
+    if body is None:
+        body = entry[encoding] = _compress(entry["identity"], encoding)
+    response = Response(body, status=status, mimetype="application/json")
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["ETag"] = entry["etag"]
+    return response
+
+
+def json_response(data, status=200):
+    """Like jsonify() but faster to encode and compressed for large payloads"""
+    return _send_body(_serialize(data), status)
+
+
+def cached_json_response(cache_key, build):
+    """Serve a pre-serialized body for cache_key, calling build() only when the dataset changed.
+
+    cache_key must include the version of every sheet the response depends on.
+    """
+    key = (cache_key, request.args.get("format", ""))
+    entry = body_cache.get(key)
+    metrics.record_cache("response_body", entry is not None)
+    if entry is None:
+        entry = _serialize(build())
+        body_cache.put(key, entry)
+    return _send_body(entry)
+
+
+# ---------------- INVENTORY STATE ----------------
+# Decoded products, per-product balances and rollups kept in memory. The Transactions
+# sheet is only tailed (rows after last_row), and the state is snapshotted to disk so a
+# restart loads the snapshot and reads just the rows added since.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "snapshots/inventory.snap")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "300"))
+STATE_SYNC_INTERVAL = float(os.getenv("STATE_SYNC_INTERVAL", "5"))
+PRODUCT_REFRESH_INTERVAL = float(os.getenv("PRODUCT_REFRESH_INTERVAL", "30"))
+SNAPSHOT_MAGIC = b"INVSNAP"
+SNAPSHOT_VERSION = 4
+SNAPSHOT_HEADER = struct.Struct("<7sHI")  # magic, format version, crc32 of payload
+SYNC_LOG_SIZE = int(os.getenv("SYNC_LOG_SIZE", "50000"))                    # product changes kept for /api/sync deltas
+SYNC_TRANSACTION_ROWS = int(os.getenv("SYNC_TRANSACTION_ROWS", "200"))      # recent stock movements kept for /api/sync
+
+# Transactions sheet columns: Type, Product ID, Quantity, Price, Date, Main Category, Sub Category, Location
+TX_TYPE, TX_PRODUCT, TX_QUANTITY, TX_PRICE, TX_DATE, TX_MAIN, TX_SUB, TX_LOCATION = range(8)
+TX_LAST_COLUMN = "H"
+DEFAULT_LOCATION = os.getenv("DEFAULT_LOCATION", "Main")  # rows without a Location cell
+
+VALUATION_METHODS = ("fifo", "average")
+VALUATION_METHOD = os.getenv("VALUATION_METHOD", "fifo")
+
+
+def parse_quantity(value):
+    try:
+        return int(float(value)) if value not in ("", None) else 0
+    except (ValueError, TypeError):
+        return 0
+
+
+def parse_price(value):
+    try:
+        return float(value) if value not in ("", None) else 0.0
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def _cell(row, index):
+    return str(row[index]).strip() if len(row) > index else ""
+
+
+def _row_fingerprint(row):
+    """Columns we write verbatim (Type, Product ID, Date) - used to check the ledger was not rewritten"""
+    return [_cell(row, TX_TYPE), _cell(row, TX_PRODUCT), _cell(row, TX_DATE)]
+
+
+def _appended_rows(response):
+    """Parse the first and last row number out of an append_row(s) API response"""
+    try:
+        updated_range = response["updates"]["updatedRange"]
+    except (KeyError, TypeError):
+        return None
+    match = re.search(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?$", updated_range)
+    if not match:
+        return None
+    first = int(match.group(1))
+    return first, int(match.group(2) or first)
+
+
+def _new_location():
+    return {
+        "balances": {},         # id -> stock at this location
+        "product_totals": {},   # id -> _new_totals()
+        "monthly": {},          # "YYYY-MM" -> _new_totals()
+        "period_totals": {},    # "YYYY-MM" / "YYYY-MM-DD" -> {id -> _new_totals()}
+    }
+
+
+def _new_totals():
+    return {"received": 0, "sold": 0, "purchases": 0.0, "sales": 0.0, "cogs_fifo": 0.0, "cogs_avg": 0.0}
+
+
+class CostLayers:
+    """Per-product cost tracking for FIFO and moving-average valuation, updated one movement at a time.
+
+    Movements are applied in ledger (append) order. A row dated before one already applied - e.g. an
+    offline sale synced late with its occurredAt - is costed against layers received after it, so
+    its COGS is an approximation; `out_of_order` records that it happened for this product.
+    """
+
+    __slots__ = ("quantity", "avg_cost", "last_cost", "fifo_value", "layers", "last_date", "out_of_order")
+
+    def __init__(self, quantity=0, avg_cost=0.0, last_cost=0.0, fifo_value=0.0, layers=(), last_date="", out_of_order=False):
+        self.quantity = quantity
+        self.avg_cost = avg_cost
+        self.last_cost = last_cost
+        self.fifo_value = fifo_value
+        self.layers = deque([list(layer) for layer in layers])  # [quantity, unit cost], oldest first
+        self.last_date = last_date          # latest movement date applied so far
+        self.out_of_order = out_of_order    # a movement was applied after a later-dated one
+
+    def applied(self, date_str):
+        """Note the date of a movement about to be applied"""
+        if date_str < self.last_date:
+            self.out_of_order = True
+        else:
+            self.last_date = date_str
+
+    def receive(self, quantity, price):
+        if quantity <= 0:
+            return
+        if self.quantity <= 0:
+            self.avg_cost = price
+        else:
+            self.avg_cost = (self.quantity * self.avg_cost + quantity * price) / (self.quantity + quantity)
+        self.quantity += quantity
+        self.last_cost = price
+        self.layers.append([quantity, price])
+        self.fifo_value += quantity * price
+
+    def issue(self, quantity):
+        """Take stock out; returns (FIFO cost, moving-average cost) of the issued units"""
+        if quantity <= 0:
+            return 0.0, 0.0
+        cogs_avg = quantity * (self.avg_cost if self.quantity > 0 else self.last_cost)
+        cogs_fifo = 0.0
+        remaining = quantity
+        while remaining > 0 and self.layers:
+            layer = self.layers[0]
+            take = min(layer[0], remaining)
+            cogs_fifo += take * layer[1]
+            layer[0] -= take
+            remaining -= take
+            if layer[0] == 0:
+                self.layers.popleft()
+        self.fifo_value -= cogs_fifo
+        # Selling more than was received: cost the shortfall at the last purchase price
+        cogs_fifo += remaining * self.last_cost
+        self.quantity -= quantity
+        return cogs_fifo, cogs_avg
+
+    def inventory_value(self, method):
+        if method == "average":
+            return max(self.quantity, 0) * self.avg_cost
+        return self.fifo_value
+
+    def unit_cost(self, method):
+        if method == "average":
+            return self.avg_cost
+        on_hand = sum(layer[0] for layer in self.layers)
+        return self.fifo_value / on_hand if on_hand else self.last_cost
+
+    def to_list(self):
+        return [self.quantity, self.avg_cost, self.last_cost, self.fifo_value, list(self.layers),
+                self.last_date, self.out_of_order]
+
+
+class ProductIndex:
+    """Sorted product IDs plus category inverted lists, for catalog search and /api/categories.
+
+    Rebuilt when the Products sheet is re-read, and updated in place on product add,
+    delete and category change so category counts never need a full scan.
+    """
+
+    def __init__(self):
+        self.keys = []          # lowercased IDs, sorted
+        self.ids = []           # product IDs in the same order as keys
+        self.by_main = {}       # mainCat -> set of IDs
+        self.by_sub = {}        # (mainCat, subCat) -> set of IDs
+        self.by_sub_name = {}   # subCat -> set of IDs (sub filter without a main category)
+
+    def rebuild(self, product_rows, product_index):
+        pairs = sorted((product_id.lower(), product_id) for product_id in product_index)
+        self.keys = [key for key, _ in pairs]
+        self.ids = [product_id for _, product_id in pairs]
+        self.by_main = {}
+        self.by_sub = {}
+        self.by_sub_name = {}
+        for product_id, index in product_index.items():
+            _, main_cat, sub_cat = product_rows[index]
+            self._add_categories(product_id, main_cat, sub_cat)
+
+    def _add_categories(self, product_id, main_cat, sub_cat):
+        self.by_main.setdefault(main_cat, set()).add(product_id)
+        self.by_sub.setdefault((main_cat, sub_cat), set()).add(product_id)
+        self.by_sub_name.setdefault(sub_cat, set()).add(product_id)
+
+    def _remove_categories(self, product_id, main_cat, sub_cat):
+        for mapping, key in ((self.by_main, main_cat), (self.by_sub, (main_cat, sub_cat)), (self.by_sub_name, sub_cat)):
+            ids = mapping.get(key)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del mapping[key]
+
+    def _position(self, product_id):
+        key = product_id.lower()
+        pos = bisect_left(self.keys, key)
+        while pos < len(self.keys) and self.keys[pos] == key and self.ids[pos] < product_id:
+            pos += 1
+        return pos
+
+    def add(self, product_id, main_cat, sub_cat):
+        pos = self._position(product_id)
+        self.keys.insert(pos, product_id.lower())
+        self.ids.insert(pos, product_id)
+        self._add_categories(product_id, main_cat, sub_cat)
+
+    def remove(self, product_id, main_cat, sub_cat):
+        pos = self._position(product_id)
+        if pos < len(self.ids) and self.ids[pos] == product_id:
+            del self.keys[pos]
+            del self.ids[pos]
+        self._remove_categories(product_id, main_cat, sub_cat)
+
+    def lookup(self, code):
+        """Product ID equal to a scanned code ignoring case, or None"""
+        key = code.strip().lower()
+        pos = bisect_left(self.keys, key)
+        return self.ids[pos] if pos < len(self.keys) and self.keys[pos] == key else None
+
+    def move(self, product_id, old_main, old_sub, new_main, new_sub):
+        self._remove_categories(product_id, old_main, old_sub)
+        self._add_categories(product_id, new_main, new_sub)
+
+    def categories(self):
+        """Main -> sub category map with product counts, in the /api/categories shape"""
+        main_counts = {}
+        sub_counts = {}
+        for (main_cat, sub_cat), ids in self.by_sub.items():
+            if not main_cat:
+                continue
+            main_counts[main_cat] = main_counts.get(main_cat, 0) + len(ids)
+            subs = sub_counts.setdefault(main_cat, {})
+            if sub_cat:
+                subs[sub_cat] = len(ids)
+        return {
+            "main_categories": sorted(main_counts),
+            "sub_categories": {main_cat: sorted(subs) for main_cat, subs in sub_counts.items()},
+            "main_counts": main_counts,
+            "sub_counts": sub_counts,
+        }
+
+    def search(self, query="", match="prefix", main_cat="", sub_cat=""):
+        """Matching product IDs in ID order"""
+        query = query.strip().lower()
+        if query and match == "prefix":
+            start = bisect_left(self.keys, query)
+            end = bisect_left(self.keys, query + "\uffff")
+            ids = self.ids[start:end]
+        elif query:
+            ids = [product_id for key, product_id in zip(self.keys, self.ids) if query in key]
+        else:
+            ids = self.ids
+
+        if main_cat and sub_cat:
+            allowed = self.by_sub.get((main_cat, sub_cat), set())
+        elif main_cat:
+            allowed = self.by_main.get(main_cat, set())
+        elif sub_cat:
+            allowed = self.by_sub_name.get(sub_cat, set())
+        else:
+            return list(ids)
+
+        if len(allowed) * 8 < len(ids):
+            return sorted(allowed.intersection(ids) if ids is not self.ids else allowed, key=lambda pid: (pid.lower(), pid))
+        return [product_id for product_id in ids if product_id in allowed]
+
+
+class InventoryState:
+    """In-memory decoded inventory, kept current by tailing the Transactions sheet"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = 0                # bumps on every change; keys cached response bodies
+        self.catalog_version = 0        # bumps only on product/category changes
+        self.snapshot_version = -1
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.product_rows = []      # (id, mainCat, subCat) per Products sheet row; row number = index + 2
+            self.product_index = {}     # id -> index into product_rows (first occurrence)
+            self.index = ProductIndex()
+            self.balances = {}          # id -> current stock
+            self.product_totals = {}    # id -> _new_totals() in first-seen order
+            self.monthly = {}           # "YYYY-MM" -> _new_totals() for all products
+            self.period_totals = {}     # "YYYY-MM" / "YYYY-MM-DD" -> {id -> _new_totals()}
+            self.costs = {}             # id -> CostLayers
+            self.touched = set()        # ids with new transactions since the last drain_touched()
+            self.touch_all = True       # balances were replaced wholesale (rebuild / snapshot load)
+            self.day_versions = {}      # "YYYY-MM-DD" -> state version at which that day's totals last changed
+            self.opening_balances = {}  # id -> carried-forward balance from "opening" rows (archive not loaded)
+            self.locations = {}         # location -> _new_location(): per-location balances and rollups
+            self.archive_cutoff = None  # first live month when the local archive was ingested
+            self.ledger_cutoff = None   # first live month once anything has been archived
+            self.changes = deque(maxlen=SYNC_LOG_SIZE)          # (version, id) per product catalog/balance change
+            self.recent_rows = deque(maxlen=SYNC_TRANSACTION_ROWS)  # (version, row) of the latest in/out rows
+            self.changes_since = self.version + 1  # oldest version a client can still delta-sync from
+            self.last_row = 1           # last ingested Transactions sheet row (row 1 is the header)
+            self.last_row_fingerprint = None
+            self.loaded = False
+            self.transactions_dirty = False
+            self.products_dirty = False
+            self.transactions_synced_at = 0.0
+            self.products_synced_at = 0.0
+
+    # ----- reading -----
+    def ensure_fresh(self):
+        """Load or tail the sheets if the state is older than the sync intervals or was marked dirty"""
+        if transactions_ws is None or products_ws is None:
+            return
+        with self.lock:
+            now = time.time()
+            if not self.loaded:
+                if not self.load_snapshot():
+                    self.rebuild()
+                    return
+            if self.products_dirty or now - self.products_synced_at > PRODUCT_REFRESH_INTERVAL:
+                self._load_products()
+            if self.transactions_dirty or now - self.transactions_synced_at > STATE_SYNC_INTERVAL:
+                self._tail_transactions()
+
+    def product(self, product_id):
+        """(id, mainCat, subCat) for a product ID, or None"""
+        index = self.product_index.get(product_id)
+        return self.product_rows[index] if index is not None else None
+
+    def rebuild(self):
+        """Full read of both sheets - only needed without a usable snapshot"""
+        with self.lock:
+            started = time.perf_counter()
+            self.reset()
+            self._load_products()
+            archived = self._ingest_archive()
+            rows = transactions_ws.get_all_values()
+            for row in rows[1:]:
+                self._ingest(row)
+            self.last_row = max(len(rows), 1)
+            self.last_row_fingerprint = _row_fingerprint(rows[-1]) if rows else None
+            self.transactions_synced_at = time.time()
+            self.loaded = True
+            self.version += 1
+            print(f"🔄 Inventory state rebuilt from {len(rows) - 1 if rows else 0} transactions"
+                  f" (+{archived} archived) in {time.perf_counter() - started:.2f}s")
+
+    def _ingest_archive(self):
+        """Replay the archived months ahead of the live sheet; their "opening" rows are then skipped"""
+        manifest = load_archive_manifest()
+        if not manifest:
+            return 0
+        try:
+            months = [read_archive_month(month) for month in sorted(manifest["months"])]
+        except (OSError, ValueError, EOFError) as e:
+            print(f"⚠️ Ledger archive unreadable ({e}) - using carried-forward opening balances")
+            return 0
+        count = 0
+        for rows in months:
+            for row in rows:
+                self._ingest(row)
+            count += len(rows)
+        self.archive_cutoff = self.ledger_cutoff = manifest["cutoff"]
+        return count
+
+    def _load_products(self):
+        rows = products_ws.get_all_values()
+        product_rows = []
+        product_index = {}
+        for row in rows[1:]:
+            product_id = _cell(row, 0)
+            if product_id and product_id not in product_index:
+                product_index[product_id] = len(product_rows)
+            product_rows.append((product_id, _cell(row, 1), _cell(row, 2)))
+        self.products_dirty = False
+        self.products_synced_at = time.time()
+        if product_rows == self.product_rows:
+            return
+        previous = {pid: self.product_rows[index] for pid, index in self.product_index.items()}
+        for product_id, index in product_index.items():
+            if previous.pop(product_id, None) != product_rows[index]:
+                self._changed(product_id)
+        for product_id in previous:
+            self._changed(product_id)
+        self.product_rows = product_rows
+        self.product_index = product_index
+        self.index.rebuild(product_rows, product_index)
+        self._catalog_changed()
+
+    def _catalog_changed(self):
+        self.catalog_version += 1
+        self.version += 1
+
+    def _changed(self, product_id):
+        """Log a product for /api/sync; recorded against the version the pending change will get"""
+        self.changes.append((self.version + 1, product_id))
+
+    def changes_after(self, since):
+        """(changed product IDs, new in/out rows) after a version, or None if the log no longer reaches back"""
+        with self.lock:
+            if since < self.changes_since or (len(self.changes) == self.changes.maxlen and since < self.changes[0][0]):
+                return None
+            product_ids = set()
+            for version, product_id in reversed(self.changes):
+                if version <= since:
+                    break
+                product_ids.add(product_id)
+            return product_ids, [row for version, row in self.recent_rows if version > since]
+
+    def product_sheet_row(self, product_id):
+        """Sheet row number of a product from the index, double-checked against its ID cell"""
+        with self.lock:
+            for _ in range(2):
+                index = self.product_index.get(product_id)
+                if index is None:
+                    return None
+                row_number = index + 2
+                cell = products_ws.get(f"A{row_number}")
+                if cell and cell[0] and str(cell[0][0]).strip() == product_id:
+                    return row_number
+                print(f"⚠️ Products sheet moved under us (row {row_number}) - reloading catalog")
+                self._load_products()
+            return None
+
+    def verify_product_rows(self):
+        """Check the in-memory row order against the sheet's ID column (one read); reload if it drifted"""
+        with self.lock:
+            sheet_ids = [str(v).strip() for v in products_ws.col_values(1)[1:]]
+            memory_ids = [product_id for product_id, _, _ in self.product_rows]
+            while memory_ids and not memory_ids[-1]:
+                memory_ids.pop()
+            if sheet_ids != memory_ids:
+                print("⚠️ Products sheet changed outside the app - reloading catalog")
+                self._load_products()
+
+    def apply_product_append(self, response, rows):
+        """Add products we just appended to the catalog and index without re-reading the sheet"""
+        with self.lock:
+            appended = _appended_rows(response)
+            if not self.loaded or appended is None or appended[0] != len(self.product_rows) + 2 \
+                    or appended[1] - appended[0] + 1 != len(rows):
+                self.products_dirty = True
+                return
+            for row in rows:
+                product_id, main_cat, sub_cat = (_cell(row, i) for i in range(3))
+                if product_id and product_id not in self.product_index:
+                    self.product_index[product_id] = len(self.product_rows)
+                    self.index.add(product_id, main_cat, sub_cat)
+                    self._changed(product_id)
+                self.product_rows.append((product_id, main_cat, sub_cat))
+            self._catalog_changed()
+
+    def apply_product_delete(self, row_numbers):
+        """Drop deleted sheet rows from the catalog; later rows shift up like they do in the sheet"""
+        with self.lock:
+            removed = set()
+            for row_number in sorted(set(row_numbers), reverse=True):
+                index = row_number - 2
+                if not 0 <= index < len(self.product_rows):
+                    self.products_dirty = True
+                    return
+                product_id, main_cat, sub_cat = self.product_rows.pop(index)
+                if product_id and self.product_index.get(product_id) == index:
+                    self.index.remove(product_id, main_cat, sub_cat)
+                    removed.add(product_id)
+                    self._changed(product_id)
+            self.product_index = {}
+            for index, (product_id, main_cat, sub_cat) in enumerate(self.product_rows):
+                if product_id and product_id not in self.product_index:
+                    self.product_index[product_id] = index
+                    if product_id in removed:  # a duplicate row now represents this ID
+                        self.index.add(product_id, main_cat, sub_cat)
+            self._catalog_changed()
+
+    def apply_product_update(self, row_number, main_cat=None, sub_cat=None):
+        """Apply a category change we just wrote; None leaves that column unchanged"""
+        with self.lock:
+            index = row_number - 2
+            if not 0 <= index < len(self.product_rows):
+                self.products_dirty = True
+                return
+            product_id, old_main, old_sub = self.product_rows[index]
+            new_main = old_main if main_cat is None else str(main_cat).strip()
+            new_sub = old_sub if sub_cat is None else str(sub_cat).strip()
+            self.product_rows[index] = (product_id, new_main, new_sub)
+            if product_id and self.product_index.get(product_id) == index:
+                self.index.move(product_id, old_main, old_sub, new_main, new_sub)
+                self._changed(product_id)
+            self._catalog_changed()
+
+    def _tail_transactions(self):
+        # Re-read the last ingested row too, to make sure the ledger was not edited above it
+        rows = transactions_ws.get(f"A{self.last_row}:{TX_LAST_COLUMN}")
+        self.transactions_synced_at = time.time()
+        self.transactions_dirty = False
+        if not rows or (self.last_row_fingerprint is not None and _row_fingerprint(rows[0]) != self.last_row_fingerprint):
+            print("⚠️ Transactions sheet changed above the last ingested row - rebuilding state")
+            self.rebuild()
+            return
+        new_rows = rows[1:]
+        if new_rows:
+            for row in new_rows:
+                self._ingest(row)
+            self.last_row += len(new_rows)
+            self.last_row_fingerprint = _row_fingerprint(new_rows[-1])
+            self.version += 1
+        metrics.record_refresh(transactions_ws.name, self.last_row - 1)
+
+    # ----- writing -----
+    def _ingest(self, row):
+        product_id = _cell(row, TX_PRODUCT)
+        if not product_id:
+            return
+        trans_type = _cell(row, TX_TYPE).lower()
+        quantity = parse_quantity(_cell(row, TX_QUANTITY))
+        price = parse_price(_cell(row, TX_PRICE))
+        date_str = _cell(row, TX_DATE)
+        day = date_str[:10]
+        month = date_str[:7]
+        location = _cell(row, TX_LOCATION) or DEFAULT_LOCATION
+
+        if trans_type == "transfer":
+            # Signed quantity at one location; the matching row moves it in or out of the other one
+            site = self.location(location)
+            site["balances"][product_id] = site["balances"].get(product_id, 0) + quantity
+            return
+        if trans_type == "opening":
+            self.ledger_cutoff = max(self.ledger_cutoff or "", month)
+            if self.archive_cutoff is None:
+                self._ingest_opening(product_id, quantity, price, location)
+            return
+        if trans_type not in ("in", "out"):
+            return
+
+        self.touched.add(product_id)
+        self._changed(product_id)
+        self.recent_rows.append((self.version + 1, row))
+        costs = self.costs.get(product_id)
+        if costs is None:
+            costs = self.costs[product_id] = CostLayers()
+
+        site = self.location(location)
+        change = quantity if trans_type == "in" else -quantity
+        self.balances[product_id] = self.balances.get(product_id, 0) + change
+        site["balances"][product_id] = site["balances"].get(product_id, 0) + change
+        costs.applied(date_str)
+        if trans_type == "in":
+            costs.receive(quantity, price)
+            cogs_fifo = cogs_avg = 0.0
+        else:
+            cogs_fifo, cogs_avg = costs.issue(quantity)
+
+        self.day_versions[day] = self.version + 1
+        rollups = [self.product_totals.setdefault(product_id, _new_totals()), self.monthly.setdefault(month, _new_totals()),
+                   site["product_totals"].setdefault(product_id, _new_totals()), site["monthly"].setdefault(month, _new_totals())]
+        for period in (month, day):
+            rollups.append(self.period_totals.setdefault(period, {}).setdefault(product_id, _new_totals()))
+            rollups.append(site["period_totals"].setdefault(period, {}).setdefault(product_id, _new_totals()))
+        for totals in rollups:
+            if trans_type == "in":
+                totals["received"] += quantity
+                totals["purchases"] += quantity * price
+            else:
+                totals["sold"] += quantity
+                totals["sales"] += quantity * price
+                totals["cogs_fifo"] += cogs_fifo
+                totals["cogs_avg"] += cogs_avg
+
+    def location(self, name):
+        site = self.locations.get(name)
+        if site is None:
+            site = self.locations[name] = _new_location()
+        return site
+
+    def _ingest_opening(self, product_id, quantity, price, location):
+        """Carried-forward balance: moves stock and cost layers, but is not a purchase in any period"""
+        self.touched.add(product_id)
+        self._changed(product_id)
+        self.balances[product_id] = self.balances.get(product_id, 0) + quantity
+        site = self.location(location)
+        site["balances"][product_id] = site["balances"].get(product_id, 0) + quantity
+        self.opening_balances[product_id] = self.opening_balances.get(product_id, 0) + quantity
+        costs = self.costs.get(product_id)
+        if costs is None:
+            costs = self.costs[product_id] = CostLayers()
+        if quantity > 0:
+            costs.receive(quantity, price)
+        else:
+            costs.issue(-quantity)
+
+    def apply_transactions_append(self, response, rows):
+        """Ingest rows we just appended without re-reading, if they landed right after last_row"""
+        with self.lock:
+            appended = _appended_rows(response)
+            if not self.loaded or appended is None or appended[0] != self.last_row + 1 \
+                    or appended[1] - appended[0] + 1 != len(rows):
+                self.transactions_dirty = True
+                return
+            for row in rows:
+                self._ingest([str(v) for v in row])
+            self.last_row = appended[1]
+            self.last_row_fingerprint = _row_fingerprint([str(v) for v in rows[-1]])
+            self.version += 1
+
+    def drain_touched(self):
+        """IDs whose balance changed since the last call, or None if every product must be re-checked"""
+        with self.lock:
+            touched = None if self.touch_all else self.touched
+            self.touched = set()
+            self.touch_all = False
+            return touched
+
+    def mark_products_dirty(self):
+        with self.lock:
+            self.products_dirty = True
+
+    # ----- snapshots -----
+    def save_snapshot(self, path=SNAPSHOT_PATH):
+        with self.lock:
+            if not self.loaded or self.version == self.snapshot_version:
+                return False
+            payload = {
+                "sheet_id": sheet_id,
+                "last_row": self.last_row,
+                "last_row_fingerprint": self.last_row_fingerprint,
+                "product_rows": self.product_rows,
+                "balances": self.balances,
+                "product_totals": self.product_totals,
+                "monthly": self.monthly,
+                "period_totals": self.period_totals,
+                "costs": {product_id: costs.to_list() for product_id, costs in self.costs.items()},
+                "opening_balances": self.opening_balances,
+                "locations": self.locations,
+                "archive_cutoff": self.archive_cutoff,
+                "ledger_cutoff": self.ledger_cutoff,
+            }
+            version = self.version
+        data = zlib.compress(dumps_json(payload), 6)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, zlib.crc32(data)))
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.snapshot_version = version
+        print(f"💾 Inventory snapshot saved: row {payload['last_row']}, {len(data)} bytes")
+        return True
+
+    def load_snapshot(self, path=SNAPSHOT_PATH):
+        """Restore from disk and tail the rows added since; False if there is no usable snapshot"""
+        try:
+            with open(path, "rb") as f:
+                header = f.read(SNAPSHOT_HEADER.size)
+                data = f.read()
+        except OSError:
+            return False
+        if len(header) != SNAPSHOT_HEADER.size:
+            return False
+        magic, version, crc = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or zlib.crc32(data) != crc:
+            print("⚠️ Ignoring incompatible or corrupt inventory snapshot")
+            return False
+        payload = json.loads(zlib.decompress(data))
+        if payload.get("sheet_id") != sheet_id:
+            print("⚠️ Ignoring inventory snapshot from a different Google Sheet")
+            return False
+
+        with self.lock:
+            self.reset()
+            self.product_rows = [tuple(row) for row in payload["product_rows"]]
+            for index, (product_id, _, _) in enumerate(self.product_rows):
+                if product_id and product_id not in self.product_index:
+                    self.product_index[product_id] = index
+            self.index.rebuild(self.product_rows, self.product_index)
+            self.balances = payload["balances"]
+            self.product_totals = payload["product_totals"]
+            self.monthly = payload["monthly"]
+            self.period_totals = payload["period_totals"]
+            self.costs = {product_id: CostLayers(*values) for product_id, values in payload["costs"].items()}
+            self.opening_balances = payload["opening_balances"]
+            self.locations = payload["locations"]
+            self.archive_cutoff = payload["archive_cutoff"]
+            self.ledger_cutoff = payload["ledger_cutoff"]
+            self.last_row = payload["last_row"]
+            self.last_row_fingerprint = payload["last_row_fingerprint"]
+            self.products_synced_at = time.time()
+            self.loaded = True
+            self._catalog_changed()
+            self.snapshot_version = self.version
+            self.day_versions = {period: self.version for period in self.period_totals if len(period) == 10}
+            print(f"💾 Inventory snapshot loaded at row {self.last_row}, tailing new transactions")
+            self._load_recent_rows()
+            self._tail_transactions()
+        return True
+
+    def _load_recent_rows(self):
+        """The snapshot has no ledger rows; read the last few so /api/sync can serve recent movements"""
+        if self.last_row < 2:
+            return
+        first = max(2, self.last_row - SYNC_TRANSACTION_ROWS + 1)
+        for row in transactions_ws.get(f"A{first}:{TX_LAST_COLUMN}{self.last_row}"):
+            if _cell(row, TX_PRODUCT) and _cell(row, TX_TYPE).lower() in ("in", "out"):
+                self.recent_rows.append((self.version, row))
+
+
+inventory_state = InventoryState()
+
+
+# ---------------- LOW STOCK ALERTS ----------------
+# Reorder points live in the "Reorder Points" sheet (Product ID, Reorder Point, Reorder Quantity).
+# Products without a row fall back to DEFAULT_REORDER_POINT; leave it empty to only watch listed products.
+DEFAULT_REORDER_POINT = os.getenv("DEFAULT_REORDER_POINT", "")
+DEFAULT_REORDER_QUANTITY = int(os.getenv("DEFAULT_REORDER_QUANTITY", "0") or 0)
+ALERT_EVENT_BUFFER = int(os.getenv("ALERT_EVENT_BUFFER", "1000"))
+ALERT_STREAM_SECONDS = float(os.getenv("ALERT_STREAM_SECONDS", "25"))
+
+
+class StockAlerts:
+    """Products at or below their reorder point, re-checked only when their balance changes"""
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.thresholds = {}        # id -> (reorder point, reorder quantity)
+        self.threshold_rows = {}    # id -> Reorder Points sheet row
+        self.low = {}               # id -> {"stock": n, "since": date}
+        self.events = deque(maxlen=ALERT_EVENT_BUFFER)
+        self.last_event_id = 0
+        self.version = 0
+        self.catalog_version = None
+        self.thresholds_dirty = True
+        self.thresholds_synced_at = 0.0
+        self.baselined = False      # the first full pass records who is low without raising events
+
+    def threshold(self, product_id):
+        if product_id in self.thresholds:
+            return self.thresholds[product_id]
+        if DEFAULT_REORDER_POINT != "":
+            return parse_quantity(DEFAULT_REORDER_POINT), DEFAULT_REORDER_QUANTITY
+        return None
+
+    def _load_thresholds(self):
+        """Read the Reorder Points sheet; returns the IDs whose threshold changed"""
+        rows = reorder_ws.get_all_values() if reorder_ws is not None else []
+        thresholds = {}
+        threshold_rows = {}
+        for row_number, row in enumerate(rows[1:], start=2):
+            product_id = _cell(row, 0)
+            if product_id and _cell(row, 1) != "":
+                thresholds[product_id] = (parse_quantity(_cell(row, 1)), parse_quantity(_cell(row, 2)))
+                threshold_rows[product_id] = row_number
+        with self.lock:
+            changed = {product_id for product_id in set(thresholds) | set(self.thresholds)
+                       if thresholds.get(product_id) != self.thresholds.get(product_id)}
+            self.thresholds = thresholds
+            self.threshold_rows = threshold_rows
+            self.thresholds_dirty = False
+            self.thresholds_synced_at = time.time()
+        return changed
+
+    def refresh(self):
+        """Reload reorder points when due, then re-check the products touched since the last pass"""
+        changed = ()
+        if self.thresholds_dirty or time.time() - self.thresholds_synced_at > PRODUCT_REFRESH_INTERVAL:
+            changed = self._load_thresholds()
+        inventory_state.ensure_fresh()
+        self.evaluate(product_ids=changed)
+
+    def evaluate(self, full=False, product_ids=()):
+        """Re-check touched products (every product after a rebuild, reload or catalog change); no sheet I/O"""
+        with inventory_state.lock:
+            if not inventory_state.loaded or not self.thresholds_synced_at:
+                return
+            touched = inventory_state.drain_touched()
+            if touched is not None:
+                touched.update(product_ids)
+            if touched is None or full or self.catalog_version != inventory_state.catalog_version:
+                touched = set(inventory_state.product_index) | set(inventory_state.balances) | set(self.low)
+                self.catalog_version = inventory_state.catalog_version
+            checks = [(product_id, inventory_state.balances.get(product_id, 0), inventory_state.product(product_id))
+                      for product_id in touched]
+
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            changed = False
+            for product_id, stock, product in checks:
+                limits = self.threshold(product_id) if product else None
+                is_low = limits is not None and stock <= limits[0]
+                current = self.low.get(product_id)
+                if is_low and current is None:
+                    self.low[product_id] = {"stock": stock, "since": now}
+                    if self.baselined:
+                        self._emit("low", product_id, stock, limits, product, now)
+                    changed = True
+                elif not is_low and current is not None:
+                    del self.low[product_id]
+                    if self.baselined:
+                        self._emit("recovered", product_id, stock, limits, product, now)
+                    changed = True
+                elif is_low and current["stock"] != stock:
+                    current["stock"] = stock
+                    changed = True
+            self.baselined = True
+            if changed:
+                self.version += 1
+                self.lock.notify_all()
+
+    def _emit(self, kind, product_id, stock, limits, product, now):
+        self.last_event_id += 1
+        self.events.append({
+            "id": self.last_event_id,
+            "type": kind,
+            "productId": product_id,
+            "mainCat": product[1] if product else "",
+            "subCat": product[2] if product else "",
+            "stock": stock,
+            "reorderPoint": limits[0] if limits else None,
+            "at": now,
+        })
+        print(f"🔔 Stock {kind}: {product_id} at {stock}")
+
+    def events_since(self, last_id):
+        """(events after last_id, whether older events were already dropped from the buffer)"""
+        with self.lock:
+            events = [event for event in self.events if event["id"] > last_id]
+            missed = bool(self.events) and self.events[0]["id"] > last_id + 1
+            return events, missed
+
+    def wait_for_events(self, last_id, timeout):
+        with self.lock:
+            if self.last_event_id <= last_id:
+                self.lock.wait(timeout)
+        return self.events_since(last_id)
+
+    def set_threshold(self, product_id, reorder_point, reorder_quantity):
+        """Write a product's reorder point to the sheet (update in place or append) and apply it"""
+        row = [product_id, reorder_point, reorder_quantity]
+        row_number = self._threshold_sheet_row(product_id)
+        if row_number is not None:
+            reorder_ws.update(f"A{row_number}:C{row_number}", [row])
+        else:
+            appended = _appended_rows(reorder_ws.append_row(row))
+            row_number = appended[0] if appended else None
+        with self.lock:
+            self.thresholds[product_id] = (reorder_point, reorder_quantity)
+            if row_number is None:
+                self.thresholds_dirty = True
+            else:
+                self.threshold_rows[product_id] = row_number
+        self.evaluate(product_ids=[product_id])
+
+    def clear_threshold(self, product_id):
+        row_number = self._threshold_sheet_row(product_id)
+        if row_number is None:
+            return False
+        reorder_ws.delete_rows(row_number)
+        with self.lock:
+            self.thresholds.pop(product_id, None)
+            self.thresholds_dirty = True  # rows below shifted up
+        self.evaluate(product_ids=[product_id])
+        return True
+
+    def _threshold_sheet_row(self, product_id):
+        """Sheet row of a product's reorder point, double-checked against its ID cell"""
+        for _ in range(2):
+            row_number = self.threshold_rows.get(product_id)
+            if row_number is None:
+                return None
+            cell = reorder_ws.get(f"A{row_number}")
+            if cell and cell[0] and str(cell[0][0]).strip() == product_id:
+                return row_number
+            print(f"⚠️ Reorder Points sheet moved under us (row {row_number}) - reloading")
+            self._load_thresholds()
+        return None
+
+
+stock_alerts = StockAlerts()
+
+
+# ---------------- DEMAND FORECAST ----------------
+# Daily units sold per product over a sliding window, kept as one (products x days) array so
+# velocity and days-to-stock-out are computed for every SKU in a handful of vectorized operations.
+FORECAST_WINDOW_DAYS = int(os.getenv("FORECAST_WINDOW_DAYS", "90"))
+FORECAST_MA_DAYS = int(os.getenv("FORECAST_MA_DAYS", "28"))
+FORECAST_ALPHA = float(os.getenv("FORECAST_ALPHA", "0.3"))
+FORECAST_METHODS = ("ema", "ma")
+
+
+class DemandForecast:
+    """Per-product demand series and velocity, refreshed from the days that changed since the last pass"""
+
+    def __init__(self, window=FORECAST_WINDOW_DAYS):
+        self.lock = threading.Lock()
+        self.window = window
+        self.ids = []               # row -> product ID
+        self.rows = {}              # product ID -> row
+        self.demand = numpy.zeros((1024, window)) if numpy is not None else None
+        self.end_day = None         # date ordinal of the last column
+        self.synced_version = -1
+        self.stock = self.active = self.velocity_ma = self.velocity_ema = None
+
+    def _row(self, product_id):
+        row = self.rows.get(product_id)
+        if row is None:
+            row = self.rows[product_id] = len(self.ids)
+            self.ids.append(product_id)
+            if row >= len(self.demand):
+                grown = numpy.zeros((len(self.demand) * 2, self.window))
+                grown[:len(self.demand)] = self.demand
+                self.demand = grown
+        return row
+
+    def refresh(self):
+        inventory_state.ensure_fresh()
+        today = datetime.now().toordinal()
+        with self.lock, inventory_state.lock:
+            if self.synced_version == inventory_state.version and self.end_day == today:
+                return
+            changed = {day for day, version in inventory_state.day_versions.items() if version > self.synced_version}
+
+            # Slide the window forward; the days entering it are re-read
+            if self.end_day is not None and today != self.end_day:
+                shift = today - self.end_day
+                if 0 < shift < self.window:
+                    self.demand[:, :-shift] = self.demand[:, shift:]
+                    self.demand[:, -shift:] = 0
+                    changed.update(datetime.fromordinal(self.end_day + offset).strftime("%Y-%m-%d")
+                                   for offset in range(1, shift + 1))
+                else:
+                    self.demand[:] = 0
+                    changed = {day for day in inventory_state.day_versions}
+            self.end_day = today
+
+            first_day = today - self.window + 1
+            for day in changed:
+                try:
+                    ordinal = datetime.strptime(day, "%Y-%m-%d").toordinal()
+                except ValueError:
+                    continue
+                if not first_day <= ordinal <= today:
+                    continue
+                column = ordinal - first_day
+                self.demand[:, column] = 0
+                for product_id, totals in inventory_state.period_totals.get(day, {}).items():
+                    row = self._row(product_id)  # may grow self.demand
+                    self.demand[row, column] = totals["sold"]
+
+            for product_id in inventory_state.product_index:
+                self._row(product_id)
+            count = len(self.ids)
+            self.stock = numpy.fromiter((inventory_state.balances.get(product_id, 0) for product_id in self.ids),
+                                        dtype=float, count=count)
+            self.active = numpy.fromiter((product_id in inventory_state.product_index for product_id in self.ids),
+                                         dtype=bool, count=count)
+            self.synced_version = inventory_state.version
+
+            demand = self.demand[:count]
+            self.velocity_ma = demand[:, -min(FORECAST_MA_DAYS, self.window):].mean(axis=1)
+            # Simple exponential smoothing seeded with the first day: s = sum(w_k * x_k)
+            weights = FORECAST_ALPHA * (1 - FORECAST_ALPHA) ** numpy.arange(self.window - 1, -1, -1)
+            weights[0] = (1 - FORECAST_ALPHA) ** (self.window - 1)
+            self.velocity_ema = demand @ weights
+
+    def forecast(self, method="ema", within_days=None, product_id=None, limit=100):
+        """Products ordered by days until stock-out (soonest first); products with no demand come last"""
+        with self.lock:
+            velocity = self.velocity_ema if method == "ema" else self.velocity_ma
+            count = len(self.ids)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                days_left = numpy.where(velocity > 0, numpy.maximum(self.stock, 0) / velocity, numpy.inf)
+            mask = self.active.copy()
+            if within_days is not None:
+                mask &= days_left <= within_days
+            if product_id is not None:
+                row = self.rows.get(product_id)
+                only = numpy.zeros(count, dtype=bool)
+                if row is not None:
+                    only[row] = True
+                mask &= only
+            candidates = numpy.flatnonzero(mask)
+            order = candidates[numpy.argsort(days_left[candidates], kind="stable")][:limit]
+            sold = self.demand[order].sum(axis=1)
+            rows = [(self.ids[row], self.stock[row], sold[i], self.velocity_ma[row], self.velocity_ema[row],
+                     velocity[row], days_left[row]) for i, row in enumerate(order)]
+            matched = len(candidates)
+
+        today = datetime.now().toordinal()
+        items = []
+        for product_id, stock, sold, velocity_ma, velocity_ema, velocity, days_left in rows:
+            product = inventory_state.product(product_id)
+            finite = bool(numpy.isfinite(days_left))
+            items.append({
+                "id": product_id,
+                "mainCat": product[1] if product else "",
+                "subCat": product[2] if product else "",
+                "stock": int(stock),
+                "soldInWindow": int(sold),
+                "velocityMA": round(float(velocity_ma), 3),
+                "velocityEMA": round(float(velocity_ema), 3),
+                "daysToStockOut": round(float(days_left), 1) if finite else None,
+                "stockOutDate": datetime.fromordinal(today + int(days_left)).strftime("%Y-%m-%d")
+                if finite and days_left < 36500 else None,
+            })
+        return {"method": method, "windowDays": self.window, "matched": matched, "items": items}
+
+
+demand_forecast = DemandForecast()
+
+
+# ---------------- RECONCILIATION (TRANSACTIONS vs STOCK IN / STOCK OUT) ----------------
+# Every movement is appended to Transactions and to the Stock In / Stock Out sheet by separate calls, so
+# the two can drift. Rows are matched by (product, quantity, price, date) with a multiset hash join; only
+# rows added since the last pass are read, in ranged chunks.
+RECONCILE_CHUNK_ROWS = int(os.getenv("RECONCILE_CHUNK_ROWS", "5000"))
+RECONCILE_GRACE_SECONDS = float(os.getenv("RECONCILE_GRACE_SECONDS", "120"))
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "600"))
+STOCK_LAST_COLUMN = "G"
+MOVEMENT_TYPES = ("in", "out")
+
+
+def _stock_sheet(kind):
+    return stockin_ws if kind == "in" else stockout_ws
+
+
+def _movement_key(product_id, quantity, price, date):
+    return product_id, parse_quantity(quantity), round(parse_price(price), 2), date
+
+
+def _movement(row_number, key, main_cat, sub_cat, location):
+    product_id, quantity, price, date = key
+    return {"row": row_number, "productId": product_id, "quantity": quantity, "price": price, "date": date,
+            "mainCat": main_cat, "subCat": sub_cat, "location": location or DEFAULT_LOCATION}
+
+
+def _is_pending(movement, now):
+    """Rows this recent may simply not have reached the other sheet yet"""
+    try:
+        written = datetime.strptime(movement["date"], "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return False
+    return (now - written).total_seconds() < RECONCILE_GRACE_SECONDS
+
+
+class Reconciler:
+    """Unmatched rows of both sides per movement type, kept between incremental passes"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.cursors = {"transactions": 1, "in": 1, "out": 1}       # last scanned row (1 = header)
+            self.fingerprints = {"transactions": None, "in": None, "out": None}
+            self.unmatched_tx = {kind: {} for kind in MOVEMENT_TYPES}     # key -> [movement] only in Transactions
+            self.unmatched_sheet = {kind: {} for kind in MOVEMENT_TYPES}  # key -> [movement] only in Stock In/Out
+            self.matched = {kind: 0 for kind in MOVEMENT_TYPES}
+            self.scanned_at = None
+
+    @staticmethod
+    def _fingerprint(row):
+        return [str(value).strip() for value in row]
+
+    def _scan(self, name, worksheet, last_column, handle):
+        """Read rows after the cursor in chunks; False if the last scanned row no longer matches"""
+        start = self.cursors[name]
+        first = True
+        while True:
+            # The first row of each chunk is the last row already scanned (or the header)
+            rows = worksheet.get(f"A{start}:{last_column}{start + RECONCILE_CHUNK_ROWS}")
+            if first:
+                first = False
+                if self.fingerprints[name] is not None and \
+                        (not rows or self._fingerprint(rows[0]) != self.fingerprints[name]):
+                    return False
+            if len(rows) <= 1:
+                return True
+            for offset, row in enumerate(rows[1:], start=1):
+                handle(start + offset, row)
+            self.fingerprints[name] = self._fingerprint(rows[-1])
+            self.cursors[name] = start = start + len(rows) - 1
+            if len(rows) <= RECONCILE_CHUNK_ROWS:
+                return True
+
+    def _match(self, kind, key, movement, own, other):
+        candidates = other[kind].get(key)
+        if candidates:
+            candidates.pop(0)
+            if not candidates:
+                del other[kind][key]
+            self.matched[kind] += 1
+        else:
+            own[kind].setdefault(key, []).append(movement)
+
+    def _add_transaction(self, row_number, row):
+        kind = _cell(row, TX_TYPE).lower()
+        if kind not in MOVEMENT_TYPES or not _cell(row, TX_PRODUCT):
+            return
+        key = _movement_key(_cell(row, TX_PRODUCT), _cell(row, TX_QUANTITY), _cell(row, TX_PRICE), _cell(row, TX_DATE))
+        movement = _movement(row_number, key, _cell(row, TX_MAIN), _cell(row, TX_SUB), _cell(row, TX_LOCATION))
+        self._match(kind, key, movement, self.unmatched_tx, self.unmatched_sheet)
+
+    def _add_sheet_row(self, kind, row_number, row):
+        if not _cell(row, 0):
+            return
+        key = _movement_key(_cell(row, 0), _cell(row, 1), _cell(row, 2), _cell(row, 3))
+        cutoff = inventory_state.ledger_cutoff
+        if cutoff and _MONTH_KEY.match(key[3][:7]) and key[3][:7] < cutoff:
+            return  # archived period: its Transactions rows are no longer in the live sheet
+        movement = _movement(row_number, key, _cell(row, 4), _cell(row, 5), _cell(row, 6))
+        self._match(kind, key, movement, self.unmatched_sheet, self.unmatched_tx)
+
+    def run(self, full=False):
+        """Incremental pass over rows added since the last one (everything on the first or a full pass)"""
+        with self.lock:
+            if full:
+                self.reset()
+            started = time.perf_counter()
+            for attempt in range(2):
+                ok = self._scan("transactions", transactions_ws, TX_LAST_COLUMN, self._add_transaction)
+                for kind in MOVEMENT_TYPES:
+                    ok = ok and self._scan(kind, _stock_sheet(kind), STOCK_LAST_COLUMN,
+                                           lambda row_number, row, kind=kind: self._add_sheet_row(kind, row_number, row))
+                if ok:
+                    break
+                print("⚠️ A sheet changed above the last reconciled row - reconciling from scratch")
+                self.reset()
+            self.scanned_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"🧾 Reconciled up to rows {self.cursors} in {time.perf_counter() - started:.2f}s")
+
+    def _pairs(self, kind):
+        """(conflicts, only in Transactions, only in the stock sheet); a conflict is one product and timestamp
+        on both sides with a different quantity or price"""
+        only_tx = [movement for movements in self.unmatched_tx[kind].values() for movement in movements]
+        only_sheet = [movement for movements in self.unmatched_sheet[kind].values() for movement in movements]
+        by_moment = {}
+        for movement in only_sheet:
+            by_moment.setdefault((movement["productId"], movement["date"]), []).append(movement)
+        conflicts = []
+        missing_from_sheet = []
+        for movement in sorted(only_tx, key=lambda m: m["row"]):
+            candidates = by_moment.get((movement["productId"], movement["date"]))
+            if candidates:
+                conflicts.append((movement, candidates.pop(0)))
+            else:
+                missing_from_sheet.append(movement)
+        missing_from_tx = sorted((m for ms in by_moment.values() for m in ms), key=lambda m: m["row"])
+        return conflicts, missing_from_sheet, missing_from_tx
+
+    def report(self, limit=100):
+        now = datetime.now()
+        with self.lock:
+            sheets = {}
+            for kind in MOVEMENT_TYPES:
+                conflicts, missing_from_sheet, missing_from_tx = self._pairs(kind)
+                tx_quantity = sum(m["quantity"] for m in missing_from_sheet) + sum(tx["quantity"] for tx, _ in conflicts)
+                sheet_quantity = sum(m["quantity"] for m in missing_from_tx) + sum(s["quantity"] for _, s in conflicts)
+                tx_value = sum(m["quantity"] * m["price"] for m in missing_from_sheet) + \
+                    sum(tx["quantity"] * tx["price"] for tx, _ in conflicts)
+                sheet_value = sum(m["quantity"] * m["price"] for m in missing_from_tx) + \
+                    sum(s["quantity"] * s["price"] for _, s in conflicts)
+                sheets[kind] = {
+                    "sheet": "Stock In" if kind == "in" else "Stock Out",
+                    "matched": self.matched[kind],
+                    "conflictCount": len(conflicts),
+                    "missingFromStockSheetCount": len(missing_from_sheet),
+                    "missingFromTransactionsCount": len(missing_from_tx),
+                    # Transactions minus the stock sheet: what the dashboard/report gap is made of
+                    "quantityDifference": tx_quantity - sheet_quantity,
+                    "valueDifference": round(tx_value - sheet_value, 2),
+                    "conflicts": [{"transactions": tx, "stockSheet": sheet_row} for tx, sheet_row in conflicts[:limit]],
+                    "missingFromStockSheet": [dict(m, pending=_is_pending(m, now)) for m in missing_from_sheet[:limit]],
+                    "missingFromTransactions": [dict(m, pending=_is_pending(m, now)) for m in missing_from_tx[:limit]],
+                }
+            return {"scannedAt": self.scanned_at, "rowsScanned": dict(self.cursors), "sheets": sheets}
+
+    def repair(self, dry_run=False):
+        """Make the stock sheets agree with Transactions and add stock-sheet-only rows to Transactions.
+        One batched write per sheet; rows inside the grace period are left alone."""
+        now = datetime.now()
+        with self.lock:
+            plan = {}
+            for kind in MOVEMENT_TYPES:
+                conflicts, missing_from_sheet, missing_from_tx = self._pairs(kind)
+                plan[kind] = (
+                    [(tx, sheet_row) for tx, sheet_row in conflicts if not _is_pending(tx, now)],
+                    [m for m in missing_from_sheet if not _is_pending(m, now)],
+                    [m for m in missing_from_tx if not _is_pending(m, now)],
+                )
+            summary = {kind: {"updatedStockRows": len(plan[kind][0]), "appendedStockRows": len(plan[kind][1]),
+                              "appendedTransactions": len(plan[kind][2])} for kind in MOVEMENT_TYPES}
+            if dry_run:
+                return summary
+
+            ensure_location_headers()
+            transaction_rows = []
+            for kind in MOVEMENT_TYPES:
+                conflicts, missing_from_sheet, missing_from_tx = plan[kind]
+                worksheet = _stock_sheet(kind)
+                if conflicts:
+                    worksheet.batch_update([{
+                        "range": f"A{sheet_row['row']}:{STOCK_LAST_COLUMN}{sheet_row['row']}",
+                        "values": [[tx["productId"], tx["quantity"], tx["price"], tx["date"], tx["mainCat"], tx["subCat"],
+                                    tx["location"]]],
+                    } for tx, sheet_row in conflicts])
+                    for tx, sheet_row in conflicts:
+                        self._forget(self.unmatched_tx[kind], tx)
+                        self._forget(self.unmatched_sheet[kind], sheet_row)
+                        self.matched[kind] += 1
+                        if sheet_row["row"] == self.cursors[kind]:
+                            self.fingerprints[kind] = None
+                if missing_from_sheet:
+                    worksheet.append_rows([[m["productId"], m["quantity"], m["price"], m["date"], m["mainCat"], m["subCat"],
+                                            m["location"]] for m in missing_from_sheet])
+                for m in missing_from_tx:
+                    product = inventory_state.product(m["productId"])
+                    transaction_rows.append([kind, m["productId"], m["quantity"], m["price"], m["date"],
+                                             m["mainCat"] or (product[1] if product else ""),
+                                             m["subCat"] or (product[2] if product else ""), m["location"]])
+            if transaction_rows:
+                response = transactions_ws.append_rows(transaction_rows)
+                inventory_state.apply_transactions_append(response, transaction_rows)
+                stock_alerts.evaluate()
+            print(f"🛠️ Reconciliation repair: {summary}")
+            self.run()  # pick up the rows just appended
+            return summary
+
+    @staticmethod
+    def _forget(unmatched, movement):
+        key = (movement["productId"], movement["quantity"], movement["price"], movement["date"])
+        remaining = [m for m in unmatched.get(key, []) if m["row"] != movement["row"]]
+        if remaining:
+            unmatched[key] = remaining
+        else:
+            unmatched.pop(key, None)
+
+
+reconciler = Reconciler()
+
+
+# ---------------- BALANCE HISTORY (STOCK AS OF A PAST DATE) ----------------
+# Month-end balance checkpoints built from the monthly rollups; an as-of query starts at the previous
+# month's checkpoint and replays at most one month of the daily rollups on top of it.
+_DAY_KEY = re.compile(r"\d{4}-\d{2}-\d{2}$")
+_MONTH_KEY = re.compile(r"\d{4}-\d{2}$")
+
+
+class BalanceHistory:
+    """Sparse per-product balances at each month end, invalidated from the earliest month that changed"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.months = []            # sorted "YYYY-MM" keys with movements
+        self.days = {}              # "YYYY-MM" -> sorted "YYYY-MM-DD" keys with movements
+        self.checkpoints = {}       # "YYYY-MM" -> {id: balance at month end}, non-zero balances only
+        self.synced_version = -1
+
+    def refresh(self):
+        inventory_state.ensure_fresh()
+        with self.lock, inventory_state.lock:
+            if self.synced_version == inventory_state.version:
+                return
+            changed = [day[:7] for day, version in inventory_state.day_versions.items() if version > self.synced_version]
+            self.synced_version = inventory_state.version
+            if not changed:
+                return
+
+            period_totals = inventory_state.period_totals
+            self.months = sorted(key for key in period_totals if _MONTH_KEY.match(key))
+            self.days = {}
+            for key in sorted(key for key in period_totals if _DAY_KEY.match(key)):
+                self.days.setdefault(key[:7], []).append(key)
+
+            # Everything from the earliest changed month on is cumulative, so recompute forward from there
+            start = bisect_left(self.months, min(changed))
+            for month in [month for month in self.checkpoints if month >= min(changed)]:
+                del self.checkpoints[month]
+            previous = self.checkpoints[self.months[start - 1]] if start > 0 else dict(inventory_state.opening_balances)
+            for month in self.months[start:]:
+                balances = dict(previous)
+                for product_id, totals in period_totals[month].items():
+                    balance = balances.get(product_id, 0) + totals["received"] - totals["sold"]
+                    if balance:
+                        balances[product_id] = balance
+                    else:
+                        balances.pop(product_id, None)
+                self.checkpoints[month] = previous = balances
+
+    def as_of(self, day, product_ids=None):
+        """({id: stock} at the end of `day` ("YYYY-MM-DD", or "YYYY-MM" for month end), checkpoint used, days replayed)"""
+        month = day[:7]
+        if _MONTH_KEY.match(day):
+            day = f"{day}-31"
+        with self.lock, inventory_state.lock:
+            index = bisect_left(self.months, month)
+            checkpoint = self.months[index - 1] if index > 0 else None
+            base = self.checkpoints[checkpoint] if checkpoint else inventory_state.opening_balances
+            replay = [key for key in self.days.get(month, []) if key <= day]
+
+            if product_ids is None:
+                balances = dict(base)
+                for key in replay:
+                    for product_id, totals in inventory_state.period_totals[key].items():
+                        balances[product_id] = balances.get(product_id, 0) + totals["received"] - totals["sold"]
+            else:
+                balances = {}
+                for product_id in product_ids:
+                    balance = base.get(product_id, 0)
+                    for key in replay:
+                        totals = inventory_state.period_totals[key].get(product_id)
+                        if totals:
+                            balance += totals["received"] - totals["sold"]
+                    balances[product_id] = balance
+        return balances, checkpoint, len(replay)
+
+
+balance_history = BalanceHistory()
+
+
+# ---------------- LEDGER ARCHIVE ----------------
+# Closed months are moved out of the live Transactions sheet into gzip'd CSV files (one per month) in
+# ARCHIVE_DIR, and one "opening" row per remaining FIFO cost layer carries each product's balance forward.
+# The state replays the archive ahead of the live sheet, so reports cover both without reading old rows
+# from Sheets again. Point ARCHIVE_DIR at persistent storage: without the files, balances still come out
+# right from the opening rows but per-period history before the cutoff is gone.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_MANIFEST = "manifest.json"
+TX_HEADERS = ["Type", "Product ID", "Quantity", "Price", "Date", "Main Category", "Sub Category", "Location"]
+_archive_lock = threading.Lock()
+
+
+def _archive_path(name):
+    return os.path.join(ARCHIVE_DIR, name)
+
+
+def load_archive_manifest():
+    """{"sheet_id", "cutoff", "months": {"YYYY-MM": rows}} for this sheet, or None"""
+    try:
+        with open(_archive_path(ARCHIVE_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("sheet_id") == sheet_id else None
+
+
+def read_archive_month(month):
+    with gzip.open(_archive_path(f"transactions-{month}.csv.gz"), "rt", newline="") as f:
+        return list(csv.reader(f))[1:]
+
+
+def _write_archive_file(path, rows):
+    with gzip.open(path, "wt", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(TX_HEADERS)
+        writer.writerows(rows)
+
+
+def _sheet_cell(value):
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+def archive_transactions(cutoff, dry_run=False):
+    """Archive every Transactions row dated before `cutoff` ("YYYY-MM") and carry balances forward.
+
+    Order of writes: month files are staged as *.pending, the sheet is rewritten with one atomic
+    batch_update (delete archived rows + insert opening rows), then the files and manifest are committed.
+    """
+    with _archive_lock, inventory_state.lock:
+        inventory_state.ensure_fresh()
+        manifest = load_archive_manifest() or {"sheet_id": sheet_id, "cutoff": None, "months": {}}
+        if manifest["cutoff"] and cutoff <= manifest["cutoff"]:
+            raise ValueError(f"Already archived up to {manifest['cutoff']}")
+
+        rows = transactions_ws.get_all_values()
+        archived = {}           # month -> rows moving to the archive
+        archived_rows = []      # sheet row numbers leaving the live sheet (incl. old opening rows)
+        for row_number, row in enumerate(rows[1:], start=2):
+            month = _cell(row, TX_DATE)[:7]
+            if not _MONTH_KEY.match(month) or month >= cutoff:
+                continue
+            archived_rows.append(row_number)
+            if _cell(row, TX_TYPE).lower() != "opening":
+                archived.setdefault(month, []).append([_cell(row, i) for i in range(len(TX_HEADERS))])
+
+        # Cost layers and per-location stock as of the cutoff: the earlier archive (or the opening rows
+        # standing in for it) + rows archived now
+        layers = {}
+        sites = {}              # id -> {location: stock}
+        categories = {}
+
+        def replay(row):
+            product_id = _cell(row, TX_PRODUCT)
+            trans_type = _cell(row, TX_TYPE).lower()
+            if not product_id or trans_type not in ("in", "out", "opening", "transfer"):
+                return
+            if trans_type == "opening" and inventory_state.archive_cutoff is not None:
+                return
+            quantity = parse_quantity(_cell(row, TX_QUANTITY))
+            location = _cell(row, TX_LOCATION) or DEFAULT_LOCATION
+            site = sites.setdefault(product_id, {})
+            site[location] = site.get(location, 0) + (-quantity if trans_type == "out" else quantity)
+            if trans_type == "transfer":
+                return
+            costs = layers.setdefault(product_id, CostLayers())
+            categories[product_id] = (_cell(row, TX_MAIN), _cell(row, TX_SUB))
+            if trans_type == "in" or (trans_type == "opening" and quantity > 0):
+                costs.receive(quantity, parse_price(_cell(row, TX_PRICE)))
+            else:
+                costs.issue(abs(quantity))
+
+        if inventory_state.archive_cutoff is not None:
+            for month in sorted(manifest["months"]):
+                for row in read_archive_month(month):
+                    replay(row)
+        for row_number in archived_rows:
+            replay(rows[row_number - 1])
+
+        opening_date = f"{cutoff}-01 00:00:00"
+        opening_rows = []
+        for product_id, costs in layers.items():
+            product = inventory_state.product(product_id)
+            main_cat, sub_cat = (product[1], product[2]) if product else categories[product_id]
+
+            def opening(location, quantity, price):
+                opening_rows.append(["opening", product_id, quantity, round(price, 4), opening_date, main_cat, sub_cat, location])
+
+            # Hand the FIFO layers (oldest first) to the locations holding stock; whatever the layers
+            # cannot cover (oversold stock) is carried at the last purchase price
+            needs = [[location, stock] for location, stock in sorted(sites.get(product_id, {}).items()) if stock > 0]
+            for quantity, price in costs.layers:
+                while quantity > 0 and needs:
+                    take = min(quantity, needs[0][1])
+                    opening(needs[0][0], take, price)
+                    quantity -= take
+                    needs[0][1] -= take
+                    if not needs[0][1]:
+                        needs.pop(0)
+            for location, stock in needs:
+                opening(location, stock, costs.last_cost)
+            for location, stock in sorted(sites.get(product_id, {}).items()):
+                if stock < 0:
+                    opening(location, stock, costs.last_cost)
+
+        summary = {
+            "cutoff": cutoff,
+            "archivedRows": len(archived_rows),
+            "months": {month: len(month_rows) for month, month_rows in sorted(archived.items())},
+            "openingRows": len(opening_rows),
+            "liveRowsAfter": len(rows) - 1 - len(archived_rows) + len(opening_rows),
+        }
+        if dry_run or not archived_rows:
+            return summary
+
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        staged = {}
+        for month, month_rows in archived.items():
+            existing = read_archive_month(month) if month in manifest["months"] else []
+            path = _archive_path(f"transactions-{month}.csv.gz")
+            _write_archive_file(f"{path}.pending", existing + month_rows)
+            staged[path] = len(existing) + len(month_rows)
+
+        balances_before = {pid: balance for pid, balance in inventory_state.balances.items() if balance}
+        requests = [
+            {"deleteDimension": {"range": {"sheetId": transactions_ws.id, "dimension": "ROWS",
+                                           "startIndex": first - 1, "endIndex": last}}}
+            for first, last in _contiguous_ranges(archived_rows)
+        ]
+        if opening_rows:
+            requests.append({"insertDimension": {"range": {"sheetId": transactions_ws.id, "dimension": "ROWS",
+                                                           "startIndex": 1, "endIndex": 1 + len(opening_rows)},
+                                                 "inheritFromBefore": False}})
+            requests.append({"updateCells": {"start": {"sheetId": transactions_ws.id, "rowIndex": 1, "columnIndex": 0},
+                                             "rows": [{"values": [_sheet_cell(v) for v in row]} for row in opening_rows],
+                                             "fields": "userEnteredValue"}})
+        try:
+            transactions_ws.spreadsheet_batch_update({"requests": requests})
+        except Exception:
+            for path in staged:
+                os.remove(f"{path}.pending")
+            raise
+
+        for path in staged:
+            os.replace(f"{path}.pending", path)
+        for month in archived:
+            manifest["months"][month] = staged[_archive_path(f"transactions-{month}.csv.gz")]
+        manifest["cutoff"] = cutoff
+        manifest["archived_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        tmp_path = _archive_path(f"{ARCHIVE_MANIFEST}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, _archive_path(ARCHIVE_MANIFEST))
+
+        inventory_state.rebuild()
+        reconciler.reset()
+        balances_after = {pid: balance for pid, balance in inventory_state.balances.items() if balance}
+        summary["verified"] = balances_after == balances_before
+        if not summary["verified"]:
+            print("⚠️ Balances differ after archiving - check the archive files and opening rows")
+        print(f"📦 Archived {len(archived_rows)} transactions before {cutoff} into {len(archived)} month files")
+        return summary
+
+
+def _state_worker():
+    """Warm the state at boot, keep it tailed, snapshot and reconcile it periodically"""
+    last_snapshot = time.time()
+    last_reconcile = 0.0
+    while True:
+        try:
+            inventory_state.ensure_fresh()
+            stock_alerts.refresh()
+            if numpy is not None:
+                demand_forecast.refresh()
+            if time.time() - last_snapshot >= SNAPSHOT_INTERVAL:
+                inventory_state.save_snapshot()
+                last_snapshot = time.time()
+            if RECONCILE_INTERVAL > 0 and time.time() - last_reconcile >= RECONCILE_INTERVAL:
+                reconciler.run()
+                last_reconcile = time.time()
+        except Exception as e:
+            print("❌ Error in inventory state worker:", e)
+        time.sleep(STATE_SYNC_INTERVAL)
+
+
+def _save_snapshot_at_exit():
+    try:
+        inventory_state.save_snapshot()
+    except Exception as e:
+        print("❌ Could not save inventory snapshot:", e)
+
+
+if transactions_ws is not None and products_ws is not None:
+    threading.Thread(target=_state_worker, name="inventory-state", daemon=True).start()
+    atexit.register(_save_snapshot_at_exit)
+
+
+# ---------------- REQUEST INSTRUMENTATION ----------------
+def is_admin_request():
+    """True if the request carries "X-Admin-Token: <ADMIN_TOKEN>" (always False while ADMIN_TOKEN is unset)"""
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN and token) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def start_request_profile():
+    if not PROFILING_ENABLED:
+        return
+    token = request.headers.get("X-Profile") or request.args.get("profile")
+    is_admin = bool(PROFILE_ADMIN_TOKEN and token) and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN)
+    if not is_admin and not (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        return
+    profile = RequestProfile(f"{request.method} {request.path}", PROFILE_INTERVAL)
+    _profile_local.profile = profile
+    g.profile = profile
+    profile.start()
+
+
+@app.after_request
+def finish_request_profile(response):
+    if not PROFILING_ENABLED:
+        return response
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    _profile_local.profile = None
+    profile.stop()
+    try:
+        base = profile.write(PROFILE_DIR)
+    except OSError as e:
+        print("❌ Could not write profile:", e)
+        base = ""
+    io_ms = profile.io_seconds * 1000
+    wall_ms = profile.wall_seconds * 1000
+    response.headers["X-Profile-Wall-Ms"] = f"{wall_ms:.1f}"
+    response.headers["X-Profile-IO-Ms"] = f"{io_ms:.1f}"
+    response.headers["X-Profile-CPU-Ms"] = f"{profile.cpu_seconds * 1000:.1f}"
+    if base:
+        response.headers["X-Profile-File"] = os.path.basename(base) + ".collapsed"
+    print(f"🔬 Profiled {profile.label}: wall={wall_ms:.1f}ms io={io_ms:.1f}ms cpu={profile.cpu_seconds * 1000:.1f}ms -> {base}")
+    return response
+
+
+@app.teardown_request
+def clear_request_profile(exc):
+    if not PROFILING_ENABLED:
+        return
+    _profile_local.profile = None
+    # after_request is skipped when the request fails before it runs - stop the sampler here instead
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.stop()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get("request_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        labels = (("route", route), ("method", request.method))
+        metrics.inc("inventory_http_requests_total", labels + (("status", str(response.status_code)),))
+        metrics.observe("inventory_http_request_duration_seconds", labels, time.perf_counter() - started)
+        if response.status_code >= 500:
+            metrics.inc("inventory_http_request_errors_total", labels)
+    return response
 
 
 # ---------------- ROUTES ----------------
@@ -87,87 +2140,35 @@ def serve_module(filename):
 # ---------- DASHBOARD STATS API (FIXED) ----------
 @app.route("/api/dashboard-stats", methods=["GET"])
 def dashboard_stats():
-    """Get dashboard statistics from Google Sheets - DIRECT FROM STOCK IN/OUT SHEETS"""
+    """Get dashboard statistics - current month totals and valuation from the in-memory rollups"""
     try:
-        if products_ws is None or stockin_ws is None or stockout_ws is None:
+        if products_ws is None or transactions_ws is None:
             return jsonify({"error": "Google Sheet not loaded"}), 500
-            
-        # Get all data from sheets
-        products_data = products_ws.get_all_values()
-        stockin_data = stockin_ws.get_all_values()
-        stockout_data = stockout_ws.get_all_values()
-        
-        # Calculate totals
-        total_products = len(products_data) - 1 if len(products_data) > 1 else 0
-        
-        # Calculate monthly stock in/out - DIRECT FROM STOCK IN/OUT SHEETS
+
+        method = _valuation_method()
+        location = _location_arg()
+        cogs_key = "cogs_avg" if method == "average" else "cogs_fifo"
+        inventory_state.ensure_fresh()
+
         current_month = datetime.now().strftime("%Y-%m")
-        monthly_stock_in = 0
-        monthly_stock_out = 0
-        total_purchases = 0
-        total_sales = 0
-        
-        # Process Stock In data
-        if len(stockin_data) > 1:
-            stockin_headers = [h.strip() for h in stockin_data[0]]
-            stockin_rows = stockin_data[1:]
-            
-            for row in stockin_rows:
-                while len(row) < len(stockin_headers):
-                    row.append('')
-                
-                row_dict = {}
-                for i, header in enumerate(stockin_headers):
-                    row_dict[header] = row[i] if i < len(row) else ''
-                
-                # Get date and check if current month
-                date_str = row_dict.get("Date", "")
-                
-                # Get quantity and price
-                try:
-                    quantity = int(float(row_dict.get("Quantity", 0)))
-                    price = float(row_dict.get("Price", 0))
-                except (ValueError, TypeError):
-                    quantity = 0
-                    price = 0
-                
-                # Check if transaction is from current month
-                if current_month in date_str:
-                    monthly_stock_in += quantity
-                    total_purchases += quantity * price
-        
-        # Process Stock Out data - ✅ YAHAN SE TOTAL SALES AYEGA
-        if len(stockout_data) > 1:
-            stockout_headers = [h.strip() for h in stockout_data[0]]
-            stockout_rows = stockout_data[1:]
-            
-            for row in stockout_rows:
-                while len(row) < len(stockout_headers):
-                    row.append('')
-                
-                row_dict = {}
-                for i, header in enumerate(stockout_headers):
-                    row_dict[header] = row[i] if i < len(row) else ''
-                
-                # Get date and check if current month
-                date_str = row_dict.get("Date", "")
-                
-                # Get quantity and PRICE (YEH SELLING PRICE HAI)
-                try:
-                    quantity = int(float(row_dict.get("Quantity", 0)))
-                    # ✅ SELLING PRICE USE KARO - DIFFERENT COLUMN NAMES CHECK KARO
-                    selling_price = float(row_dict.get("Selling Price", 0) or row_dict.get("Price", 0))
-                except (ValueError, TypeError):
-                    quantity = 0
-                    selling_price = 0
-                
-                # Check if transaction is from current month
-                if current_month in date_str:
-                    monthly_stock_out += quantity
-                    total_sales += quantity * selling_price  # ✅ QUANTITY × SELLING PRICE
+        with inventory_state.lock:
+            total_products = len(inventory_state.product_index)
+            if location:
+                site = inventory_state.locations.get(location, _new_location())
+                month_totals = site["monthly"].get(current_month) or _new_totals()
+                inventory_value = sum(_inventory_value(product_id, method, site) for product_id in site["balances"])
+            else:
+                month_totals = inventory_state.monthly.get(current_month) or _new_totals()
+                inventory_value = sum(costs.inventory_value(method) for costs in inventory_state.costs.values())
+
+        monthly_stock_in = month_totals["received"]
+        monthly_stock_out = month_totals["sold"]
+        total_purchases = round(month_totals["purchases"], 2)
+        total_sales = round(month_totals["sales"], 2)  # ✅ QUANTITY × SELLING PRICE
+        cogs = round(month_totals[cogs_key], 2)
         
         # Calculate balance (profit/loss)
-        balance = total_sales - total_purchases
+        balance = round(total_sales - total_purchases, 2)
         
         print(f"📊 Dashboard Stats: Products={total_products}, StockIn={monthly_stock_in}, StockOut={monthly_stock_out}, Purchases={total_purchases}, Sales={total_sales}, Balance={balance}")
         
@@ -177,7 +2178,12 @@ def dashboard_stats():
             "monthlyStockOut": monthly_stock_out,
             "balance": balance,
             "totalPurchases": total_purchases,
-            "totalSales": total_sales  # ✅ YAHAN SE TOTAL SALES JAYEGA
+            "totalSales": total_sales,  # ✅ YAHAN SE TOTAL SALES JAYEGA
+            "cogs": cogs,
+            "grossMargin": round(total_sales - cogs, 2),
+            "inventoryValue": round(inventory_value, 2),
+            "valuationMethod": method,
+            "location": location or "all"
         })
         
     except Exception as e:
@@ -201,127 +2207,323 @@ def products():
 
     try:
         if request.method == "GET":
-            # Manual approach - get all values and map manually
-            all_data = products_ws.get_all_values()
-            
-            if len(all_data) < 2:  # Only headers or empty
-                return jsonify([])
-            
-            headers = [h.strip() for h in all_data[0]]  # Clean headers
-            rows = all_data[1:]    # Rest are data rows
-            
-            print("🔍 Headers found:", headers)
-            
-            formatted_data = []
-            
-            for row_index, row in enumerate(rows):
-                # Ensure row has same length as headers
-                while len(row) < len(headers):
-                    row.append('')
-                
-                # Create a dictionary by mapping headers to row values
-                row_dict = {}
-                for i, header in enumerate(headers):
-                    row_dict[header] = row[i] if i < len(row) else ''
-                
-                # ✅ FIXED: Map to consistent field names
-                product_data = {
-                    "id": str(row_dict.get("ID", "")).strip(),
-                    "mainCat": str(row_dict.get("Main Category", "")).strip(),
-                    "subCat": str(row_dict.get("Sub Category", "")).strip(),
-                }
-                
-                # Calculate current stock from transactions
-                current_stock = calculate_current_stock(product_data["id"])
-                product_data["quantity"] = current_stock
-                
-                formatted_data.append(product_data)
-            
-            print("📦 Final formatted products:", formatted_data)
-            return jsonify(formatted_data)
+            # Served from the in-memory inventory state (products + balances)
+            inventory_state.ensure_fresh()
+
+            def build_products():
+                with inventory_state.lock:
+                    formatted_data = [
+                        {
+                            "id": product_id,
+                            "mainCat": main_cat,
+                            "subCat": sub_cat,
+                            "quantity": inventory_state.balances.get(product_id, 0),
+                        }
+                        for product_id, main_cat, sub_cat in inventory_state.product_rows
+                        if product_id
+                    ]
+                print(f"📦 Products served from state: {len(formatted_data)}")
+                return formatted_data
+
+            return cached_json_response(("products", inventory_state.version), build_products)
 
         elif request.method == "POST":
             payload = request.json
             print("📝 Product POST received:", payload)
 
-            required = ["id", "mainCat"]
-            if not all(field in payload for field in required):
-                return jsonify({"error": "Missing required fields"}), 400
+            required = ["id", "mainCat"]
+            if not all(field in payload for field in required):
+                return jsonify({"error": "Missing required fields"}), 400
+
+            # Duplicate check against the in-memory catalog
+            inventory_state.ensure_fresh()
+            if str(payload["id"]).strip() in inventory_state.product_index:
+                return jsonify({"error": "Product ID already exists"}), 400
+
+            # ✅ FIXED: Add to Google Sheets - ONLY 3 COLUMNS
+            product_row = [
+                payload["id"],           # ID - Column 1
+                payload["mainCat"],      # Main Category - Column 2  
+                payload.get("subCat", ""), # Sub Category - Column 3
+            ]
+            response = products_ws.append_row(product_row)
+            inventory_state.apply_product_append(response, [product_row])
+
+            print("✅ Product added to Google Sheet:", payload["id"])
+            return jsonify({"message": "Product added successfully!"})
+
+        elif request.method == "DELETE":
+            pid = str(request.args.get("id", "")).strip()
+            inventory_state.ensure_fresh()
+            with inventory_state.lock:
+                row_number = inventory_state.product_sheet_row(pid)
+                if row_number is None:
+                    return jsonify({"error": "Product not found"}), 404
+                products_ws.delete_rows(row_number)
+                inventory_state.apply_product_delete([row_number])
+            print(f"🗑️ Deleted product ID: {pid}")
+            return jsonify({"message": "Product deleted successfully!"})
+
+    except Exception as e:
+        print("❌ Exception:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- BULK PRODUCT IMPORT ----------
+MAX_IMPORT_ROWS = int(os.getenv("MAX_IMPORT_ROWS", "50000"))
+IMPORT_FIELD_ALIASES = {
+    "id": ("id", "ID", "Product ID", "productId"),
+    "mainCat": ("mainCat", "Main Category", "main_category"),
+    "subCat": ("subCat", "Sub Category", "sub_category"),
+}
+
+
+def _import_records():
+    """Products to import from a JSON array, an uploaded CSV file or a text/csv body"""
+    if "file" in request.files:
+        text = request.files["file"].read().decode("utf-8-sig")
+        return list(csv.DictReader(io.StringIO(text)))
+    if request.mimetype == "text/csv":
+        return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        payload = payload.get("products")
+    return payload
+
+
+def _import_field(record, field):
+    for alias in IMPORT_FIELD_ALIASES[field]:
+        if record.get(alias) not in (None, ""):
+            return str(record[alias]).strip()
+    return ""
+
+
+@app.route("/api/products/import", methods=["POST"])
+def products_import():
+    """Bulk create products from a JSON array or CSV (columns: ID, Main Category, Sub Category).
+
+    Duplicates are checked against the in-memory catalog, every rejected row is reported,
+    and all accepted rows are written with a single append_rows call. ?dryRun=1 only validates.
+    """
+    if products_ws is None:
+        return jsonify({"error": "Google Sheet not loaded"}), 500
+    try:
+        records = _import_records()
+        if not isinstance(records, list) or not records:
+            return jsonify({"error": "Send a JSON array of products or a CSV file"}), 400
+        if len(records) > MAX_IMPORT_ROWS:
+            return jsonify({"error": f"Too many rows ({len(records)}), limit is {MAX_IMPORT_ROWS}"}), 400
+        dry_run = request.args.get("dryRun", "").lower() in ("1", "true", "yes")
+
+        inventory_state.ensure_fresh()
+        with inventory_state.lock:
+            existing_ids = inventory_state.product_index
+            seen = set()
+            accepted = []
+            errors = []
+            for row_number, record in enumerate(records, start=1):
+                if not isinstance(record, dict):
+                    errors.append({"row": row_number, "id": "", "error": "Row must be an object"})
+                    continue
+                product_id = _import_field(record, "id")
+                main_cat = _import_field(record, "mainCat")
+                if not product_id or not main_cat:
+                    errors.append({"row": row_number, "id": product_id, "error": "Missing required fields"})
+                elif product_id in existing_ids:
+                    errors.append({"row": row_number, "id": product_id, "error": "Product ID already exists"})
+                elif product_id in seen:
+                    errors.append({"row": row_number, "id": product_id, "error": "Duplicate ID in import"})
+                else:
+                    seen.add(product_id)
+                    accepted.append([product_id, main_cat, _import_field(record, "subCat")])
+
+            if accepted and not dry_run:
+                response = products_ws.append_rows(accepted)
+                inventory_state.apply_product_append(response, accepted)
+
+        print(f"📦 Product import: {len(accepted)} accepted, {len(errors)} rejected{' (dry run)' if dry_run else ''}")
+        return jsonify({
+            "message": f"{'Validated' if dry_run else 'Imported'} {len(accepted)} products",
+            "imported": 0 if dry_run else len(accepted),
+            "accepted": len(accepted),
+            "rejected": len(errors),
+            "errors": errors,
+        })
+
+    except Exception as e:
+        print("❌ Error in product import:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- BATCH PRODUCT DELETE ----------
+def _contiguous_ranges(row_numbers):
+    """[2, 3, 4, 9, 10] -> [(9, 10), (2, 4)] - descending, so each delete leaves the next rows in place"""
+    ranges = []
+    for row_number in sorted(set(row_numbers)):
+        if ranges and row_number == ranges[-1][1] + 1:
+            ranges[-1][1] = row_number
+        else:
+            ranges.append([row_number, row_number])
+    return [tuple(r) for r in reversed(ranges)]
+
+
+@app.route("/api/products/batch-delete", methods=["POST"])
+def products_batch_delete():
+    """Delete many products in one Sheets request: {"ids": ["P001", "P002", ...]}"""
+    if products_ws is None:
+        return jsonify({"error": "Google Sheet not loaded"}), 500
+    try:
+        payload = request.json or {}
+        ids = payload.get("ids")
+        if not isinstance(ids, list) or not ids:
+            return jsonify({"error": "ids must be a non-empty list"}), 400
+        ids = list(dict.fromkeys(str(pid).strip() for pid in ids))
+
+        inventory_state.ensure_fresh()
+        with inventory_state.lock:
+            # One ID-column read guards against rows shifted by edits made outside the app
+            inventory_state.verify_product_rows()
+            row_numbers = {}
+            not_found = []
+            for pid in ids:
+                index = inventory_state.product_index.get(pid)
+                if index is None:
+                    not_found.append(pid)
+                else:
+                    row_numbers[pid] = index + 2
+
+            ranges = _contiguous_ranges(row_numbers.values())
+            if ranges:
+                products_ws.spreadsheet_batch_update({"requests": [
+                    {"deleteDimension": {"range": {
+                        "sheetId": products_ws.id,
+                        "dimension": "ROWS",
+                        "startIndex": first - 1,   # 0-based, inclusive
+                        "endIndex": last,          # 0-based, exclusive
+                    }}}
+                    for first, last in ranges
+                ]})
+                inventory_state.apply_product_delete(row_numbers.values())
+
+        print(f"🗑️ Batch deleted {len(row_numbers)} products in {len(ranges)} ranges")
+        return jsonify({
+            "message": f"Deleted {len(row_numbers)} products",
+            "deleted": list(row_numbers),
+            "notFound": not_found,
+        })
+
+    except Exception as e:
+        print("❌ Error in batch delete:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- PRODUCT SEARCH (SERVER-SIDE, PAGINATED) ----------
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+
+
+def _encode_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+
+
+def _keyset_start(ids, after, descending):
+    """Index of the first ID that comes after `after` in an ID-sorted (or reversed) list"""
+    target = (after.lower(), after)
+    lo, hi = 0, len(ids)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        key = (ids[mid].lower(), ids[mid])
+        if (key < target) if descending else (key > target):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+@app.route("/api/products/search", methods=["GET"])
+def products_search():
+    """Search the catalog by ID prefix/substring and category, sorted and paginated.
+
+    Query params: q, match (prefix|substring), mainCat, subCat,
+    sort (id|-id|quantity|-quantity), limit, cursor (from nextCursor)
+    """
+    if products_ws is None:
+        return jsonify({"error": "Google Sheet not loaded"}), 500
+    try:
+        query = request.args.get("q", "")
+        match = request.args.get("match", "prefix")
+        main_cat = request.args.get("mainCat", "").strip()
+        sub_cat = request.args.get("subCat", "").strip()
+        sort = request.args.get("sort", "id")
+        if match not in ("prefix", "substring"):
+            return jsonify({"error": "match must be prefix or substring"}), 400
+        if sort not in ("id", "-id", "quantity", "-quantity"):
+            return jsonify({"error": "sort must be id, -id, quantity or -quantity"}), 400
+        try:
+            limit = min(max(int(request.args.get("limit", SEARCH_DEFAULT_LIMIT)), 1), SEARCH_MAX_LIMIT)
+        except ValueError:
+            return jsonify({"error": "limit must be a number"}), 400
+        cursor = _decode_cursor(request.args["cursor"]) if request.args.get("cursor") else {}
+        if cursor is None:
+            return jsonify({"error": "Invalid cursor"}), 400
 
-            # Get all existing IDs
-            all_values = products_ws.get_all_values()
-            all_ids = [row[0] for row in all_values[1:]] if len(all_values) > 1 else []
-            
-            if payload["id"] in all_ids:
-                return jsonify({"error": "Product ID already exists"}), 400
+        inventory_state.ensure_fresh()
+        with inventory_state.lock:
+            ids = inventory_state.index.search(query, match, main_cat, sub_cat)
+            balances = inventory_state.balances
+            total = len(ids)
 
-            # ✅ FIXED: Add to Google Sheets - ONLY 3 COLUMNS
-            products_ws.append_row([
-                payload["id"],           # ID - Column 1
-                payload["mainCat"],      # Main Category - Column 2  
-                payload.get("subCat", ""), # Sub Category - Column 3
-            ])
+            if sort in ("id", "-id"):
+                descending = sort == "-id"
+                if descending:
+                    ids.reverse()
+                start = _keyset_start(ids, cursor["after"], descending) if "after" in cursor else 0
+                page = ids[start:start + limit]
+                has_more = start + limit < len(ids)
+                next_cursor = _encode_cursor({"after": page[-1]}) if has_more and page else None
+            else:
+                ids.sort(key=lambda pid: balances.get(pid, 0), reverse=sort == "-quantity")
+                start = int(cursor.get("offset", 0))
+                page = ids[start:start + limit]
+                has_more = start + limit < len(ids)
+                next_cursor = _encode_cursor({"offset": start + limit}) if has_more else None
 
-            print("✅ Product added to Google Sheet:", payload["id"])
-            return jsonify({"message": "Product added successfully!"})
+            items = []
+            for product_id in page:
+                _, product_main, product_sub = inventory_state.product(product_id)
+                items.append({
+                    "id": product_id,
+                    "mainCat": product_main,
+                    "subCat": product_sub,
+                    "quantity": balances.get(product_id, 0),
+                })
 
-        elif request.method == "DELETE":
-            pid = request.args.get("id")
-            rows = products_ws.get_all_values()
-            for i, row in enumerate(rows):
-                if len(row) > 0 and row[0] == pid:
-                    products_ws.delete_rows(i + 1)
-                    print(f"🗑️ Deleted product ID: {pid}")
-                    return jsonify({"message": "Product deleted successfully!"})
-            return jsonify({"error": "Product not found"}), 404
+        return json_response({"items": items, "total": total, "limit": limit, "nextCursor": next_cursor})
 
     except Exception as e:
-        print("❌ Exception:", e)
+        print("❌ Error in product search:", e)
         return jsonify({"error": str(e)}), 500
 
 
 # ---------- CALCULATE CURRENT STOCK FROM TRANSACTIONS ----------
-def calculate_current_stock(product_id):
-    """Calculate current stock from transactions"""
+def calculate_current_stock(product_id, location=None):
+    """Current stock from the in-memory balances (kept in sync with the Transactions sheet)"""
     try:
         if transactions_ws is None:
             return 0
-            
-        all_transactions = transactions_ws.get_all_values()
-        if len(all_transactions) < 2:
-            return 0
-            
-        headers = [h.strip() for h in all_transactions[0]]
-        rows = all_transactions[1:]
-        
-        total_stock = 0
-        
-        for row in rows:
-            while len(row) < len(headers):
-                row.append('')
-            
-            row_dict = {}
-            for i, header in enumerate(headers):
-                row_dict[header] = row[i] if i < len(row) else ''
-            
-            # Check if this transaction is for our product
-            trans_product_id = str(row_dict.get("Product ID", "")).strip()
-            if trans_product_id == str(product_id):
-                trans_type = str(row_dict.get("Type", "")).strip().lower()
-                trans_quantity = 0
-                
-                try:
-                    trans_quantity = int(float(row_dict.get("Quantity", 0)))
-                except (ValueError, TypeError):
-                    trans_quantity = 0
-                
-                if trans_type == "in":
-                    total_stock += trans_quantity
-                elif trans_type == "out":
-                    total_stock -= trans_quantity
-        
-        print(f"📊 Calculated stock for {product_id}: {total_stock}")
-        return total_stock
+
+        inventory_state.ensure_fresh()
+        if location:
+            site = inventory_state.locations.get(location)
+            return site["balances"].get(str(product_id).strip(), 0) if site else 0
+        return inventory_state.balances.get(str(product_id).strip(), 0)
         
     except Exception as e:
         print(f"❌ Error calculating stock: {e}")
@@ -333,6 +2535,7 @@ def calculate_current_stock(product_id):
 def stock_in():
     if stockin_ws is None or transactions_ws is None:
         return jsonify({"error": "Google Sheet not loaded"}), 500
+    claimed = None
     try:
         payload = request.json
         print("📥 Stock In payload:", payload)
@@ -340,63 +2543,64 @@ def stock_in():
         required = ["productId", "quantity", "price"]
         if not all(field in payload for field in required):
             return jsonify({"error": "Missing required stock fields"}), 400
+        client_id = str(payload.get("clientId") or "").strip()
 
         # Find product details for categories
-        all_data = products_ws.get_all_values()
-        if len(all_data) < 2:
-            return jsonify({"error": "No products found"}), 404
-            
-        headers = [h.strip() for h in all_data[0]]
-        rows = all_data[1:]
-        
-        product_details = None
-        for row in rows:
-            while len(row) < len(headers):
-                row.append('')
-            
-            row_dict = {}
-            for i, header in enumerate(headers):
-                row_dict[header] = row[i] if i < len(row) else ''
-            
-            product_id = str(row_dict.get("ID", "")).strip()
-            if product_id == str(payload["productId"]):
-                product_details = row_dict
-                break
+        inventory_state.ensure_fresh()
+        product_details = inventory_state.product(str(payload["productId"]).strip())
         
         if not product_details:
             return jsonify({"error": "Product not found"}), 404
 
-        date_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        main_category = product_details.get("Main Category", "")
-        sub_category = product_details.get("Sub Category", "")
+        # Movements queued offline carry the time they happened, not the time they were sent
+        date_str, date_error = movement_date(payload)
+        if date_error:
+            return jsonify({"error": date_error}), 400
+
+        # Offline clients resend queued movements with the same clientId - book each one once
+        if client_id and not movement_receipts.claim(client_id):
+            print(f"↩️ Stock In {client_id} already recorded")
+            return jsonify({"message": "Stock In already recorded", "duplicate": True})
+        claimed = client_id
+
+        _, main_category, sub_category = product_details
+        location = str(payload.get("location") or "").strip() or DEFAULT_LOCATION
         
         print(f"📥 Stock In - Product: {payload['productId']}, MainCat: {main_category}, SubCat: {sub_category}")
         
         # ✅ STOCK IN SHEET - CORRECT COLUMN ORDER
+        ensure_location_headers()
         stockin_ws.append_row([
             payload["productId"],        # Product ID
             payload["quantity"],         # Quantity
             payload["price"],            # Price
             date_str,                    # Date
             main_category,               # Main Category
-            sub_category                 # Sub Category
+            sub_category,                # Sub Category
+            location                     # Location
         ])
         
         # ✅ TRANSACTIONS SHEET (MAIN DATABASE) - CORRECT COLUMN ORDER
-        transactions_ws.append_row([
+        transaction_row = [
             "in",                        # Type
             payload["productId"],        # Product ID
             payload["quantity"],         # Quantity
             payload["price"],            # Price
             date_str,                    # Date
             main_category,               # Main Category
-            sub_category                 # Sub Category
-        ])
+            sub_category,                # Sub Category
+            location                     # Location
+        ]
+        response = transactions_ws.append_row(transaction_row)
+        inventory_state.apply_transactions_append(response, [transaction_row])
+        stock_alerts.evaluate()
         
         print("✅ Stock In recorded successfully in both sheets!")
         return jsonify({"message": "Stock In recorded successfully!"})
             
     except Exception as e:
+        if claimed:
+            movement_receipts.release(claimed)
         print("❌ Error in /api/stockin:", e)
         return jsonify({"error": str(e)}), 500
 
@@ -406,6 +2610,7 @@ def stock_in():
 def stock_out():
     if stockout_ws is None or transactions_ws is None:
         return jsonify({"error": "Google Sheet not loaded"}), 500
+    claimed = None
     try:
         payload = request.json
         print("📤 Stock Out payload:", payload)
@@ -413,238 +2618,1436 @@ def stock_out():
         required = ["productId", "quantity", "price"]
         if not all(field in payload for field in required):
             return jsonify({"error": "Missing required stock fields"}), 400
+        client_id = str(payload.get("clientId") or "").strip()
 
-        # Check available stock from transactions
-        current_stock = calculate_current_stock(payload["productId"])
+        # Check available stock from transactions (at the location the stock leaves from)
+        location = str(payload.get("location") or "").strip() or DEFAULT_LOCATION
+        current_stock = calculate_current_stock(payload["productId"], location)
         
         if current_stock < int(payload["quantity"]):
             return jsonify({"error": f"Not enough stock available! Current: {current_stock}, Required: {payload['quantity']}"}), 400
 
         # Get product details for categories
-        all_data = products_ws.get_all_values()
-        if len(all_data) < 2:
-            return jsonify({"error": "No products found"}), 404
-            
-        headers = [h.strip() for h in all_data[0]]
-        rows = all_data[1:]
-        
-        product_details = None
-        for row in rows:
-            while len(row) < len(headers):
-                row.append('')
-            
-            row_dict = {}
-            for i, header in enumerate(headers):
-                row_dict[header] = row[i] if i < len(row) else ''
-            
-            product_id = str(row_dict.get("ID", "")).strip()
-            if product_id == str(payload["productId"]):
-                product_details = row_dict
-                break
+        inventory_state.ensure_fresh()
+        product_details = inventory_state.product(str(payload["productId"]).strip())
         
         if not product_details:
             return jsonify({"error": "Product not found"}), 404
 
-        date_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        main_category = product_details.get("Main Category", "")
-        sub_category = product_details.get("Sub Category", "")
+        # Movements queued offline carry the time they happened, not the time they were sent
+        date_str, date_error = movement_date(payload)
+        if date_error:
+            return jsonify({"error": date_error}), 400
+
+        # Offline clients resend queued movements with the same clientId - book each one once
+        if client_id and not movement_receipts.claim(client_id):
+            print(f"↩️ Stock Out {client_id} already recorded")
+            return jsonify({"message": "Stock Out already recorded", "duplicate": True})
+        claimed = client_id
+
+        _, main_category, sub_category = product_details
         
         print(f"📤 Stock Out - Product: {payload['productId']}, MainCat: {main_category}, SubCat: {sub_category}")
         
         # ✅ STOCK OUT SHEET - CORRECT COLUMN ORDER
+        ensure_location_headers()
         stockout_ws.append_row([
             payload["productId"],        # Product ID
             payload["quantity"],         # Quantity
             payload["price"],            # Selling Price
             date_str,                    # Date
             main_category,               # Main Category
-            sub_category                 # Sub Category
+            sub_category,                # Sub Category
+            location                     # Location
         ])
         
         # ✅ TRANSACTIONS SHEET (MAIN DATABASE) - CORRECT COLUMN ORDER
-        transactions_ws.append_row([
+        transaction_row = [
             "out",                       # Type
             payload["productId"],        # Product ID
             payload["quantity"],         # Quantity
             payload["price"],            # Price
             date_str,                    # Date
             main_category,               # Main Category
-            sub_category                 # Sub Category
-        ])
+            sub_category,                # Sub Category
+            location                     # Location
+        ]
+        response = transactions_ws.append_row(transaction_row)
+        inventory_state.apply_transactions_append(response, [transaction_row])
+        stock_alerts.evaluate()
         
         print("✅ Stock Out recorded successfully in both sheets!")
         return jsonify({"message": "Stock Out recorded successfully!"})
             
     except Exception as e:
+        if claimed:
+            movement_receipts.release(claimed)
         print("❌ Error in /api/stockout:", e)
         return jsonify({"error": str(e)}), 500
 
 
+# ---------- STOCK TRANSFER BETWEEN LOCATIONS ----------
+@app.route("/api/transfer", methods=["POST"])
+def stock_transfer():
+    """Move stock between locations: {"productId", "quantity", "from", "to"} - two Transactions rows, one append"""
+    if transactions_ws is None:
+        return jsonify({"error": "Google Sheet not loaded"}), 500
+    try:
+        payload = request.json or {}
+        print("🔁 Transfer payload:", payload)
+
+        required = ["productId", "quantity", "from", "to"]
+        if not all(payload.get(field) not in (None, "") for field in required):
+            return jsonify({"error": "Missing required transfer fields"}), 400
+        product_id = str(payload["productId"]).strip()
+        source = str(payload["from"]).strip()
+        destination = str(payload["to"]).strip()
+        try:
+            quantity = int(payload["quantity"])
+        except (TypeError, ValueError):
+            return jsonify({"error": "quantity must be a whole number"}), 400
+        if quantity <= 0 or source == destination:
+            return jsonify({"error": "quantity must be positive and the locations must differ"}), 400
+
+        inventory_state.ensure_fresh()
+        product_details = inventory_state.product(product_id)
+        if not product_details:
+            return jsonify({"error": "Product not found"}), 404
+        available = calculate_current_stock(product_id, source)
+        if available < quantity:
+            return jsonify({"error": f"Not enough stock at {source}! Current: {available}, Required: {quantity}"}), 400
+
+        date_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        _, main_category, sub_category = product_details
+        costs = inventory_state.costs.get(product_id)
+        unit_cost = round(costs.unit_cost(VALUATION_METHOD), 4) if costs else 0
+        transfer_rows = [
+            ["transfer", product_id, -quantity, unit_cost, date_str, main_category, sub_category, source],
+            ["transfer", product_id, quantity, unit_cost, date_str, main_category, sub_category, destination],
+        ]
+        ensure_location_headers()
+        response = transactions_ws.append_rows(transfer_rows)
+        inventory_state.apply_transactions_append(response, transfer_rows)
+
+        print(f"✅ Transferred {quantity} × {product_id} from {source} to {destination}")
+        return jsonify({"message": "Transfer recorded successfully!"})
+
+    except Exception as e:
+        print("❌ Error in /api/transfer:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/locations", methods=["GET"])
+def locations():
+    """Every location with its stocked product count, units on hand and inventory value (?id= for one product)"""
+    try:
+        if transactions_ws is None:
+            return jsonify({"error": "Google Sheet not loaded"}), 500
+
+        method = _valuation_method()
+        product_id = request.args.get("id", "").strip()
+        inventory_state.ensure_fresh()
+
+        def build_locations():
+            result = []
+            with inventory_state.lock:
+                for name in sorted(inventory_state.locations):
+                    site = inventory_state.locations[name]
+                    if product_id:
+                        result.append({"location": name, "stock": site["balances"].get(product_id, 0)})
+                        continue
+                    result.append({
+                        "location": name,
+                        "products": sum(1 for stock in site["balances"].values() if stock),
+                        "units": sum(site["balances"].values()),
+                        "inventoryValue": round(sum(_inventory_value(pid, method, site) for pid in site["balances"]), 2),
+                    })
+            return {"default": DEFAULT_LOCATION, "locations": result}
+
+        return cached_json_response(("locations", method, product_id, inventory_state.version), build_locations)
+
+    except Exception as e:
+        print("❌ Error in locations:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- BARCODE SCAN SESSIONS ----------
+# A scanner opens a session, posts one request per scan (checked against the in-memory
+# catalog and balances only, no sheet access) and commits. Repeated scans of a SKU add
+# up to one line, and the commit writes the whole session with one append per sheet.
+SCAN_SESSION_TTL = float(os.getenv("SCAN_SESSION_TTL", "3600"))  # idle seconds before a session is dropped
+SCAN_MAX_BATCH = int(os.getenv("SCAN_MAX_BATCH", "500"))         # scans per request from buffering scanners
+
+
+class ScanSessions:
+    """Open scan sessions: aggregated lines per product, committed once as a batched write"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def open(self, kind, location, price):
+        now = time.time()
+        session = {
+            "id": base64.urlsafe_b64encode(os.urandom(9)).decode(),
+            "type": kind,
+            "location": location,
+            "price": price,
+            "lines": {},            # product id -> {"quantity", "price"} in first-scan order
+            "scan_ids": set(),      # client scan IDs already counted (a resent scan is not counted twice)
+            "scans": 0,
+            "status": "open",       # open -> committing -> committed, or partial (Stock In/Out written) -> committing
+            "written": None,        # (lines, transaction_rows) once Stock In/Out is written; a retry appends exactly these
+            "result": None,
+            "touched_at": now,
+        }
+        with self.lock:
+            # A partial session still owes its Transactions rows, so it stays until a commit finishes it
+            for session_id in [sid for sid, s in self.sessions.items()
+                               if now - s["touched_at"] > SCAN_SESSION_TTL and s["status"] != "partial"]:
+                del self.sessions[session_id]
+            self.sessions[session["id"]] = session
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session["touched_at"] = time.time()
+            return session
+
+    def discard(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None or session["status"] in ("committing", "partial"):
+                return False
+            del self.sessions[session_id]
+            return True
+
+    def scan(self, session, scan):
+        """Count one scan {"code", "quantity"=1, "price", "scanId"}; (ack, HTTP status)"""
+        code = str(scan.get("code") or scan.get("barcode") or scan.get("productId") or "").strip()
+        if not code:
+            return {"error": "code is required"}, 400
+        try:
+            quantity = int(scan.get("quantity", 1))
+        except (TypeError, ValueError):
+            return {"error": "quantity must be a whole number", "code": code}, 400
+        product_id = code if code in inventory_state.product_index else inventory_state.index.lookup(code)
+        if product_id is None:
+            with inventory_state.lock:  # waits out a catalog reload before calling it unknown
+                product_id = code if code in inventory_state.product_index else inventory_state.index.lookup(code)
+        if product_id is None:
+            return {"error": "Unknown product", "code": code}, 404
+
+        with self.lock:
+            if session["status"] != "open":
+                return {"error": f"Session is {session['status']}", "code": code}, 409
+            scan_id = str(scan.get("scanId") or "")
+            line = session["lines"].get(product_id) or {"quantity": 0, "price": session["price"]}
+            if scan_id and scan_id in session["scan_ids"]:
+                return {"productId": product_id, "quantity": line["quantity"], "scans": session["scans"], "duplicate": True}, 200
+            total = line["quantity"] + quantity
+            if total < 0:
+                return {"error": "Cannot remove more than was scanned", "productId": product_id}, 400
+            if session["type"] == "out":
+                site = inventory_state.locations.get(session["location"])
+                available = site["balances"].get(product_id, 0) if site else 0
+                if total > available:
+                    return {"error": f"Not enough stock! Current: {available}, Scanned: {total}",
+                            "productId": product_id}, 409
+            price = scan.get("price")
+            if price not in (None, ""):
+                line["price"] = price
+            if line["price"] in (None, ""):
+                return {"error": "price is required (per scan or for the session)", "productId": product_id}, 400
+            if total:
+                line["quantity"] = total
+                session["lines"][product_id] = line
+            else:
+                session["lines"].pop(product_id, None)
+            if scan_id:
+                session["scan_ids"].add(scan_id)
+            session["scans"] += 1
+            return {"productId": product_id, "quantity": total, "scans": session["scans"]}, 200
+
+    def commit(self, session):
+        """Write every line with one append to Stock In/Out and one to Transactions; (result, HTTP status)"""
+        with self.lock:
+            if session["status"] == "committed":
+                return session["result"], 200
+            if session["status"] == "committing":
+                return {"error": "Commit already in progress"}, 409
+            if not session["lines"] and session["written"] is None:
+                return {"error": "Nothing scanned"}, 400
+            session["status"] = "committing"
+            written = session["written"]
+            lines = [(product_id, dict(line)) for product_id, line in session["lines"].items()]
+
+        try:
+            inventory_state.ensure_fresh()
+            location = session["location"]
+            if written is not None:
+                # Stock In/Out already has these rows - finish with the same rows, same date
+                lines, transaction_rows = written
+            elif session["type"] == "out":
+                with inventory_state.lock:
+                    balances = inventory_state.locations.get(location, {}).get("balances", {})
+                    shortages = [{"productId": product_id, "stock": balances.get(product_id, 0), "quantity": line["quantity"]}
+                                 for product_id, line in lines if balances.get(product_id, 0) < line["quantity"]]
+                if shortages:
+                    with self.lock:
+                        session["status"] = "open"
+                    return {"error": "Not enough stock for some scanned products", "shortages": shortages}, 409
+
+            if written is None:
+                date_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                stock_rows = []
+                transaction_rows = []
+                for product_id, line in lines:
+                    product = inventory_state.product(product_id)
+                    _, main_category, sub_category = product if product else (product_id, "", "")
+                    stock_rows.append([product_id, line["quantity"], line["price"], date_str,
+                                       main_category, sub_category, location])
+                    transaction_rows.append([session["type"], product_id, line["quantity"], line["price"], date_str,
+                                             main_category, sub_category, location])
+                ensure_location_headers()
+                (stockin_ws if session["type"] == "in" else stockout_ws).append_rows(stock_rows)
+                with self.lock:
+                    session["written"] = (lines, transaction_rows)
+            response = transactions_ws.append_rows(transaction_rows)
+            inventory_state.apply_transactions_append(response, transaction_rows)
+            stock_alerts.evaluate()
+        except Exception:
+            with self.lock:
+                # After the Stock In/Out append no more scans are taken; only a retried commit can finish it
+                session["status"] = "open" if session["written"] is None else "partial"
+            raise
+
+        result = {
+            "message": f"{len(lines)} products ({sum(line['quantity'] for _, line in lines)} units) recorded",
+            "sessionId": session["id"],
+            "lines": len(lines),
+            "units": sum(line["quantity"] for _, line in lines),
+        }
+        with self.lock:
+            session["result"] = result
+            session["status"] = "committed"
+        return result, 200
+
+
+scan_sessions = ScanSessions()
+
+
+def _scan_session_summary(session):
+    with scan_sessions.lock:
+        lines = [{"productId": product_id, "quantity": line["quantity"], "price": line["price"]}
+                 for product_id, line in session["lines"].items()]
+        return {
+            "sessionId": session["id"],
+            "type": session["type"],
+            "location": session["location"],
+            "status": session["status"],
+            "scans": session["scans"],
+            "units": sum(line["quantity"] for line in lines),
+            "lines": lines,
+        }
+
+
+@app.route("/api/scan-sessions", methods=["POST"])
+def scan_session_open():
+    """Start a scan session: {"type": "in"|"out", "location", "price" (default for every scan)}"""
+    if stockin_ws is None or stockout_ws is None or transactions_ws is None:
+        return jsonify({"error": "Google Sheet not loaded"}), 500
+    try:
+        payload = request.json or {}
+        kind = str(payload.get("type", "")).lower()
+        if kind not in MOVEMENT_TYPES:
+            return jsonify({"error": "type must be in or out"}), 400
+        location = str(payload.get("location") or "").strip() or DEFAULT_LOCATION
+        if not inventory_state.loaded:
+            inventory_state.ensure_fresh()
+        session = scan_sessions.open(kind, location, payload.get("price"))
+        print(f"📷 Scan session {session['id']} opened: stock {kind} at {location}")
+        return jsonify(_scan_session_summary(session))
+
+    except Exception as e:
+        print("❌ Error opening scan session:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/scan-sessions/<session_id>", methods=["GET", "DELETE"])
+def scan_session(session_id):
+    try:
+        session = scan_sessions.get(session_id)
+        if session is None:
+            return jsonify({"error": "Scan session not found or expired"}), 404
+        if request.method == "DELETE":
+            if not scan_sessions.discard(session_id):
+                return jsonify({"error": f"Session is {session['status']} and cannot be discarded"}), 409
+            print(f"🗑️ Scan session {session_id} discarded")
+            return jsonify({"message": "Scan session discarded"})
+        return json_response(_scan_session_summary(session))
+
+    except Exception as e:
+        print("❌ Error in scan session:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/scan-sessions/<session_id>/scans", methods=["POST"])
+def scan_session_scan(session_id):
+    """One scan {"code", "quantity", "price", "scanId"}, or {"scans": [...]} from a buffering scanner"""
+    try:
+        session = scan_sessions.get(session_id)
+        if session is None:
+            return jsonify({"error": "Scan session not found or expired"}), 404
+        if not inventory_state.loaded:
+            inventory_state.ensure_fresh()
+        payload = request.get_json(silent=True) or {}
+        if "scans" not in payload:
+            ack, status = scan_sessions.scan(session, payload)
+            return json_response(ack, status)
+        scans = payload["scans"]
+        if not isinstance(scans, list) or len(scans) > SCAN_MAX_BATCH:
+            return jsonify({"error": f"scans must be a list of at most {SCAN_MAX_BATCH} scans"}), 400
+        results = []
+        for scan in scans:
+            ack, status = scan_sessions.scan(session, scan if isinstance(scan, dict) else {"code": scan})
+            ack["status"] = status
+            results.append(ack)
+        return json_response({"results": results, "scans": session["scans"]})
+
+    except Exception as e:
+        print("❌ Error recording scan:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/scan-sessions/<session_id>/commit", methods=["POST"])
+def scan_session_commit(session_id):
+    """Record the session; committing again returns the same result instead of writing twice"""
+    try:
+        session = scan_sessions.get(session_id)
+        if session is None:
+            return jsonify({"error": "Scan session not found or expired"}), 404
+        result, status = scan_sessions.commit(session)
+        if status == 200:
+            print(f"✅ Scan session {session_id} committed: {result['message']}")
+        return jsonify(result), status
+
+    except Exception as e:
+        print("❌ Error committing scan session:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- DELTA SYNC (OFFLINE-CAPABLE PAGES) ----------
+# Pages keep products and recent movements in IndexedDB and ask only for what changed
+# since their token ("<boot id>.<state version>"). A token from another process, or one
+# older than the change log, gets a full sync instead.
+SYNC_RECEIPTS = int(os.getenv("SYNC_RECEIPTS", "10000"))
+SYNC_CLOCK_SKEW = int(os.getenv("SYNC_CLOCK_SKEW", "300"))  # seconds a client clock may run ahead
+
+
+def movement_date(payload):
+    """Sheet date for a stock movement: the client's "occurredAt" (queued offline) or now.
+
+    Returns (date_str, error). occurredAt is ISO 8601; without an offset it is server local time.
+    """
+    now = datetime.now()
+    occurred_at = str(payload.get("occurredAt") or "").strip()
+    if not occurred_at:
+        return now.strftime("%Y-%m-%d %H:%M:%S"), None
+    try:
+        occurred = datetime.fromisoformat(occurred_at.replace("Z", "+00:00"))
+    except ValueError:
+        return None, "occurredAt must be an ISO 8601 timestamp"
+    if occurred.tzinfo is not None:
+        occurred = occurred.astimezone().replace(tzinfo=None)
+    if (occurred - now).total_seconds() > SYNC_CLOCK_SKEW:
+        return None, "occurredAt is in the future"
+    occurred = min(occurred, now)
+    cutoff = inventory_state.ledger_cutoff
+    if cutoff and occurred.strftime("%Y-%m") < cutoff:
+        return None, f"occurredAt is before {cutoff}, which has been archived"
+    return occurred.strftime("%Y-%m-%d %H:%M:%S"), None
+
+
+class MovementReceipts:
+    """clientId of recently recorded stock movements, so a retried offline POST is booked only once.
+
+    Kept in process memory only: a resend that arrives after a restart (or at another worker)
+    is not recognised and is booked again.
+    """
+
+    def __init__(self, size=SYNC_RECEIPTS):
+        self.lock = threading.Lock()
+        self.size = size
+        self.ids = OrderedDict()
+
+    def claim(self, client_id):
+        """False if this clientId was already recorded (or is being recorded right now)"""
+        with self.lock:
+            if client_id in self.ids:
+                return False
+            self.ids[client_id] = True
+            while len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+            return True
+
+    def release(self, client_id):
+        with self.lock:
+            self.ids.pop(client_id, None)
+
+
+movement_receipts = MovementReceipts()
+
+
+def _sync_version(token):
+    boot_id, _, version = str(token or "").partition(".")
+    if boot_id != BOOT_ID or not version.isdigit():
+        return None
+    return int(version)
+
+
+def _sync_product(product_id):
+    """Product the way /api/products lists it, or None if it is no longer in the catalog"""
+    product = inventory_state.product(product_id)
+    if product is None:
+        return None
+    _, main_cat, sub_cat = product
+    return {"id": product_id, "mainCat": main_cat, "subCat": sub_cat,
+            "quantity": inventory_state.balances.get(product_id, 0)}
+
+
+def _sync_transaction(row):
+    """Ledger row the way /api/reports formats it"""
+    return {
+        "type": _cell(row, TX_TYPE).lower(),
+        "productId": _cell(row, TX_PRODUCT),
+        "quantity": parse_quantity(_cell(row, TX_QUANTITY)),
+        "price": parse_price(_cell(row, TX_PRICE)),
+        "date": _cell(row, TX_DATE),
+        "mainCat": _cell(row, TX_MAIN),
+        "subCat": _cell(row, TX_SUB),
+        "location": _cell(row, TX_LOCATION) or DEFAULT_LOCATION,
+    }
+
+
+@app.route("/api/sync", methods=["GET"])
+def sync():
+    """Products and recent stock movements changed since ?since=<token>; "full" replaces the local copy"""
+    if products_ws is None or transactions_ws is None:
+        return jsonify({"error": "Google Sheet not loaded"}), 500
+    try:
+        inventory_state.ensure_fresh()
+        since = _sync_version(request.args.get("since"))
+        with inventory_state.lock:
+            version = inventory_state.version
+            delta = inventory_state.changes_after(since) if since is not None else None
+            if delta is not None:
+                product_ids, rows = delta
+                products, deleted = [], []
+                for product_id in sorted(product_ids):
+                    product = _sync_product(product_id)
+                    if product is None:
+                        deleted.append(product_id)
+                    else:
+                        products.append(product)
+                return json_response({
+                    "full": False,
+                    "token": f"{BOOT_ID}.{version}",
+                    "products": products,
+                    "deleted": deleted,
+                    "transactions": [_sync_transaction(row) for row in rows],
+                })
+
+        def build_full_sync():
+            with inventory_state.lock:
+                products = [_sync_product(product_id) for product_id in inventory_state.product_index]
+                rows = [_sync_transaction(row) for _, row in inventory_state.recent_rows]
+            print(f"🔄 Full sync served: {len(products)} products, {len(rows)} recent movements")
+            return {"full": True, "token": f"{BOOT_ID}.{version}", "products": products, "deleted": [], "transactions": rows}
+
+        return cached_json_response(("sync", version), build_full_sync)
+
+    except Exception as e:
+        print("❌ Error in /api/sync:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- LOW STOCK / REORDER POINTS ----------
+@app.route("/api/low-stock", methods=["GET"])
+def low_stock():
+    """Products at or below their reorder point, most short first"""
+    try:
+        if transactions_ws is None or products_ws is None:
+            return jsonify({"error": "Google Sheet not loaded"}), 500
+
+        stock_alerts.refresh()
+
+        def build_low_stock():
+            items = []
+            with stock_alerts.lock:
+                for product_id, status in stock_alerts.low.items():
+                    product = inventory_state.product(product_id)
+                    reorder_point, reorder_quantity = stock_alerts.threshold(product_id) or (0, 0)
+                    items.append({
+                        "id": product_id,
+                        "mainCat": product[1] if product else "",
+                        "subCat": product[2] if product else "",
+                        "stock": status["stock"],
+                        "reorderPoint": reorder_point,
+                        "reorderQuantity": reorder_quantity,
+                        "suggestedOrder": max(reorder_quantity, reorder_point - status["stock"]),
+                        "since": status["since"],
+                    })
+                last_event_id = stock_alerts.last_event_id
+            items.sort(key=lambda item: (item["stock"] - item["reorderPoint"], item["id"]))
+            return {"items": items, "count": len(items), "lastEventId": last_event_id}
+
+        return cached_json_response(("low-stock", stock_alerts.version), build_low_stock)
+
+    except Exception as e:
+        print("❌ Error in low stock:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/low-stock/events", methods=["GET"])
+def low_stock_events():
+    """Threshold crossings after ?since=<id> (or Last-Event-ID); text/event-stream clients get a stream"""
+    try:
+        since = request.args.get("since", request.headers.get("Last-Event-ID", "0"))
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({"error": "since must be an event id"}), 400
+
+        if "text/event-stream" not in request.headers.get("Accept", ""):
+            events, missed = stock_alerts.events_since(since)
+            return jsonify({"events": events, "lastEventId": events[-1]["id"] if events else max(since, 0), "missed": missed})
+
+        def stream(last_id):
+            # Bounded so a sync gunicorn worker is not held forever; EventSource reconnects with Last-Event-ID
+            deadline = time.time() + ALERT_STREAM_SECONDS
+            yield "retry: 3000\n\n"
+            while time.time() < deadline:
+                events, _ = stock_alerts.wait_for_events(last_id, min(15.0, max(deadline - time.time(), 0.1)))
+                if not events:
+                    yield ": ping\n\n"
+                for event in events:
+                    last_id = event["id"]
+                    yield f"id: {last_id}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+        return Response(stream(since), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    except Exception as e:
+        print("❌ Error in low stock events:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/reorder-points", methods=["GET", "POST", "DELETE"])
+def reorder_points():
+    if reorder_ws is None:
+        return jsonify({"error": "Google Sheet not loaded"}), 500
+
+    try:
+        if request.method == "GET":
+            stock_alerts.refresh()
+            with stock_alerts.lock:
+                points = [{"id": product_id, "reorderPoint": point, "reorderQuantity": quantity}
+                          for product_id, (point, quantity) in stock_alerts.thresholds.items()]
+            return jsonify(points)
+
+        if request.method == "POST":
+            data = request.json or {}
+            product_id = str(data.get("productId", "")).strip()
+            if not product_id or "reorderPoint" not in data:
+                return jsonify({"error": "productId and reorderPoint are required"}), 400
+            try:
+                reorder_point = int(data["reorderPoint"])
+                reorder_quantity = int(data.get("reorderQuantity") or 0)
+            except (TypeError, ValueError):
+                return jsonify({"error": "reorderPoint and reorderQuantity must be whole numbers"}), 400
+
+            stock_alerts.refresh()
+            if not inventory_state.product(product_id):
+                return jsonify({"error": "Product not found"}), 404
+
+            stock_alerts.set_threshold(product_id, reorder_point, reorder_quantity)
+            print(f"✅ Reorder point set: {product_id} <= {reorder_point} (order {reorder_quantity})")
+            return jsonify({"message": "Reorder point saved", "low": product_id in stock_alerts.low})
+
+        # DELETE
+        product_id = str(request.args.get("id", "")).strip()
+        if not product_id:
+            return jsonify({"error": "Product ID required"}), 400
+        stock_alerts.refresh()
+        if not stock_alerts.clear_threshold(product_id):
+            return jsonify({"error": "No reorder point for this product"}), 404
+        print(f"🗑️ Reorder point removed: {product_id}")
+        return jsonify({"message": "Reorder point removed"})
+
+    except Exception as e:
+        print("❌ Error in reorder points:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- SALES VELOCITY / STOCK-OUT FORECAST ----------
+@app.route("/api/forecast", methods=["GET"])
+def forecast():
+    """Sales velocity and days until stock-out (?method=ema|ma&days=N&id=X&limit=N)"""
+    try:
+        if transactions_ws is None or products_ws is None:
+            return jsonify({"error": "Google Sheet not loaded"}), 500
+        if numpy is None:
+            return jsonify({"error": "Forecasting is unavailable: numpy is not installed"}), 503
+
+        method = request.args.get("method", "ema")
+        if method not in FORECAST_METHODS:
+            return jsonify({"error": f"method must be one of {', '.join(FORECAST_METHODS)}"}), 400
+        try:
+            within_days = float(request.args["days"]) if request.args.get("days") else None
+            limit = min(max(int(request.args.get("limit", 100)), 1), 20000)
+        except ValueError:
+            return jsonify({"error": "days and limit must be numbers"}), 400
+        product_id = request.args.get("id", "").strip() or None
+
+        demand_forecast.refresh()
+        cache_key = ("forecast", demand_forecast.synced_version, demand_forecast.end_day,
+                     method, within_days, product_id, limit)
+        return cached_json_response(cache_key, lambda: demand_forecast.forecast(method, within_days, product_id, limit))
+
+    except Exception as e:
+        print("❌ Error in forecast:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- RECONCILIATION ----------
+@app.route("/api/reconcile", methods=["GET"])
+def reconcile():
+    """Mismatches between Transactions and Stock In/Stock Out (?full=1 rescans from the top, ?limit=N rows per list)"""
+    try:
+        if transactions_ws is None or stockin_ws is None or stockout_ws is None:
+            return jsonify({"error": "Google Sheet not loaded"}), 500
+        try:
+            limit = min(max(int(request.args.get("limit", 100)), 0), 10000)
+        except ValueError:
+            return jsonify({"error": "limit must be a number"}), 400
+
+        reconciler.run(full=request.args.get("full") in ("1", "true"))
+        return json_response(reconciler.report(limit))
+
+    except Exception as e:
+        print("❌ Error in reconciliation:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/reconcile/repair", methods=["POST"])
+def reconcile_repair():
+    """Fix mismatches found by the last pass: {"dryRun": true} only reports what would be written"""
+    try:
+        if transactions_ws is None or stockin_ws is None or stockout_ws is None:
+            return jsonify({"error": "Google Sheet not loaded"}), 500
+
+        data = request.get_json(silent=True) or {}
+        dry_run = bool(data.get("dryRun", False))
+        reconciler.run()
+        summary = reconciler.repair(dry_run=dry_run)
+        return jsonify({"dryRun": dry_run, "repairs": summary, "report": reconciler.report(0)})
+
+    except Exception as e:
+        print("❌ Error in reconciliation repair:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- STOCK AS OF A PAST DATE ----------
+@app.route("/api/stock/as-of", methods=["GET"])
+def stock_as_of():
+    """Per-product stock at the end of ?date=YYYY-MM-DD|MM/DD/YYYY or month end for YYYY-MM (&id=, &mainCat=, &subCat=)"""
+    try:
+        if transactions_ws is None or products_ws is None:
+            return jsonify({"error": "Google Sheet not loaded"}), 500
+
+        day = _normalize_period(request.args.get("date"))
+        if not (_DAY_KEY.match(day) or _MONTH_KEY.match(day)):
+            return jsonify({"error": "date must be YYYY-MM-DD, MM/DD/YYYY or YYYY-MM"}), 400
+        product_id = request.args.get("id", "").strip()
+        main_cat = request.args.get("mainCat", "").strip()
+        sub_cat = request.args.get("subCat", "").strip()
+
+        balance_history.refresh()
+        cutoff = inventory_state.ledger_cutoff
+        if cutoff and inventory_state.archive_cutoff is None and day[:7] < cutoff:
+            # Only the carried-forward opening balances are left for that time - they are the stock at the cutoff
+            return jsonify({"error": f"History before {cutoff} is archived and the archive is not loaded",
+                            "ledgerCutoff": cutoff, "incomplete": True}), 409
+
+        def build_as_of():
+            with inventory_state.lock:
+                if product_id:
+                    product_ids = [product_id]
+                elif main_cat and sub_cat:
+                    product_ids = sorted(inventory_state.index.by_sub.get((main_cat, sub_cat), ()))
+                elif main_cat:
+                    product_ids = sorted(inventory_state.index.by_main.get(main_cat, ()))
+                else:
+                    product_ids = None
+            balances, checkpoint, replayed = balance_history.as_of(day, product_ids)
+            items = []
+            for pid in sorted(balances):
+                if not balances[pid] and product_ids is None:
+                    continue
+                product = inventory_state.product(pid)
+                items.append({
+                    "id": pid,
+                    "mainCat": product[1] if product else "",
+                    "subCat": product[2] if product else "",
+                    "stock": balances[pid],
+                })
+            return {
+                "asOf": day,
+                "checkpoint": checkpoint,
+                "replayedDays": replayed,
+                "totalUnits": sum(item["stock"] for item in items),
+                "items": items,
+            }
+
+        cache_key = ("as-of", balance_history.synced_version, day, product_id, main_cat, sub_cat)
+        return cached_json_response(cache_key, build_as_of)
+
+    except Exception as e:
+        print("❌ Error in stock as-of:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------- LEDGER ARCHIVE ----------
+@app.route("/api/archive", methods=["GET", "POST"])
+def ledger_archive():
+    """GET: archive status. POST {"before": "YYYY-MM", "dryRun": bool}: archive all months before it.
+
+    A real (non dry-run) POST deletes ledger rows and needs "X-Admin-Token: <ADMIN_TOKEN>".
+    """
+    if transactions_ws is None or products_ws is None:
+        return jsonify({"error": "Google Sheet not loaded"}), 500
+
+    try:
+        if request.method == "GET":
+            inventory_state.ensure_fresh()
+            manifest = load_archive_manifest() or {}
+            return jsonify({
+                "cutoff": manifest.get("cutoff"),
+                "months": manifest.get("months", {}),
+                "archivedAt": manifest.get("archived_at"),
+                "archiveLoaded": inventory_state.archive_cutoff is not None,
+                "liveRows": inventory_state.last_row - 1,
+            })
+
+        data = request.json or {}
+        cutoff = str(data.get("before", "")).strip()
+        if not _MONTH_KEY.match(cutoff):
+            return jsonify({"error": "before must be a month (YYYY-MM)"}), 400
+        if cutoff > datetime.now().strftime("%Y-%m"):
+            return jsonify({"error": "Only closed months can be archived"}), 400
+        dry_run = bool(data.get("dryRun", False))
+        if not dry_run and not is_admin_request():
+            return jsonify({"error": "Archiving needs a valid X-Admin-Token (ADMIN_TOKEN)"}), 403
+
+        try:
+            summary = archive_transactions(cutoff, dry_run=dry_run)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(summary)
+
+    except Exception as e:
+        print("❌ Error archiving transactions:", e)
+        return jsonify({"error": str(e)}), 500
+
+
 # ---------- REPORTS (FIXED COLUMN MAPPING) ----------
 @app.route("/api/reports", methods=["GET"])
 def reports():
+    """Stock movements: archived months (from ARCHIVE_DIR) followed by the live Transactions sheet.
+
+    Bookkeeping rows are left out - "opening" rows only carry balances forward after archiving and
+    "transfer" rows move stock between locations without changing the total.
+    """
     if transactions_ws is None:
         return jsonify({"error": "Google Sheet not loaded"}), 500
     try:
         # Manual approach for transactions
-        all_data = transactions_ws.get_all_values()
-        
-        if len(all_data) < 2:
+        all_data, transactions_fingerprint = transactions_ws.read_versioned()
+        manifest = load_archive_manifest()
+        archive_cutoff = manifest["cutoff"] if manifest else None
+
+        if len(all_data) < 2 and not archive_cutoff:
             return jsonify([])
-            
-        headers = [h.strip() for h in all_data[0]]
-        rows = all_data[1:]
+
+        def build_transactions():
+            headers = [h.strip() for h in all_data[0]] if all_data else TX_HEADERS
+            rows = []
+            if archive_cutoff:
+                try:
+                    for month in sorted(manifest["months"]):
+                        rows.extend(read_archive_month(month))
+                except (OSError, ValueError, EOFError) as e:
+                    print(f"⚠️ Ledger archive unreadable ({e}) - reporting live transactions only")
+                    rows = []
+            rows.extend(all_data[1:])
         
-        print(f"🔍 Transactions headers: {headers}")
+            print(f"🔍 Transactions headers: {headers}")
         
-        formatted_transactions = []
-        for row in rows:
-            while len(row) < len(headers):
-                row.append('')
-            
-            row_dict = {}
-            for i, header in enumerate(headers):
-                row_dict[header] = row[i] if i < len(row) else ''
+            formatted_transactions = []
+            for row in rows:
+                if _cell(row, 0).lower() in ("opening", "transfer"):
+                    continue
+                while len(row) < len(headers):
+                    row.append('')
             
-            # ✅ FIXED: Correct column mapping based on ACTUAL Google Sheets structure
-            # Debug: Print the actual row data to see the order
-            print(f"📋 Row data: {row}")
+                row_dict = {}
+                for i, header in enumerate(headers):
+                    row_dict[header] = row[i] if i < len(row) else ''
             
-            # ✅ FIXED: Use POSITION-BASED mapping instead of header-based
-            # Based on the actual column order in your Google Sheet
-            # Transactions sheet columns: Type, Product ID, Quantity, Price, Date, Main Category, Sub Category
-            transaction = {
-                "type": row[0] if len(row) > 0 else "",           # Column 1: Type
-                "productId": row[1] if len(row) > 1 else "",      # Column 2: Product ID
-                "quantity": row[2] if len(row) > 2 else "",       # Column 3: Quantity
-                "price": row[3] if len(row) > 3 else "",          # Column 4: Price
-                "date": row[4] if len(row) > 4 else "",           # Column 5: Date
-                "mainCat": row[5] if len(row) > 5 else "",        # Column 6: Main Category
-                "subCat": row[6] if len(row) > 6 else ""          # Column 7: Sub Category
-            }
+                # ✅ FIXED: Correct column mapping based on ACTUAL Google Sheets structure
+                # ✅ FIXED: Use POSITION-BASED mapping instead of header-based
+                # Based on the actual column order in your Google Sheet
+                # Transactions sheet columns: Type, Product ID, Quantity, Price, Date, Main Category, Sub Category, Location
+                transaction = {
+                    "type": row[0] if len(row) > 0 else "",           # Column 1: Type
+                    "productId": row[1] if len(row) > 1 else "",      # Column 2: Product ID
+                    "quantity": row[2] if len(row) > 2 else "",       # Column 3: Quantity
+                    "price": row[3] if len(row) > 3 else "",          # Column 4: Price
+                    "date": row[4] if len(row) > 4 else "",           # Column 5: Date
+                    "mainCat": row[5] if len(row) > 5 else "",        # Column 6: Main Category
+                    "subCat": row[6] if len(row) > 6 else "",         # Column 7: Sub Category
+                    "location": row[7] if len(row) > 7 and row[7] else DEFAULT_LOCATION  # Column 8: Location
+                }
             
-            # Convert quantity and price to proper types
-            try:
-                transaction["quantity"] = int(float(transaction["quantity"])) if transaction["quantity"] else 0
-            except (ValueError, TypeError):
-                transaction["quantity"] = 0
+                # Convert quantity and price to proper types
+                try:
+                    transaction["quantity"] = int(float(transaction["quantity"])) if transaction["quantity"] else 0
+                except (ValueError, TypeError):
+                    transaction["quantity"] = 0
                 
-            try:
-                transaction["price"] = float(transaction["price"]) if transaction["price"] else 0.0
-            except (ValueError, TypeError):
-                transaction["price"] = 0.0
+                try:
+                    transaction["price"] = float(transaction["price"]) if transaction["price"] else 0.0
+                except (ValueError, TypeError):
+                    transaction["price"] = 0.0
             
-            formatted_transactions.append(transaction)
+                formatted_transactions.append(transaction)
         
-        print(f"📊 Reports fetched: {len(formatted_transactions)} transactions")
+            print(f"📊 Reports fetched: {len(formatted_transactions)} transactions")
         
-        # ✅ DEBUG: Print first transaction to verify structure
-        if formatted_transactions:
-            print("🔍 First transaction sample:", formatted_transactions[0])
+            # ✅ DEBUG: Print first transaction to verify structure
+            if formatted_transactions:
+                print("🔍 First transaction sample:", formatted_transactions[0])
         
-        return jsonify(formatted_transactions)
+            return formatted_transactions
+
+        return cached_json_response(("reports", archive_cutoff, transactions_fingerprint), build_transactions)
     except Exception as e:
         print("❌ Error in /api/reports:", e)
         return jsonify({"error": str(e)}), 500
 
 
+# ---------- INVENTORY REPORT BUILDER (FROM IN-MEMORY ROLLUPS + VALUATION) ----------
+def _normalize_period(value):
+    """'2025-01' (month), '2025-01-15' or '01/15/2025' (day) -> rollup key; '' -> all time"""
+    value = (value or "").strip()
+    if "/" in value:
+        try:
+            return datetime.strptime(value, "%m/%d/%Y").strftime("%Y-%m-%d")
+        except ValueError:
+            return value
+    return value
+
+
+def _valuation_method():
+    method = request.args.get("method", VALUATION_METHOD)
+    return method if method in VALUATION_METHODS else VALUATION_METHOD
+
+
+def _location_arg():
+    """?location= filter; None means all locations"""
+    return request.args.get("location", "").strip() or None
+
+
+def _inventory_value(product_id, method, site=None):
+    """Value of a product's stock - everywhere, or at one location priced at the product's unit cost"""
+    costs = inventory_state.costs.get(product_id)
+    if costs is None:
+        return 0.0
+    if site is None:
+        return costs.inventory_value(method)
+    return max(site["balances"].get(product_id, 0), 0) * costs.unit_cost(method)
+
+
+def build_inventory_report(period="", method=VALUATION_METHOD, location=None):
+    """Per-product movements and valuation for a month/day rollup key, or all time when period is empty.
+
+    inventoryValue is only included for all-time reports: the cost layers are kept as of now, so a
+    value for a past period would be today's stock value, not the value at the end of that period.
+    """
+    inventory_state.ensure_fresh()
+    cogs_key = "cogs_avg" if method == "average" else "cogs_fifo"
+
+    inventory_data = []
+    total_purchases = 0
+    total_sales = 0
+    total_cogs = 0
+    with inventory_state.lock:
+        site = inventory_state.locations.get(location, _new_location()) if location else None
+        source = site or {"period_totals": inventory_state.period_totals, "product_totals": inventory_state.product_totals}
+        if period:
+            totals_by_product = source["period_totals"].get(period, {})
+        else:
+            totals_by_product = source["product_totals"]
+        for product_id, totals in totals_by_product.items():
+            product = inventory_state.product(product_id)
+            inventory_data.append({
+                "id": product_id,
+                # ✅ NO PRODUCT NAME - only categories
+                "mainCat": product[1] if product else "",
+                "subCat": product[2] if product else "",
+                "received": totals["received"],
+                "sold": totals["sold"],
+                "remaining": totals["received"] - totals["sold"],
+                "purchaseValue": round(totals["purchases"], 2),
+                "salesValue": round(totals["sales"], 2),
+                "cogs": round(totals[cogs_key], 2),
+                "margin": round(totals["sales"] - totals[cogs_key], 2),
+            })
+            if not period:
+                inventory_data[-1]["inventoryValue"] = round(_inventory_value(product_id, method, site), 2)
+            total_purchases += totals["purchases"]
+            total_sales += totals["sales"]
+            total_cogs += totals[cogs_key]
+        finance = {
+            "purchases": round(total_purchases, 2),
+            "sales": round(total_sales, 2),
+            "balance": round(total_sales - total_purchases, 2),
+            "cogs": round(total_cogs, 2),
+            "grossMargin": round(total_sales - total_cogs, 2),
+        }
+        if not period:
+            stocked = site["balances"] if site else inventory_state.costs
+            finance["inventoryValue"] = round(sum(_inventory_value(product_id, method, site) for product_id in stocked), 2)
+
+    return {
+        "period": period or "all",
+        "location": location or "all",
+        "valuationMethod": method,
+        "inventory": inventory_data,
+        "finance": finance,
+    }
+
+
+CATEGORY_REPORT_FIELDS = ("received", "sold", "remaining", "purchaseValue", "salesValue", "cogs", "margin", "inventoryValue")
+
+
+def build_category_report(period="", method=VALUATION_METHOD, location=None):
+    """build_inventory_report rolled up per (main, sub) category"""
+    report = build_inventory_report(period, method, location)
+    # Period reports carry no inventoryValue (see build_inventory_report)
+    fields = CATEGORY_REPORT_FIELDS if not period else CATEGORY_REPORT_FIELDS[:-1]
+    groups = {}
+    for item in report["inventory"]:
+        group = groups.get((item["mainCat"], item["subCat"]))
+        if group is None:
+            group = groups[(item["mainCat"], item["subCat"])] = dict.fromkeys(fields, 0)
+            group.update(mainCat=item["mainCat"], subCat=item["subCat"], products=0)
+        group["products"] += 1
+        for field in fields:
+            group[field] += item[field]
+    categories = sorted(groups.values(), key=lambda group: (group["mainCat"], group["subCat"]))
+    for group in categories:
+        for field in fields:
+            group[field] = round(group[field], 2)
+    return {
+        "period": report["period"],
+        "location": report["location"],
+        "valuationMethod": method,
+        "categories": categories,
+        "finance": report["finance"],
+    }
+
+
+# ---------- REPORT CACHE + SCHEDULED REPORT JOBS ----------
+# Reports are built by a background worker; /api/generate-report waits REPORT_WAIT_SECONDS
+# and then hands back a job to poll instead of running into the gunicorn timeout. A report
+# for a closed period (a day or month that ended REPORT_CLOSE_MINUTES ago) is kept on disk
+# and served as long as that period's ledger totals and product categories are unchanged.
+REPORT_TYPES = ("daily", "monthly", "category", "general")
+REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR", "report_cache")
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "64"))            # reports kept in memory
+REPORT_CLOSE_MINUTES = float(os.getenv("REPORT_CLOSE_MINUTES", "30"))    # late rows allowed after a period ends
+REPORT_WAIT_SECONDS = float(os.getenv("REPORT_WAIT_SECONDS", "20"))
+REPORT_JOB_HISTORY = int(os.getenv("REPORT_JOB_HISTORY", "200"))
+REPORT_SCHEDULE = [kind.strip() for kind in os.getenv("REPORT_SCHEDULE", "daily,monthly,category").split(",")
+                   if kind.strip() in REPORT_TYPES[:3]]  # recurring reports, saved to the Reports sheet
+REPORT_LAST_COLUMN = "L"
+REPORT_VERSION_INDEX = 11  # "Report Version" column: which ledger state a saved report block was built from
+
+
+def _report_period(report_type, period):
+    """Rollup key a report of this type covers ("" = all time for general reports)"""
+    if report_type == "general":
+        return ""
+    period = _normalize_period(period)
+    if report_type == "daily" and not _DAY_KEY.match(period):
+        raise ValueError("daily reports need a date (YYYY-MM-DD or MM/DD/YYYY)")
+    if report_type == "monthly" and not _MONTH_KEY.match(period):
+        raise ValueError("monthly reports need a month (YYYY-MM)")
+    if report_type == "category" and period and not (_DAY_KEY.match(period) or _MONTH_KEY.match(period)):
+        raise ValueError("category reports need a month, a date or no period")
+    return period
+
+
+def _period_end(period):
+    if _DAY_KEY.match(period):
+        return datetime.strptime(period, "%Y-%m-%d") + timedelta(days=1)
+    if _MONTH_KEY.match(period):
+        year, month = int(period[:4]), int(period[5:])
+        return datetime(year + month // 12, month % 12 + 1, 1)
+    return None
+
+
+def _period_closed(period, now=None):
+    end = _period_end(period)
+    return end is not None and (now or datetime.now()) >= end + timedelta(minutes=REPORT_CLOSE_MINUTES)
+
+
+def _last_closed_period(report_type, now=None):
+    """Most recent closed day (daily) or month (monthly, category) - what the schedule generates"""
+    closed_at = (now or datetime.now()) - timedelta(minutes=REPORT_CLOSE_MINUTES)
+    if report_type == "daily":
+        return (closed_at - timedelta(days=1)).strftime("%Y-%m-%d")
+    return (closed_at.replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+
+
+def _period_fingerprint(period, location):
+    """Everything a closed-period report is built from: the period's ledger totals and the catalog
+    categories of its products. A cached closed-period report is reused only while this matches."""
+    with inventory_state.lock:
+        source = inventory_state.locations.get(location, _new_location()) if location else {
+            "monthly": inventory_state.monthly, "period_totals": inventory_state.period_totals}
+        by_product = source["period_totals"].get(period, {})
+        if _MONTH_KEY.match(period):
+            totals = source["monthly"].get(period) or _new_totals()
+        else:
+            totals = _new_totals()
+            for product_totals in by_product.values():
+                for field, value in product_totals.items():
+                    totals[field] += value
+        # Reports label products with their current categories, so a category edit invalidates them too
+        categories = [inventory_state.product(product_id) or (product_id, "", "") for product_id in sorted(by_product)]
+        return [len(by_product), zlib.crc32(dumps_json(categories))] + [round(totals[field], 4) for field in sorted(totals)]
+
+
+def build_report(report_type, period, method=VALUATION_METHOD, location=None):
+    if report_type == "category":
+        return build_category_report(period, method, location)
+    return build_inventory_report(period, method, location)
+
+
+class ReportCache:
+    """Finished reports keyed by (type, period, location, method)"""
+
+    def __init__(self, directory=REPORT_CACHE_DIR):
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.entries = OrderedDict()  # key -> entry, least recently used first
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(dumps_json(list(key))).hexdigest() + ".json.gz")
+
+    def _valid(self, key, entry):
+        period, location = key[1], key[2]
+        if _period_closed(period):
+            return entry["fingerprint"] == _period_fingerprint(period, location)
+        return entry["boot"] == BOOT_ID and entry["version"] == inventory_state.version
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None and _period_closed(key[1]):
+            try:
+                with gzip.open(self._path(key), "rb") as f:
+                    entry = json.loads(f.read())
+            except (OSError, ValueError, EOFError):
+                entry = None
+        if entry is None or not self._valid(key, entry):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, build):
+        """Build a report with build() and store it, stamped with the state it was built from"""
+        # Build and stamp under the state lock: a row ingested in between would be missing from
+        # the report while its version/fingerprint says it is included
+        with inventory_state.lock:
+            entry = {
+                "report": build(),
+                "generatedAt": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "boot": BOOT_ID,
+                "version": inventory_state.version,
+                "fingerprint": _period_fingerprint(key[1], key[2]) if key[1] else None,
+            }
+        self._remember(key, entry)
+        self._persist(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > REPORT_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def _persist(self, key, entry):
+        if not _period_closed(key[1]):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(dumps_json(entry))
+        os.replace(tmp_path, path)
+
+
+report_cache = ReportCache()
+
+
+def cached_report(report_type, period, method=VALUATION_METHOD, location=None):
+    """(cache entry, served from cache) for a report, building and caching it on a miss"""
+    key = (report_type, period, location, method)
+    inventory_state.ensure_fresh()
+    entry = report_cache.get(key)
+    if entry is not None:
+        return entry, True
+    return report_cache.put(key, lambda: build_report(report_type, period, method, location)), False
+
+
+def _report_version(fingerprint):
+    """Short id of the _period_fingerprint a report was built from, kept in the Reports sheet's last column"""
+    return f"{zlib.crc32(dumps_json(fingerprint)):08x}" if fingerprint else ""
+
+
+def saved_report_versions():
+    """(type, period) -> Report Version of every report block in the Reports sheet ("" for older rows).
+
+    Adds the "Report Version" header to Reports sheets created before the column existed.
+    """
+    rows = reports_ws.get(f"A1:{REPORT_LAST_COLUMN}")
+    if rows and not _cell(rows[0], REPORT_VERSION_INDEX):
+        reports_ws.update(f"{REPORT_LAST_COLUMN}1", [["Report Version"]])
+    return {(_cell(row, 0), _cell(row, 1)): _cell(row, REPORT_VERSION_INDEX) for row in rows[1:] if _cell(row, 0)}
+
+
+def save_report_rows(report_type, label, report, version="", replace=False):
+    """Write a report to the Reports sheet in one call; returns the number of rows written.
+
+    replace=True swaps an existing (type, period) block for the new rows in place (one atomic
+    batch_update) instead of appending a second copy.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if report_type == "category":
+        # Category rows put the product count where product reports have the Product ID
+        report_rows = [
+            [report_type, label, f"{group['products']} products", group["mainCat"], group["received"], group["sold"],
+             group["remaining"], group["purchaseValue"], group["salesValue"], timestamp, group["subCat"], version]
+            for group in report["categories"]
+        ]
+    else:
+        report_rows = [
+            [
+                report_type,                    # Report Type
+                label,                          # Period
+                item["id"],                     # Product ID
+                item["mainCat"],                # ✅ MAIN CATEGORY (Product Name ki jagah)
+                item["received"],               # Received
+                item["sold"],                   # Sold
+                item.get("remaining", 0),       # Remaining
+                item["purchaseValue"],          # Purchase Value (actual purchase prices)
+                item["salesValue"],             # Sales Value (actual selling prices)
+                timestamp,                      # Generated At
+                item["subCat"],                 # ✅ SUB CATEGORY (new column)
+                version                         # Report Version (ledger state the report was built from)
+            ]
+            for item in report["inventory"]
+        ]
+    existing = []
+    if replace:
+        existing = [row_number for row_number, row in enumerate(reports_ws.get("A2:B"), start=2)
+                    if _cell(row, 0) == report_type and _cell(row, 1) == label]
+    if existing:
+        ranges = _contiguous_ranges(existing)
+        requests = [{"deleteDimension": {"range": {"sheetId": reports_ws.id, "dimension": "ROWS",
+                                                   "startIndex": first - 1, "endIndex": last}}}
+                    for first, last in ranges]
+        if report_rows:
+            start = min(existing) - 1  # 0-based index where the old block started
+            requests.append({"insertDimension": {"range": {"sheetId": reports_ws.id, "dimension": "ROWS",
+                                                           "startIndex": start, "endIndex": start + len(report_rows)},
+                                                 "inheritFromBefore": False}})
+            requests.append({"updateCells": {"start": {"sheetId": reports_ws.id, "rowIndex": start, "columnIndex": 0},
+                                             "rows": [{"values": [_sheet_cell(v) for v in row]} for row in report_rows],
+                                             "fields": "userEnteredValue"}})
+        reports_ws.spreadsheet_batch_update({"requests": requests})
+    elif report_rows:
+        reports_ws.append_rows(report_rows)
+    return len(report_rows)
+
+
+class ReportJobs:
+    """Report generation queue, run by one background thread that also fires the recurring schedule"""
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.jobs = OrderedDict()   # job id -> job, oldest first (bounded by REPORT_JOB_HISTORY)
+        self.queue = deque()
+        self.thread = None
+        self.schedule_checked = 0.0
+        self.saved = None           # (type, period) -> Report Version in the Reports sheet, read on the first schedule check
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker, name="report-jobs", daemon=True)
+                self.thread.start()
+
+    def submit(self, report_type, period, label=None, location=None, method=VALUATION_METHOD, save=False, scheduled=False):
+        """Queue a report (or join an identical queued/running one); the job dict is the status record"""
+        key = (report_type, period, location, method)
+        with self.lock:
+            for job in self.jobs.values():
+                if job["key"] == key and job["status"] in ("queued", "running") and job["save"] == save:
+                    return job
+            job = {
+                "id": base64.urlsafe_b64encode(os.urandom(6)).decode(),
+                "key": key,
+                "type": report_type,
+                "period": period or "all",
+                "label": label or period or "all",
+                "location": location or "all",
+                "method": method,
+                "save": save,
+                "scheduled": scheduled,
+                "status": "queued",
+                "submittedAt": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "startedAt": None,
+                "finishedAt": None,
+                "seconds": None,
+                "fromCache": None,
+                "rowsSaved": 0,
+                "error": None,
+                "entry": None,      # the cache entry the job produced (and saved), served as the job's result
+            }
+            self.jobs[job["id"]] = job
+            while len(self.jobs) > REPORT_JOB_HISTORY:
+                oldest = next(iter(self.jobs))
+                if self.jobs[oldest]["status"] in ("queued", "running"):
+                    break
+                del self.jobs[oldest]
+            self.queue.append(job)
+            self.lock.notify_all()
+        self.start()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def wait(self, job, timeout):
+        """True once the job has finished (done or failed), False if it is still going after timeout"""
+        with self.lock:
+            return self.lock.wait_for(lambda: job["status"] in ("done", "failed"), timeout)
+
+    def status(self, job):
+        with self.lock:
+            return {field: value for field, value in job.items() if field not in ("key", "entry")}
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.lock.wait(timeout=60)
+                job = self.queue.popleft() if self.queue else None
+                if job is not None:
+                    job["status"] = "running"
+                    job["startedAt"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            if job is not None:
+                self._run(job)
+            elif REPORT_SCHEDULE and time.time() - self.schedule_checked >= 60:
+                self.schedule_checked = time.time()
+                try:
+                    self.schedule_due()
+                except Exception as e:
+                    print("❌ Error checking report schedule:", e)
+
+    def _run(self, job):
+        started = time.perf_counter()
+        report_type, period, location, method = job["key"]
+        try:
+            entry, from_cache = cached_report(report_type, period, method, location)
+            rows = 0
+            if job["save"]:
+                # Reports sheet has no location column
+                label = f"{job['label']} @ {location}" if location else job["label"]
+                version = _report_version(entry["fingerprint"])
+                # A scheduled report replaces its earlier block (e.g. after a backdated row) instead of adding a copy
+                rows = save_report_rows(report_type, label, entry["report"], version, replace=job["scheduled"])
+                with self.lock:
+                    if self.saved is not None:
+                        self.saved[(report_type, label)] = version
+            status, error = "done", None
+            print(f"✅ Report job {job['id']} ({report_type} {job['period']}): "
+                  f"{'cached' if from_cache else 'built'}, {rows} rows saved")
+        except Exception as e:
+            entry, from_cache, rows, status, error = None, None, 0, "failed", str(e)
+            print(f"❌ Report job {job['id']} failed:", e)
+        with self.lock:
+            job.update(status=status, error=error, entry=entry, fromCache=from_cache, rowsSaved=rows,
+                       finishedAt=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                       seconds=round(time.perf_counter() - started, 3))
+            self.lock.notify_all()
+
+    def schedule_due(self):
+        """Queue the latest closed period of every scheduled report type that is not in the Reports sheet
+        yet, or whose saved block was built from a different ledger state"""
+        if not inventory_state.loaded or reports_ws is None:
+            return
+        if self.saved is None:
+            saved = saved_report_versions()
+            with self.lock:
+                self.saved = saved
+        for report_type in REPORT_SCHEDULE:
+            period = _last_closed_period(report_type)
+            version = _report_version(_period_fingerprint(period, None))
+            with self.lock:
+                saved = self.saved.get((report_type, period))
+            # "" = saved before report versions existed - leave those blocks alone
+            if saved is not None and saved in ("", version):
+                continue
+            print(f"🗓️ Scheduling {report_type} report for {period}")
+            self.submit(report_type, period, save=True, scheduled=True)
+
+
+report_jobs = ReportJobs()
+if transactions_ws is not None and products_ws is not None and REPORT_SCHEDULE:
+    report_jobs.start()
+
+
 # ---------- SIMPLIFIED REPORTS (NO PRODUCT NAME) ----------
 @app.route("/api/simple-reports", methods=["GET"])
 def simple_reports():
-    """Simple reports data for frontend - WITHOUT PRODUCT NAME"""
+    """Simple reports data for frontend - WITHOUT PRODUCT NAME (all time)"""
     try:
         if transactions_ws is None or products_ws is None:
             return jsonify({"error": "Google Sheet not loaded"}), 500
-            
-        # Get all transactions
-        all_transactions = transactions_ws.get_all_values()
-        if len(all_transactions) < 2:
-            return jsonify({"inventory": [], "finance": {"purchases": 0, "sales": 0, "balance": 0}})
-        
-        headers = [h.strip() for h in all_transactions[0]]
-        rows = all_transactions[1:]
-        
-        print(f"📋 Transactions headers: {headers}")
-        print(f"📋 Total transactions found: {len(rows)}")
-        
-        # Get products for categories only (NO NAME NEEDED)
-        products_data = products_ws.get_all_values()
-        product_categories = {}
-        if len(products_data) > 1:
-            for row in products_data[1:]:
-                if len(row) > 0:
-                    product_id = str(row[0]).strip()
-                    main_cat = str(row[1]).strip() if len(row) > 1 else ""  # ✅ FIXED: Main Category is now at index 1
-                    sub_cat = str(row[2]).strip() if len(row) > 2 else ""   # ✅ FIXED: Sub Category is now at index 2
-                    
-                    product_categories[product_id] = {
-                        "mainCat": main_cat,
-                        "subCat": sub_cat
-                    }
-        
-        print(f"📦 Product categories found: {product_categories}")
-        
-        # Calculate current stock for all products
-        inventory_data = {}
-        total_purchases = 0
-        total_sales = 0
-        
-        for row_index, row in enumerate(rows):
-            while len(row) < len(headers):
-                row.append('')
-            
-            row_dict = {}
-            for i, header in enumerate(headers):
-                row_dict[header] = row[i] if i < len(row) else ''
-            
-            product_id = str(row_dict.get("Product ID", "")).strip()
-            trans_type = row_dict.get("Type", "").lower()
-            
-            # Get quantity and price
-            try:
-                quantity = int(float(row_dict.get("Quantity", 0)))
-                price = float(row_dict.get("Price", 0))
-            except (ValueError, TypeError):
-                quantity = 0
-                price = 0
-            
-            print(f"📊 Processing: {product_id}, {trans_type}, Qty: {quantity}, Price: {price}")
-            
-            # Initialize product in report
-            if product_id not in inventory_data:
-                categories = product_categories.get(product_id, {"mainCat": "", "subCat": ""})
-                inventory_data[product_id] = {
-                    "id": product_id,
-                    # ✅ NO PRODUCT NAME - only categories
-                    "mainCat": categories.get("mainCat", ""),
-                    "subCat": categories.get("subCat", ""),
-                    "received": 0,
-                    "sold": 0,
-                    "remaining": 0
-                }
-            
-            # Update counts
-            if trans_type == "in":
-                inventory_data[product_id]["received"] += quantity
-                inventory_data[product_id]["remaining"] += quantity
-                total_purchases += quantity * price
-            elif trans_type == "out":
-                inventory_data[product_id]["sold"] += quantity
-                inventory_data[product_id]["remaining"] -= quantity
-                total_sales += quantity * price
-        
-        # ✅ DEBUG: Show final inventory data
-        for product_id, data in inventory_data.items():
-            print(f"📋 Final: {product_id} -> {data}")
-        
-        return jsonify({
-            "inventory": list(inventory_data.values()),
-            "finance": {
-                "purchases": total_purchases,
-                "sales": total_sales,
-                "balance": total_sales - total_purchases
-            }
-        })
+
+        report = build_inventory_report("", _valuation_method(), _location_arg())
+        print(f"📊 Simple report from state: {len(report['inventory'])} products")
+        return jsonify(report)
         
     except Exception as e:
         print("❌ Error in simple reports:", e)
@@ -654,107 +4057,20 @@ def simple_reports():
 # ---------- MONTHLY REPORT (NO PRODUCT NAME) ----------
 @app.route("/api/monthly-report", methods=["GET"])
 def monthly_report():
-    """Get monthly report data - WITHOUT PRODUCT NAME"""
+    """Get monthly report data (?month=YYYY-MM) - WITHOUT PRODUCT NAME"""
     try:
         if transactions_ws is None or products_ws is None:
             return jsonify({"error": "Google Sheet not loaded"}), 500
             
-        month = request.args.get("month")
-        
+        month = _normalize_period(request.args.get("month"))
         print(f"🔍 Monthly report requested for: {month}")
-        
-        # Get all transactions
-        all_data = transactions_ws.get_all_values()
-        if len(all_data) < 2:
-            return jsonify({"inventory": [], "finance": {"purchases": 0, "sales": 0, "balance": 0}})
-        
-        headers = [h.strip() for h in all_data[0]]
-        rows = all_data[1:]
-        
-        print(f"📋 Transactions headers: {headers}")
-        print(f"📋 Total transactions found: {len(rows)}")
-        
-        # Get products for categories only (NO NAME NEEDED)
-        products_data = products_ws.get_all_values()
-        product_categories = {}
-        if len(products_data) > 1:
-            for row in products_data[1:]:
-                if len(row) > 0:
-                    product_id = str(row[0]).strip()
-                    main_cat = str(row[1]).strip() if len(row) > 1 else ""  # ✅ FIXED: Main Category is now at index 1
-                    sub_cat = str(row[2]).strip() if len(row) > 2 else ""   # ✅ FIXED: Sub Category is now at index 2
-                    
-                    product_categories[product_id] = {
-                        "mainCat": main_cat,
-                        "subCat": sub_cat
-                    }
 
-        print(f"📦 Product categories found: {product_categories}")
-
-        # Process transactions
-        inventory_data = {}
-        total_purchases = 0
-        total_sales = 0
-        
-        for row_index, row in enumerate(rows):
-            while len(row) < len(headers):
-                row.append('')
-            
-            row_dict = {}
-            for i, header in enumerate(headers):
-                row_dict[header] = row[i] if i < len(row) else ''
-            
-            product_id = str(row_dict.get("Product ID", "")).strip()
-            trans_type = row_dict.get("Type", "").lower()
-            
-            # Get quantity and price
-            try:
-                quantity = int(float(row_dict.get("Quantity", 0)))
-                price = float(row_dict.get("Price", 0))
-            except (ValueError, TypeError):
-                quantity = 0
-                price = 0
-            
-            print(f"📊 Processing: {product_id}, {trans_type}, Qty: {quantity}, Price: {price}")
-            
-            # Initialize product in report
-            if product_id not in inventory_data:
-                categories = product_categories.get(product_id, {"mainCat": "", "subCat": ""})
-                inventory_data[product_id] = {
-                    "id": product_id,
-                    # ✅ NO PRODUCT NAME - only categories
-                    "mainCat": categories.get("mainCat", ""),
-                    "subCat": categories.get("subCat", ""),
-                    "received": 0,
-                    "sold": 0,
-                    "remaining": 0
-                }
-            
-            # Update counts
-            if trans_type == "in":
-                inventory_data[product_id]["received"] += quantity
-                inventory_data[product_id]["remaining"] += quantity
-                total_purchases += quantity * price
-            elif trans_type == "out":
-                inventory_data[product_id]["sold"] += quantity
-                inventory_data[product_id]["remaining"] -= quantity
-                total_sales += quantity * price
-        
-        print(f"✅ Report generated: {len(inventory_data)} products, Purchases: {total_purchases}, Sales: {total_sales}")
-        
-        # ✅ DEBUG: Show final inventory data
-        for product_id, data in inventory_data.items():
-            print(f"📋 Final: {product_id} -> {data}")
-        
-        return jsonify({
-            "inventory": list(inventory_data.values()),
-            "finance": {
-                "purchases": total_purchases,
-                "sales": total_sales,
-                "balance": total_sales - total_purchases
-            }
-        })
-        
+        method, location = _valuation_method(), _location_arg()
+        entry, from_cache = cached_report("monthly", month, method, location)
+        report = entry["report"]
+        print(f"✅ Report {'from cache' if from_cache else 'generated'}: {len(report['inventory'])} products, Purchases: {report['finance']['purchases']}, Sales: {report['finance']['sales']}")
+        return cached_json_response(("monthly-report", month, method, location, entry["generatedAt"], entry["version"]),
+                                    lambda: report)
         
     except Exception as e:
         print("❌ Error in monthly report:", e)
@@ -764,116 +4080,87 @@ def monthly_report():
 # ---------- DAILY REPORT (NO PRODUCT NAME) ----------
 @app.route("/api/daily-report", methods=["GET"])
 def daily_report():
-    """Get daily report data - WITHOUT PRODUCT NAME"""
+    """Get daily report data (?date=MM/DD/YYYY or YYYY-MM-DD) - WITHOUT PRODUCT NAME"""
     try:
         if transactions_ws is None or products_ws is None:
             return jsonify({"error": "Google Sheet not loaded"}), 500
             
-        date = request.args.get("date")
-        
+        date = _normalize_period(request.args.get("date"))
         print(f"🔍 Daily report requested for: {date}")
-        
-        # Get all transactions
-        all_data = transactions_ws.get_all_values()
-        if len(all_data) < 2:
-            return jsonify({"inventory": [], "finance": {"purchases": 0, "sales": 0, "balance": 0}})
-        
-        headers = [h.strip() for h in all_data[0]]
-        rows = all_data[1:]
-        
-        print(f"📋 Transactions headers: {headers}")
-        print(f"📋 Total transactions found: {len(rows)}")
-        
-        # Get products for categories only (NO NAME NEEDED)
-        products_data = products_ws.get_all_values()
-        product_categories = {}
-        if len(products_data) > 1:
-            for row in products_data[1:]:
-                if len(row) > 0:
-                    product_id = str(row[0]).strip()
-                    main_cat = str(row[1]).strip() if len(row) > 1 else ""  # ✅ FIXED: Main Category is now at index 1
-                    sub_cat = str(row[2]).strip() if len(row) > 2 else ""   # ✅ FIXED: Sub Category is now at index 2
-                    
-                    product_categories[product_id] = {
-                        "mainCat": main_cat,
-                        "subCat": sub_cat
-                    }
-        
-        print(f"📦 Product categories found: {product_categories}")
-        
-        # Process transactions
-        inventory_data = {}
-        total_purchases = 0
-        total_sales = 0
-        
-        for row_index, row in enumerate(rows):
-            while len(row) < len(headers):
-                row.append('')
-            
-            row_dict = {}
-            for i, header in enumerate(headers):
-                row_dict[header] = row[i] if i < len(row) else ''
-            
-            product_id = str(row_dict.get("Product ID", "")).strip()
-            trans_type = row_dict.get("Type", "").lower()
-            
-            # Get quantity and price
-            try:
-                quantity = int(float(row_dict.get("Quantity", 0)))
-                price = float(row_dict.get("Price", 0))
-            except (ValueError, TypeError):
-                quantity = 0
-                price = 0
-            
-            print(f"📊 Processing: {product_id}, {trans_type}, Qty: {quantity}, Price: {price}")
-            
-            # Initialize product in report
-            if product_id not in inventory_data:
-                categories = product_categories.get(product_id, {"mainCat": "", "subCat": ""})
-                inventory_data[product_id] = {
-                    "id": product_id,
-                    # ✅ NO PRODUCT NAME - only categories
-                    "mainCat": categories.get("mainCat", ""),
-                    "subCat": categories.get("subCat", ""),
-                    "received": 0,
-                    "sold": 0,
-                    "remaining": 0
-                }
-            
-            # Update counts
-            if trans_type == "in":
-                inventory_data[product_id]["received"] += quantity
-                inventory_data[product_id]["remaining"] += quantity
-                total_purchases += quantity * price
-            elif trans_type == "out":
-                inventory_data[product_id]["sold"] += quantity
-                inventory_data[product_id]["remaining"] -= quantity
-                total_sales += quantity * price
-        
-        print(f"✅ Report generated: {len(inventory_data)} products, Purchases: {total_purchases}, Sales: {total_sales}")
-        
-        # ✅ DEBUG: Show final inventory data
-        for product_id, data in inventory_data.items():
-            print(f"📋 Final: {product_id} -> {data}")
-        
-        return jsonify({
-            "inventory": list(inventory_data.values()),
-            "finance": {
-                "purchases": total_purchases,
-                "sales": total_sales,
-                "balance": total_sales - total_purchases
-            }
-        })
+
+        method, location = _valuation_method(), _location_arg()
+        entry, from_cache = cached_report("daily", date, method, location)
+        report = entry["report"]
+        print(f"✅ Report {'from cache' if from_cache else 'generated'}: {len(report['inventory'])} products, Purchases: {report['finance']['purchases']}, Sales: {report['finance']['sales']}")
+        return cached_json_response(("daily-report", date, method, location, entry["generatedAt"], entry["version"]),
+                                    lambda: report)
         
     except Exception as e:
         print("❌ Error in daily report:", e)
         return jsonify({"error": str(e)}), 500
 
 
+# ---------- INVENTORY VALUATION ----------
+@app.route("/api/valuation", methods=["GET"])
+def valuation():
+    """On-hand quantity, unit cost, inventory value, COGS and margin per product (?method=fifo|average&location=).
+
+    cogsApproximate marks products whose ledger has movements appended out of date order (see CostLayers).
+    """
+    try:
+        if transactions_ws is None or products_ws is None:
+            return jsonify({"error": "Google Sheet not loaded"}), 500
+
+        method = _valuation_method()
+        location = _location_arg()
+        inventory_state.ensure_fresh()
+        cogs_key = "cogs_avg" if method == "average" else "cogs_fifo"
+
+        def build_valuation():
+            items = []
+            totals = {"inventoryValue": 0.0, "cogs": 0.0, "revenue": 0.0}
+            with inventory_state.lock:
+                site = inventory_state.locations.get(location, _new_location()) if location else None
+                all_totals = site["product_totals"] if site else inventory_state.product_totals
+                for product_id in (site["balances"] if site else inventory_state.costs):
+                    costs = inventory_state.costs.get(product_id) or CostLayers()
+                    product = inventory_state.product(product_id)
+                    product_totals = all_totals.get(product_id) or _new_totals()
+                    value = _inventory_value(product_id, method, site)
+                    items.append({
+                        "id": product_id,
+                        "mainCat": product[1] if product else "",
+                        "subCat": product[2] if product else "",
+                        "onHand": site["balances"][product_id] if site else costs.quantity,
+                        "unitCost": round(costs.unit_cost(method), 4),
+                        "inventoryValue": round(value, 2),
+                        "cogs": round(product_totals[cogs_key], 2),
+                        "revenue": round(product_totals["sales"], 2),
+                        "margin": round(product_totals["sales"] - product_totals[cogs_key], 2),
+                        "cogsApproximate": costs.out_of_order,
+                    })
+                    totals["inventoryValue"] += value
+                    totals["cogs"] += product_totals[cogs_key]
+                    totals["revenue"] += product_totals["sales"]
+            totals = {key: round(value, 2) for key, value in totals.items()}
+            totals["margin"] = round(totals["revenue"] - totals["cogs"], 2)
+            totals["cogsApproximateProducts"] = sum(1 for item in items if item["cogsApproximate"])
+            return {"method": method, "location": location or "all", "products": items, "totals": totals}
+
+        return cached_json_response(("valuation", method, location, inventory_state.version), build_valuation)
+
+    except Exception as e:
+        print("❌ Error in valuation:", e)
+        return jsonify({"error": str(e)}), 500
+
+
 # ---------- GENERATE REPORT (WITH CATEGORIES INSTEAD OF PRODUCT NAME) ----------
 @app.route("/api/generate-report", methods=["POST"])
 def generate_report():
-    """Generate and save report to Google Sheets - WITH CATEGORIES INSTEAD OF PRODUCT NAME"""
+    """Generate and save report to Google Sheets - WITH CATEGORIES INSTEAD OF PRODUCT NAME.
+
+    Runs as a report job; answers 202 with the job if it takes longer than REPORT_WAIT_SECONDS.
+    """
     try:
         if reports_ws is None:
             return jsonify({"error": "Google Sheet not loaded"}), 500
@@ -881,52 +4168,93 @@ def generate_report():
         data = request.json
         report_type = data.get("type", "general")
         period = data.get("period", datetime.now().strftime("%Y-%m"))
+        location = str(data.get("location") or "").strip() or None
+        if report_type not in REPORT_TYPES:
+            report_type = "general"
+        try:
+            report_period = _report_period(report_type, period)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         print(f"📊 Generating {report_type} report for period: {period}")
-        
-        # Get report data based on type
-        if report_type == "monthly":
-            report_response = monthly_report()
-        elif report_type == "daily":
-            report_response = daily_report()
-        else:
-            report_response = simple_reports()
-            
-        report_data = report_response.get_json()
-        
-        if "error" in report_data:
-            return jsonify({"error": report_data["error"]}), 500
-        
-        # Save to Reports sheet - WITH CATEGORIES
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        for item in report_data["inventory"]:
-            # Calculate values based on actual data
-            purchase_value = item["received"] * 100  # Assuming average purchase price
-            sales_value = item["sold"] * 150         # Assuming average sale price
-            
-            reports_ws.append_row([
-                report_type,                    # Report Type
-                period,                         # Period
-                item["id"],                     # Product ID
-                item["mainCat"],                # ✅ MAIN CATEGORY (Product Name ki jagah)
-                item["received"],               # Received
-                item["sold"],                   # Sold
-                item.get("remaining", 0),       # Remaining
-                purchase_value,                 # Purchase Value
-                sales_value,                    # Sales Value
-                timestamp,                      # Generated At
-                item["subCat"]                  # ✅ SUB CATEGORY (new column)
-            ])
-        
+        job = report_jobs.submit(report_type, report_period, label=period, location=location,
+                                 method=_valuation_method(), save=True)
+        if not report_jobs.wait(job, REPORT_WAIT_SECONDS):
+            print(f"⏳ Report job {job['id']} still running - client will poll")
+            return jsonify({"message": "Report is being generated", "jobId": job["id"],
+                            "job": report_jobs.status(job)}), 202
+        if job["status"] == "failed":
+            return jsonify({"error": job["error"], "jobId": job["id"]}), 500
+
         print(f"✅ Report saved to Google Sheets: {report_type} - {period}")
-        return jsonify({"message": "Report generated and saved successfully", "data": report_data})
+        return jsonify({"message": "Report generated and saved successfully", "jobId": job["id"],
+                        "data": job["entry"]["report"]})
         
     except Exception as e:
         print("❌ Error generating report:", e)
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/report-jobs", methods=["GET", "POST"])
+def report_jobs_api():
+    """GET: recent jobs and the schedule. POST {"type", "period", "location", "method", "save"}: queue a report"""
+    try:
+        if transactions_ws is None or products_ws is None:
+            return jsonify({"error": "Google Sheet not loaded"}), 500
+
+        if request.method == "GET":
+            with report_jobs.lock:
+                jobs = [report_jobs.status(job) for job in reversed(report_jobs.jobs.values())]
+            return json_response({
+                "jobs": jobs,
+                "schedule": [{"type": report_type, "nextPeriod": _last_closed_period(report_type)}
+                             for report_type in REPORT_SCHEDULE],
+            })
+
+        data = request.json or {}
+        report_type = data.get("type", "")
+        if report_type not in REPORT_TYPES:
+            return jsonify({"error": f"type must be one of {', '.join(REPORT_TYPES)}"}), 400
+        method = data.get("method", VALUATION_METHOD)
+        if method not in VALUATION_METHODS:
+            return jsonify({"error": "method must be fifo or average"}), 400
+        save = bool(data.get("save"))
+        if save and reports_ws is None:
+            return jsonify({"error": "Google Sheet not loaded"}), 500
+        try:
+            period = _report_period(report_type, data.get("period", ""))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        location = str(data.get("location") or "").strip() or None
+        job = report_jobs.submit(report_type, period, label=data.get("period") or period, location=location,
+                                 method=method, save=save)
+        print(f"🗂️ Report job {job['id']} queued: {report_type} {period or 'all'}")
+        return jsonify(report_jobs.status(job)), 202
+
+    except Exception as e:
+        print("❌ Error in report jobs:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/report-jobs/<job_id>", methods=["GET"])
+def report_job(job_id):
+    """Job status; a finished job includes the report under "data" (?data=0 to leave it out)"""
+    try:
+        job = report_jobs.get(job_id)
+        if job is None:
+            return jsonify({"error": "Report job not found"}), 404
+        result = report_jobs.status(job)
+        if job["status"] == "done" and request.args.get("data") != "0":
+            entry = job["entry"]
+            result["data"] = entry["report"]
+            result["generatedAt"] = entry["generatedAt"]
+        return json_response(result)
+
+    except Exception as e:
+        print("❌ Error in report job:", e)
+        return jsonify({"error": str(e)}), 500
+
+
 # ---------- CATEGORIES API (NEW) ----------
 @app.route("/api/categories", methods=["GET", "POST", "DELETE"])
 def categories_api():
@@ -936,45 +4264,14 @@ def categories_api():
             return jsonify({"error": "Google Sheet not loaded"}), 500
             
         if request.method == "GET":
-            # Get all products to extract categories
-            all_products = products_ws.get_all_values()
-            
-            if len(all_products) < 2:
-                return jsonify({
-                    "main_categories": [],
-                    "sub_categories": {}
-                })
-            
-            headers = [h.strip() for h in all_products[0]]
-            rows = all_products[1:]
-            
-            main_categories = set()
-            sub_categories = {}
-            
-            for row in rows:
-                while len(row) < len(headers):
-                    row.append('')
-                
-                row_dict = {}
-                for i, header in enumerate(headers):
-                    row_dict[header] = row[i] if i < len(row) else ''
-                
-                main_cat = str(row_dict.get("Main Category", "")).strip()
-                sub_cat = str(row_dict.get("Sub Category", "")).strip()
-                
-                if main_cat:
-                    main_categories.add(main_cat)
-                    
-                    if main_cat not in sub_categories:
-                        sub_categories[main_cat] = set()
-                    
-                    if sub_cat:
-                        sub_categories[main_cat].add(sub_cat)
-            
-            return jsonify({
-                "main_categories": sorted(list(main_categories)),
-                "sub_categories": {k: sorted(list(v)) for k, v in sub_categories.items()}
-            })
+            # Served from the category index (kept current on product add/delete/update)
+            inventory_state.ensure_fresh()
+
+            def build_categories():
+                with inventory_state.lock:
+                    return inventory_state.index.categories()
+
+            return cached_json_response(("categories", inventory_state.catalog_version), build_categories)
         
         elif request.method == "POST":
             data = request.json
@@ -989,20 +4286,21 @@ def categories_api():
                 if not product_id or not new_main:
                     return jsonify({"error": "Product ID and main category are required"}), 400
                 
-                # Find and update the product
-                all_products = products_ws.get_all_values()
-                for i, row in enumerate(all_products[1:], start=2):  # start=2 because of header row
-                    if len(row) > 0 and str(row[0]).strip() == str(product_id):
-                        # Update the row
-                        updated_row = [
-                            row[0],  # ID
-                            new_main,  # Main Category
-                            new_sub   # Sub Category
-                        ]
-                        products_ws.update(f"A{i}:C{i}", [updated_row])
-                        return jsonify({"message": "Product categories updated successfully"})
-                
-                return jsonify({"error": "Product not found"}), 404
+                # Find the product row from the index and update it
+                inventory_state.ensure_fresh()
+                product_id = str(product_id).strip()
+                i = inventory_state.product_sheet_row(product_id)
+                if i is None:
+                    return jsonify({"error": "Product not found"}), 404
+
+                updated_row = [
+                    product_id,  # ID
+                    new_main,  # Main Category
+                    new_sub   # Sub Category
+                ]
+                products_ws.update(f"A{i}:C{i}", [updated_row])
+                inventory_state.apply_product_update(i, new_main, new_sub)
+                return jsonify({"message": "Product categories updated successfully"})
             
             elif action == "add_main":
                 # Add new main category (no direct storage needed, will be created when used)
@@ -1021,34 +4319,31 @@ def categories_api():
             category_name = data.get("category")
             main_category = data.get("main_category", "")
             
-            if category_type == "main":
-                # Delete main category by updating all products with this category
-                all_products = products_ws.get_all_values()
-                updated_count = 0
-                
-                for i, row in enumerate(all_products[1:], start=2):
-                    if len(row) > 1 and str(row[1]).strip() == category_name:
-                        # Remove main category (set to empty)
-                        products_ws.update(f"B{i}", [[""]])
-                        updated_count += 1
-                
-                return jsonify({"message": f"Main category removed from {updated_count} products"})
-            
-            elif category_type == "sub":
-                # Delete sub category by updating all products with this sub category
-                all_products = products_ws.get_all_values()
-                updated_count = 0
-                
-                for i, row in enumerate(all_products[1:], start=2):
-                    if len(row) > 2 and str(row[2]).strip() == category_name and str(row[1]).strip() == main_category:
-                        # Remove sub category
-                        products_ws.update(f"C{i}", [[""]])
-                        updated_count += 1
-                
-                return jsonify({"message": f"Sub category removed from {updated_count} products"})
-            
-            else:
+            if category_type not in ("main", "sub"):
                 return jsonify({"error": "Invalid category type"}), 400
+
+            # Rows come from the category index; one batched write clears them all
+            inventory_state.ensure_fresh()
+            with inventory_state.lock:
+                inventory_state.verify_product_rows()
+                if category_type == "main":
+                    column = "B"
+                    product_ids = inventory_state.index.by_main.get(category_name, set())
+                else:
+                    column = "C"
+                    product_ids = inventory_state.index.by_sub.get((main_category, category_name), set())
+                row_numbers = sorted(inventory_state.product_index[pid] + 2 for pid in product_ids)
+
+                if row_numbers:
+                    products_ws.batch_update([{"range": f"{column}{i}", "values": [[""]]} for i in row_numbers])
+                    for i in row_numbers:
+                        if category_type == "main":
+                            inventory_state.apply_product_update(i, main_cat="")
+                        else:
+                            inventory_state.apply_product_update(i, sub_cat="")
+
+            label = "Main" if category_type == "main" else "Sub"
+            return jsonify({"message": f"{label} category removed from {len(row_numbers)} products"})
                 
     except Exception as e:
         print("❌ Error in categories API:", e)
@@ -1062,39 +4357,24 @@ def products_with_categories():
         if products_ws is None:
             return jsonify({"error": "Google Sheet not loaded"}), 500
             
-        all_products = products_ws.get_all_values()
-        
-        if len(all_products) < 2:
-            return jsonify([])
-        
-        headers = [h.strip() for h in all_products[0]]
-        rows = all_products[1:]
-        
-        products_data = []
-        
-        for row in rows:
-            while len(row) < len(headers):
-                row.append('')
-            
-            row_dict = {}
-            for i, header in enumerate(headers):
-                row_dict[header] = row[i] if i < len(row) else ''
-            
-            product_id = str(row_dict.get("ID", "")).strip()
-            main_category = str(row_dict.get("Main Category", "")).strip()
-            sub_category = str(row_dict.get("Sub Category", "")).strip()
-            
-            if product_id:  # Only include products with ID
-                current_stock = calculate_current_stock(product_id)
-                
-                products_data.append({
-                    "id": product_id,
-                    "main_category": main_category,
-                    "sub_category": sub_category if sub_category else None,
-                    "current_stock": current_stock
-                })
-        
-        return jsonify(products_data)
+        inventory_state.ensure_fresh()
+
+        def build_products_with_categories():
+            with inventory_state.lock:
+                return [
+                    {
+                        "id": product_id,
+                        "main_category": main_category,
+                        "sub_category": sub_category if sub_category else None,
+                        "current_stock": inventory_state.balances.get(product_id, 0)
+                    }
+                    for product_id, main_category, sub_category in inventory_state.product_rows
+                    if product_id  # Only include products with ID
+                ]
+
+        return cached_json_response(
+            ("products-with-categories", inventory_state.version), build_products_with_categories
+        )
         
     except Exception as e:
         print("❌ Error in products with categories:", e)
@@ -1107,6 +4387,13 @@ def health_check():
     return jsonify({"status": "OK", "message": "Server is running"})
 
 
+# ---------- METRICS (PROMETHEUS) ----------
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint - request, Sheets and cache metrics for this worker"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 # ---------- RUN APP ----------
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,487 @@
+"""Offline benchmark for app.py - runs every /api/* endpoint against an in-memory fake of gspread.
+
+Usage:
+    python benchmark.py --products 1000 --transactions 10000
+    python benchmark.py --products 50000 --transactions 1000000 --latency-ms 80 --scenarios products,reports
+    python benchmark.py --output before.json
+    python benchmark.py --compare before.json --max-regression 20
+
+No Google credentials are needed - the app's worksheets are replaced with FakeWorksheet
+objects before any request is made.
+"""
+import argparse
+import atexit
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Never let the benchmark connect to the real sheet, even if a .env is present
+os.environ["GOOGLE_SERVICE_ACCOUNT_JSON"] = ""
+os.environ["GOOGLE_SERVICE_ACCOUNT"] = ""
+os.environ["SNAPSHOT_PATH"] = os.devnull
+os.environ.setdefault("ARCHIVE_DIR", os.path.join(tempfile.gettempdir(), f"inventory-benchmark-archive-{os.getpid()}"))
+os.environ.setdefault("REPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), f"inventory-benchmark-reports-{os.getpid()}"))
+os.environ.setdefault("REPORT_SCHEDULE", "")  # no recurring reports writing into the fake Reports sheet
+
+PRODUCT_HEADERS = ["ID", "Main Category", "Sub Category"]
+STOCK_HEADERS = ["Product ID", "Quantity", "Price", "Date", "Main Category", "Sub Category", "Location"]
+TRANSACTION_HEADERS = ["Type", "Product ID", "Quantity", "Price", "Date", "Main Category", "Sub Category", "Location"]
+REPORT_HEADERS = ["Report Type", "Period", "Product ID", "Main Category", "Received", "Sold", "Remaining",
+                  "Purchase Value", "Sales Value", "Generated At", "Sub Category", "Report Version"]
+
+REORDER_HEADERS = ["Product ID", "Reorder Point", "Reorder Quantity"]
+
+LOCATIONS = ["Main", "Store 2", "Store 3"]
+
+MAIN_CATEGORIES = ["Electronics", "Grocery", "Clothing", "Hardware", "Stationery", "Toys", "Beauty", "Sports"]
+
+
+# ---------------- FAKE GSPREAD ----------------
+def _parse_cell(cell):
+    """'C12' -> (12, 3); 'C' -> (None, 3)"""
+    match = re.fullmatch(r"([A-Za-z]+)(\d*)", cell.split("!")[-1])
+    if not match:
+        raise ValueError(f"Invalid cell reference: {cell}")
+    col = 0
+    for ch in match.group(1).upper():
+        col = col * 26 + (ord(ch) - 64)
+    return (int(match.group(2)) if match.group(2) else None), col
+
+
+class FakeWorksheet:
+    """In-memory stand-in for gspread.Worksheet with configurable per-call latency"""
+
+    def __init__(self, title, rows, latency=0.0, latency_per_1k_rows=0.0, sheet_id=0):
+        self.title = title
+        self.id = sheet_id
+        self.rows = rows
+        self.latency = latency
+        self.latency_per_1k_rows = latency_per_1k_rows
+        self.calls = 0
+
+    def _wait(self, rows_touched=1):
+        self.calls += 1
+        delay = self.latency + self.latency_per_1k_rows * rows_touched / 1000.0
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+    def get_all_values(self):
+        self._wait(len(self.rows))
+        return [list(row) for row in self.rows]
+
+    def get(self, range_name, **kwargs):
+        start, _, end = range_name.partition(":")
+        first_row, first_col = _parse_cell(start)
+        last_row, last_col = _parse_cell(end) if end else (first_row, first_col)
+        rows = self.rows[(first_row or 1) - 1:last_row]
+        self._wait(len(rows))
+        values = []
+        for row in rows:
+            cells = row[first_col - 1:last_col]
+            while cells and cells[-1] == "":
+                cells = cells[:-1]
+            values.append(list(cells))
+        return values
+
+    def col_values(self, col, **kwargs):
+        self._wait(len(self.rows))
+        values = [row[col - 1] if len(row) >= col else "" for row in self.rows]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def append_row(self, values, **kwargs):
+        self._wait()
+        self.rows.append([str(v) for v in values])
+        row = len(self.rows)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{row}:{chr(64 + max(len(values), 1))}{row}",
+                            "updatedRows": 1}}
+
+    def append_rows(self, values, **kwargs):
+        self._wait(len(values))
+        first = len(self.rows) + 1
+        self.rows.extend([str(v) for v in row] for row in values)
+        last = len(self.rows)
+        width = max((len(row) for row in values), default=1)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{first}:{chr(64 + width)}{last}",
+                            "updatedRows": len(values)}}
+
+    def _write_range(self, range_name, values):
+        start, _, end = range_name.partition(":")
+        row, col = _parse_cell(start)
+        for r_offset, value_row in enumerate(values):
+            target = row + r_offset
+            while len(self.rows) < target:
+                self.rows.append([])
+            sheet_row = self.rows[target - 1]
+            for c_offset, value in enumerate(value_row):
+                while len(sheet_row) < col + c_offset:
+                    sheet_row.append("")
+                sheet_row[col + c_offset - 1] = str(value)
+
+    def update(self, range_name, values=None, **kwargs):
+        self._wait(len(values or []))
+        self._write_range(range_name, values or [])
+        return {"updatedRange": range_name}
+
+    def batch_update(self, data, **kwargs):
+        self._wait(sum(len(item["values"]) for item in data))
+        for item in data:
+            self._write_range(item["range"], item["values"])
+        return {"totalUpdatedRanges": len(data)}
+
+    def delete_rows(self, start_index, end_index=None):
+        self._wait()
+        end_index = end_index or start_index
+        del self.rows[start_index - 1:end_index]
+        return {}
+
+
+class FakeSpreadsheet:
+    """Spreadsheet-level batch_update; supports the deleteDimension / insertDimension / updateCells requests the app sends"""
+
+    def __init__(self, worksheets):
+        self.worksheets = {ws.id: ws for ws in worksheets}
+
+    @staticmethod
+    def _target(req):
+        body = next(iter(req.values()))
+        return body["range"]["sheetId"] if "range" in body else body["start"]["sheetId"]
+
+    def batch_update(self, body):
+        requests = body.get("requests", [])
+        if requests:  # one API call for the whole batch
+            self.worksheets[self._target(requests[0])]._wait(len(requests))
+        for req in requests:
+            rows = self.worksheets[self._target(req)].rows
+            if "deleteDimension" in req:
+                dim = req["deleteDimension"]["range"]
+                del rows[dim["startIndex"]:dim["endIndex"]]
+            elif "insertDimension" in req:
+                dim = req["insertDimension"]["range"]
+                rows[dim["startIndex"]:dim["startIndex"]] = [[] for _ in range(dim["endIndex"] - dim["startIndex"])]
+            elif "updateCells" in req:
+                start = req["updateCells"]["start"]
+                for offset, row in enumerate(req["updateCells"]["rows"]):
+                    rows[start["rowIndex"] + offset] = [str(next(iter(cell["userEnteredValue"].values())))
+                                                        for cell in row["values"]]
+        return {"replies": [{} for _ in requests]}
+
+
+# ---------------- SYNTHETIC DATA ----------------
+def generate_products(count, seed=42):
+    rng = random.Random(seed)
+    rows = [PRODUCT_HEADERS]
+    for i in range(count):
+        main = rng.choice(MAIN_CATEGORIES)
+        sub = f"{main[:3].upper()}-{rng.randint(1, 12)}"
+        rows.append([f"SKU{i:06d}", main, sub])
+    return rows
+
+
+def generate_transactions(count, product_rows, days=365, seed=42):
+    """Chronological ledger where stock out never exceeds what was received.
+
+    Returns (transactions, stock_in, stock_out) rows with headers, consistent with each other.
+    """
+    rng = random.Random(seed)
+    products = product_rows[1:]
+    stock = [dict.fromkeys(LOCATIONS, 0) for _ in products]
+    start = datetime.now() - timedelta(days=days)
+    step = timedelta(days=days) / max(count, 1)
+
+    transactions = [TRANSACTION_HEADERS]
+    stock_in = [STOCK_HEADERS]
+    stock_out = [STOCK_HEADERS]
+    for i in range(count):
+        idx = rng.randrange(len(products))
+        pid, main, sub = products[idx]
+        loc = rng.choice(LOCATIONS)
+        date_str = (start + step * i).strftime("%Y-%m-%d %H:%M:%S")
+        if stock[idx][loc] > 0 and rng.random() < 0.6:
+            qty = rng.randint(1, min(stock[idx][loc], 20))
+            price = round(rng.uniform(120, 300), 2)
+            stock[idx][loc] -= qty
+            transactions.append(["out", pid, str(qty), str(price), date_str, main, sub, loc])
+            stock_out.append([pid, str(qty), str(price), date_str, main, sub, loc])
+        else:
+            qty = rng.randint(5, 50)
+            price = round(rng.uniform(50, 200), 2)
+            stock[idx][loc] += qty
+            transactions.append(["in", pid, str(qty), str(price), date_str, main, sub, loc])
+            stock_in.append([pid, str(qty), str(price), date_str, main, sub, loc])
+    return transactions, stock_in, stock_out
+
+
+class Dataset:
+    """Generated sheet contents; fresh FakeWorksheets are built from it for every scenario"""
+
+    def __init__(self, products, transactions, seed=42):
+        self.products = generate_products(products, seed)
+        self.transactions, self.stock_in, self.stock_out = generate_transactions(transactions, self.products, seed=seed)
+        self.reports = [REPORT_HEADERS]
+        rng = random.Random(seed)
+        self.reorder_points = [REORDER_HEADERS] + [[row[0], str(rng.randint(5, 40)), str(rng.randint(20, 100))]
+                                                   for row in self.products[1::10]]
+
+    def worksheets(self, latency=0.0, latency_per_1k_rows=0.0):
+        def ws(title, rows, sheet_id):
+            return FakeWorksheet(title, [list(r) for r in rows], latency, latency_per_1k_rows, sheet_id)
+        sheets = {
+            "products_ws": ws("Products", self.products, 1),
+            "stockin_ws": ws("Stock In", self.stock_in, 2),
+            "stockout_ws": ws("Stock Out", self.stock_out, 3),
+            "transactions_ws": ws("Transactions", self.transactions, 4),
+            "reports_ws": ws("Reports", self.reports, 5),
+            "reorder_ws": ws("Reorder Points", self.reorder_points, 6),
+        }
+        spreadsheet = FakeSpreadsheet(sheets.values())
+        for sheet in sheets.values():
+            sheet.spreadsheet = spreadsheet
+        return sheets
+
+
+def install(app_module, worksheets):
+    """Point the app's module-level worksheets at fakes (wrapped so /metrics still works).
+
+    Every module-level cache is replaced too, so nothing built in one scenario is served in the next.
+    """
+    for name, ws in worksheets.items():
+        setattr(app_module, name, app_module.InstrumentedWorksheet(ws))
+    app_module.inventory_state.reset()
+    app_module.body_cache = app_module.BodyCache(app_module.BODY_CACHE_SIZE)
+    app_module.stock_alerts = app_module.StockAlerts()
+    app_module.demand_forecast = app_module.DemandForecast()
+    app_module.reconciler = app_module.Reconciler()
+    app_module.balance_history = app_module.BalanceHistory()
+    app_module.scan_sessions = app_module.ScanSessions()
+    app_module.movement_receipts = app_module.MovementReceipts()
+    # Closed-period reports are also kept on disk - give every scenario an empty directory
+    report_dir = tempfile.mkdtemp(prefix="inventory-benchmark-reports-")
+    atexit.register(shutil.rmtree, report_dir, True)
+    app_module.report_cache = app_module.ReportCache(report_dir)
+    app_module.report_jobs = app_module.ReportJobs()
+
+
+# ---------------- SCENARIOS ----------------
+def _existing_product(ds, rng):
+    return ds.products[rng.randrange(1, len(ds.products))][0]
+
+
+def _current_sync_token():
+    """Token of the state as it is now - measures the "nothing changed" delta every polling page sends"""
+    app_module = sys.modules["app"]
+    return f"{app_module.BOOT_ID}.{app_module.inventory_state.version}"
+
+
+def _scan_session(ds, rng, scans=0):
+    """Open stock-in scan session (new when scans > 0, pre-filled with that many scans)"""
+    app_module = sys.modules["app"]
+    app_module.inventory_state.ensure_fresh()
+    sessions = app_module.scan_sessions
+    open_sessions = [s for s in sessions.sessions.values() if s["status"] == "open"]
+    if open_sessions and not scans:
+        return open_sessions[0]["id"]
+    session = sessions.open("in", "Main", 100)
+    for _ in range(scans):
+        sessions.scan(session, {"code": _existing_product(ds, rng)})
+    return session["id"]
+
+
+def _scenarios(ds):
+    """name -> callable(rng, i) returning (method, path, json_body)"""
+    month = datetime.now().strftime("%Y-%m")
+    today = datetime.now().strftime("%Y-%m-%d")
+    last_month = (datetime.now().replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+    return {
+        "health": lambda rng, i: ("GET", "/api/health", None),
+        "dashboard-stats": lambda rng, i: ("GET", "/api/dashboard-stats", None),
+        "products": lambda rng, i: ("GET", "/api/products", None),
+        "products-search": lambda rng, i: ("GET", f"/api/products/search?q=SKU{rng.randrange(100):02d}&limit=50", None),
+        "products-search-category": lambda rng, i: ("GET", "/api/products/search?mainCat="
+                                                    f"{rng.choice(MAIN_CATEGORIES)}&sort=-quantity&limit=50", None),
+        "products-add": lambda rng, i: ("POST", "/api/products",
+                                        {"id": f"BENCH{i:06d}", "mainCat": "Bench", "subCat": "B-1"}),
+        "products-delete": lambda rng, i: ("DELETE", f"/api/products?id={_existing_product(ds, rng)}", None),
+        "products-import": lambda rng, i: ("POST", "/api/products/import",
+                                           [{"id": f"IMP{i:03d}-{n:05d}", "mainCat": rng.choice(MAIN_CATEGORIES),
+                                             "subCat": "IMP-1"} for n in range(5000)]),
+        "products-batch-delete": lambda rng, i: ("POST", "/api/products/batch-delete",
+                                                 {"ids": [_existing_product(ds, rng) for _ in range(100)]}),
+        "stockin": lambda rng, i: ("POST", "/api/stockin",
+                                   {"productId": _existing_product(ds, rng), "quantity": 10, "price": 100}),
+        "stockout": lambda rng, i: ("POST", "/api/stockout",
+                                    {"productId": _existing_product(ds, rng), "quantity": 1, "price": 150}),
+        "reports": lambda rng, i: ("GET", "/api/reports", None),
+        "scan": lambda rng, i: ("POST", f"/api/scan-sessions/{_scan_session(ds, rng)}/scans",
+                                {"code": _existing_product(ds, rng), "scanId": f"bench-{i}"}),
+        "scan-commit": lambda rng, i: ("POST", f"/api/scan-sessions/{_scan_session(ds, rng, scans=100)}/commit", None),
+        "sync-full": lambda rng, i: ("GET", "/api/sync", None),
+        "sync-delta": lambda rng, i: ("GET", f"/api/sync?since={_current_sync_token()}", None),
+        "low-stock": lambda rng, i: ("GET", "/api/low-stock", None),
+        "locations": lambda rng, i: ("GET", "/api/locations", None),
+        "dashboard-stats-location": lambda rng, i: ("GET", "/api/dashboard-stats?location=" + rng.choice(LOCATIONS), None),
+        "transfer": lambda rng, i: ("POST", "/api/transfer", {"productId": _existing_product(ds, rng), "quantity": 1,
+                                                              "from": "Main", "to": rng.choice(LOCATIONS[1:])}),
+        "archive-dry-run": lambda rng, i: ("POST", "/api/archive", {"before": month, "dryRun": True}),
+        "stock-as-of": lambda rng, i: ("GET", "/api/stock/as-of?date="
+                                       + (datetime.now() - timedelta(days=rng.randrange(365))).strftime("%Y-%m-%d"), None),
+        "reconcile": lambda rng, i: ("GET", "/api/reconcile?limit=20", None),
+        "forecast": lambda rng, i: ("GET", "/api/forecast?method=" + rng.choice(["ema", "ma"]) + "&days=30", None),
+        "low-stock-events": lambda rng, i: ("GET", "/api/low-stock/events?since=0", None),
+        "reorder-points-set": lambda rng, i: ("POST", "/api/reorder-points",
+                                              {"productId": _existing_product(ds, rng), "reorderPoint": rng.randint(5, 40),
+                                               "reorderQuantity": 50}),
+        "simple-reports": lambda rng, i: ("GET", "/api/simple-reports", None),
+        "valuation": lambda rng, i: ("GET", "/api/valuation?method=" + rng.choice(["fifo", "average"]), None),
+        "monthly-report": lambda rng, i: ("GET", f"/api/monthly-report?month={month}", None),
+        "daily-report": lambda rng, i: ("GET", f"/api/daily-report?date={today}", None),
+        "generate-report": lambda rng, i: ("POST", "/api/generate-report", {"type": "monthly", "period": month}),
+        "generate-report-category": lambda rng, i: ("POST", "/api/generate-report", {"type": "category", "period": month}),
+        "monthly-report-closed": lambda rng, i: ("GET", f"/api/monthly-report?month={last_month}", None),
+        "categories": lambda rng, i: ("GET", "/api/categories", None),
+        "categories-update": lambda rng, i: ("POST", "/api/categories",
+                                             {"action": "update_product", "product_id": _existing_product(ds, rng),
+                                              "main_category": rng.choice(MAIN_CATEGORIES), "sub_category": "X-1"}),
+        "categories-delete": lambda rng, i: ("DELETE", "/api/categories",
+                                             {"type": "sub", "category": "X-1", "main_category": "Electronics"}),
+        "products-with-categories": lambda rng, i: ("GET", "/api/products-with-categories", None),
+    }
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def run_scenario(app_module, ds, name, make_request, iterations, warmup, args):
+    worksheets = ds.worksheets(args.latency_ms / 1000.0, args.latency_per_1k_rows_ms / 1000.0)
+    install(app_module, worksheets)
+    client = app_module.app.test_client()
+    rng = random.Random(args.seed)
+
+    latencies = []
+    statuses = {}
+    sink = io.StringIO()
+    total_started = time.perf_counter()
+    for i in range(warmup + iterations):
+        method, path, body = make_request(rng, i)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            response = client.open(path, method=method, json=body)
+        elapsed = time.perf_counter() - started
+        sink.seek(0)
+        sink.truncate()
+        if i < warmup:
+            total_started = time.perf_counter()
+            continue
+        latencies.append(elapsed)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    wall = time.perf_counter() - total_started
+
+    latencies.sort()
+    sheet_calls = sum(ws.calls for ws in worksheets.values())
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        "sheet_calls_per_request": round(sheet_calls / max(warmup + iterations, 1), 2),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+def print_results(results):
+    header = f"{'scenario':<28}{'req':>6}{'req/s':>10}{'p50 ms':>11}{'p90 ms':>11}{'p99 ms':>11}{'max ms':>11}{'calls/req':>11}  status"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<28}{r['requests']:>6}{r['throughput_rps']:>10}{r['p50_ms']:>11}{r['p90_ms']:>11}"
+              f"{r['p99_ms']:>11}{r['max_ms']:>11}{r['sheet_calls_per_request']:>11}  {r['statuses']}")
+
+
+def compare_results(results, baseline_path, max_regression):
+    """Print p50 change per scenario against a saved run; returns True if any scenario regressed too much"""
+    with open(baseline_path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    regressed = False
+    print(f"\nComparison against {baseline_path} (p50):")
+    for r in results:
+        before = baseline.get(r["scenario"])
+        if not before or not before["p50_ms"]:
+            print(f"  {r['scenario']:<28} (no baseline)")
+            continue
+        change = (r["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+        flag = ""
+        if change > max_regression:
+            flag = "  ❌ REGRESSION"
+            regressed = True
+        print(f"  {r['scenario']:<28}{before['p50_ms']:>10} -> {r['p50_ms']:<10} ({change:+.1f}%){flag}")
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark app.py endpoints against an in-memory fake Google Sheet")
+    parser.add_argument("--products", type=int, default=1000, help="Number of products (1k-100k)")
+    parser.add_argument("--transactions", type=int, default=10000, help="Number of ledger rows (10k-1M)")
+    parser.add_argument("--iterations", type=int, default=5, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured requests per scenario")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Injected latency per Sheets call")
+    parser.add_argument("--latency-per-1k-rows-ms", type=float, default=0.0,
+                        help="Extra injected latency per 1000 rows read or written")
+    parser.add_argument("--scenarios", default="", help="Comma separated scenario names (default: all)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Compare p50 latencies with a previous --output file")
+    parser.add_argument("--max-regression", type=float, default=25.0,
+                        help="Exit non-zero if any p50 is this many percent slower than --compare")
+    args = parser.parse_args(argv)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as app_module
+
+    print(f"🔧 Generating {args.products} products and {args.transactions} transactions...")
+    ds = Dataset(args.products, args.transactions, seed=args.seed)
+
+    scenarios = _scenarios(ds)
+    selected = [s.strip() for s in args.scenarios.split(",") if s.strip()] or list(scenarios)
+    unknown = [s for s in selected if s not in scenarios]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)} (available: {', '.join(scenarios)})")
+
+    results = []
+    for name in selected:
+        print(f"⏱️  {name}...", file=sys.stderr)
+        results.append(run_scenario(app_module, ds, name, scenarios[name], args.iterations, args.warmup, args))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+
+    if args.compare and compare_results(results, args.compare, args.max_regression):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
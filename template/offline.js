@@ -0,0 +1,222 @@
+// Local cache + delta sync shared by the dashboard, Stock and Product pages.
+// Products and recent stock movements live in IndexedDB; /api/sync only sends what changed
+// since our token. Stock movements made while offline wait in the outbox and are posted,
+// in order, with their clientId and occurredAt once the server is reachable again. The server
+// remembers clientIds in memory only, so a resend after a server restart is booked again.
+// A movement the server refuses (e.g. not enough stock) is kept in the rejected store until
+// the user retries or discards it - it happened physically, so it is never dropped silently.
+window.InventorySync = window.InventorySync || (function () {
+  const DB_NAME = 'inventory-cache';
+  const DB_VERSION = 2;
+  const MAX_TRANSACTIONS = 200;
+  const ENDPOINTS = { in: '/api/stockin', out: '/api/stockout' };
+  let dbPromise = null;
+  let running = null;
+
+  function openDb() {
+    if (!dbPromise) {
+      dbPromise = new Promise((resolve, reject) => {
+        const req = indexedDB.open(DB_NAME, DB_VERSION);
+        req.onupgradeneeded = () => {
+          const db = req.result;
+          const create = (name, options) => {
+            if (!db.objectStoreNames.contains(name)) db.createObjectStore(name, options);
+          };
+          create('products', { keyPath: 'id' });
+          create('transactions', { keyPath: 'seq', autoIncrement: true });
+          create('outbox', { keyPath: 'seq', autoIncrement: true });
+          create('meta');
+          create('rejected', { keyPath: 'seq' });  // outbox entries the server refused, same seq
+        };
+        req.onsuccess = () => resolve(req.result);
+        req.onerror = () => reject(req.error);
+      });
+    }
+    return dbPromise;
+  }
+
+  function requestResult(req) {
+    return new Promise((resolve, reject) => {
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => reject(req.error);
+    });
+  }
+
+  function transactionDone(tx) {
+    return new Promise((resolve, reject) => {
+      tx.oncomplete = () => resolve();
+      tx.onerror = tx.onabort = () => reject(tx.error);
+    });
+  }
+
+  async function getAll(store) {
+    const db = await openDb();
+    return requestResult(db.transaction(store).objectStore(store).getAll());
+  }
+
+  async function getMeta(key) {
+    const db = await openDb();
+    return requestResult(db.transaction('meta').objectStore('meta').get(key));
+  }
+
+  async function setMeta(key, value) {
+    const db = await openDb();
+    const tx = db.transaction('meta', 'readwrite');
+    tx.objectStore('meta').put(value, key);
+    return transactionDone(tx);
+  }
+
+  function newClientId() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+  }
+
+  // Apply a /api/sync response and keep only the latest MAX_TRANSACTIONS movements
+  async function applySync(data) {
+    const db = await openDb();
+    const tx = db.transaction(['products', 'transactions', 'meta'], 'readwrite');
+    const products = tx.objectStore('products');
+    const transactions = tx.objectStore('transactions');
+    if (data.full) {
+      products.clear();
+      transactions.clear();
+    }
+    data.products.forEach(p => products.put(p));
+    data.deleted.forEach(id => products.delete(id));
+    data.transactions.forEach(t => transactions.add(t));
+    transactions.count().onsuccess = event => {
+      let extra = event.target.result - MAX_TRANSACTIONS;
+      if (extra <= 0) return;
+      transactions.openCursor().onsuccess = e => {
+        const cursor = e.target.result;
+        if (cursor && extra-- > 0) {
+          cursor.delete();
+          cursor.continue();
+        }
+      };
+    };
+    tx.objectStore('meta').put(data.token, 'token');
+    return transactionDone(tx);
+  }
+
+  // Post queued movements oldest first; stop at the first network or server error.
+  // A refused movement moves to the rejected store.
+  async function flushOutbox() {
+    const result = { sent: 0, rejected: [] };
+    const entries = await getAll('outbox');
+    for (const entry of entries) {
+      let res;
+      try {
+        res = await fetch(ENDPOINTS[entry.type], {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify(entry.payload)
+        });
+      } catch (err) {
+        break;
+      }
+      if (res.status >= 500) break;
+      let rejected = null;
+      if (res.ok) {
+        result.sent++;
+      } else {
+        const data = await res.json().catch(() => ({}));
+        console.error('❌ Queued stock movement rejected:', entry, data);
+        rejected = { ...entry, error: data.error || `HTTP ${res.status}`, rejectedAt: new Date().toISOString() };
+        result.rejected.push(rejected);
+      }
+      const db = await openDb();
+      const tx = db.transaction(['outbox', 'rejected'], 'readwrite');
+      tx.objectStore('outbox').delete(entry.seq);
+      if (rejected) tx.objectStore('rejected').put(rejected);
+      await transactionDone(tx);
+    }
+    return result;
+  }
+
+  // Flush the outbox, then pull changes. Resolves to { online, changed, sent, rejected }.
+  function sync() {
+    if (running) return running;
+    running = (async () => {
+      let outbox = { sent: 0, rejected: [] };
+      try {
+        outbox = await flushOutbox();
+        // A rejected movement leaves a wrong local stock figure behind - start over from a full sync
+        const token = outbox.rejected.length ? '' : (await getMeta('token')) || '';
+        const res = await fetch(`/api/sync?since=${encodeURIComponent(token)}`);
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
+        const data = await res.json();
+        const changed = data.full || data.token !== token;
+        if (changed) await applySync(data);
+        return { online: true, changed, ...outbox };
+      } catch (err) {
+        console.warn('📴 Sync failed, using the local copy:', err);
+        return { online: false, changed: false, ...outbox };
+      } finally {
+        running = null;
+      }
+    })();
+    return running;
+  }
+
+  // Queue a stock movement (payload as for /api/stockin or /api/stockout, with a clientId)
+  // and apply it to the local stock figure until the server confirms it. occurredAt makes the
+  // server date it when it happened rather than when the outbox is flushed.
+  async function queueMovement(type, payload) {
+    payload = { ...payload, occurredAt: payload.occurredAt || new Date().toISOString() };
+    const db = await openDb();
+    const tx = db.transaction(['outbox', 'products'], 'readwrite');
+    tx.objectStore('outbox').add({ type, payload });
+    const products = tx.objectStore('products');
+    products.get(payload.productId).onsuccess = event => {
+      const product = event.target.result;
+      if (!product) return;
+      product.quantity = (product.quantity || 0) + (type === 'in' ? payload.quantity : -payload.quantity);
+      products.put(product);
+    };
+    return transactionDone(tx);
+  }
+
+  async function pendingCount() {
+    const db = await openDb();
+    return requestResult(db.transaction('outbox').objectStore('outbox').count());
+  }
+
+  // Put a rejected movement back at the end of the outbox (same clientId) and sync
+  async function retryRejected(seq) {
+    const db = await openDb();
+    const tx = db.transaction(['rejected', 'outbox'], 'readwrite');
+    const rejected = tx.objectStore('rejected');
+    rejected.get(seq).onsuccess = event => {
+      const entry = event.target.result;
+      if (!entry) return;
+      rejected.delete(seq);
+      tx.objectStore('outbox').add({ type: entry.type, payload: entry.payload });
+    };
+    await transactionDone(tx);
+    return sync();
+  }
+
+  async function discardRejected(seq) {
+    const db = await openDb();
+    const tx = db.transaction('rejected', 'readwrite');
+    tx.objectStore('rejected').delete(seq);
+    return transactionDone(tx);
+  }
+
+  window.addEventListener('online', () => sync());
+
+  return {
+    sync,
+    products: () => getAll('products'),
+    transactions: () => getAll('transactions'),
+    getMeta,
+    setMeta,
+    queueMovement,
+    pendingCount,
+    rejected: () => getAll('rejected'),
+    retryRejected,
+    discardRejected,
+    newClientId
+  };
+})();